@@ -1,25 +1,54 @@
-from flask import Flask, render_template, jsonify, request, redirect, abort
+from flask import Flask, Response, render_template, jsonify, request, redirect, abort
 import os
-import requests
+import base64
+import csv
 import hashlib
+import hmac
+import io
+import json
 import logging
-import threading
-from datetime import datetime
+import math
+from datetime import date, datetime, timedelta
 from decimal import Decimal, ROUND_HALF_UP
+import click_api
+from cache import TTLCache
+from compression import Compression
 from database import Database
+from jobs import JobQueue
+from metrics import Metrics
+from notifier import TelegramDispatcher, build_payment_message
+from page_cache import PageCache
+from quota import QuotaEngine
+from ratelimit import RateLimiter, RedisBucketStore
+from scheduler import PaymentSweeper, TariffExpiryScheduler
+from slowlog import SlowQueryLog
+from static_assets import init_static_assets
 from typing import Tuple
 from config import (
-    CLICK_SECRET_KEY,
+    ADMIN_API_TOKEN,
     CLICK_SERVICE_ID,
     CLICK_MERCHANT_ID,
     CLICK_MERCHANT_USER_ID,
+    CLICK_IDEMPOTENCY_CACHE_SIZE,
+    CLICK_IDEMPOTENCY_CACHE_TTL,
     BOT_TOKEN,
+    COMPRESSION_MIN_SIZE,
+    JOB_QUEUE_CONFIG,
+    METRICS_TOKEN,
+    NOTIFIER_CONFIG,
+    PAYMENT_SWEEPER_CONFIG,
     PLUS_PACKAGES,
     PLUS_PACKAGE_SEQUENCE,
-    TARIFF_LIMITS,
+    QUOTA_CONFIG,
+    RATE_LIMIT_CONFIG,
+    SLOW_QUERY_CONFIG,
+    TARIFF_EXPIRY_CONFIG,
 )
 
 app = Flask(__name__)
+init_static_assets(app)
+# Click's servers gain nothing from compressed callback responses.
+compression = Compression(app, min_size=COMPRESSION_MIN_SIZE, exclude_endpoints=('click_prepare', 'click_complete'))
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,18 +57,10 @@ logging.basicConfig(
 )
 
 db = Database()
+slow_queries = SlowQueryLog(db, **SLOW_QUERY_CONFIG)
 
 try:
-    db.create_payments_table()
-    db.create_user_package_limits_table()
-    db.ensure_payments_package_column()
-    db.create_plus_package_purchases_table()
-    db.ensure_plus_purchase_columns()
-    db.ensure_user_package_limit_defaults()
-    db.ensure_payments_discount_columns()
-    db.create_promo_codes_table()
-    db.create_promo_code_redemptions_table()
-    db.seed_promo_codes()
+    db.ensure_schema()
 except Exception as bootstrap_err:
     logging.warning(f"⚠️ Database bootstrap warning: {bootstrap_err}")
 
@@ -67,7 +88,7 @@ def _calculate_discount(amount: Decimal, percent: int) -> Tuple[Decimal, Decimal
 def _validate_promocode(code: str, plan_type: str, amount: Decimal):
     if not code:
         raise ValueError("Promokod kiritilmadi")
-    promo = db.get_promo_code(code)
+    promo = db.get_cached_promo_code(code)
     if not promo:
         raise ValueError("Bunday promokod topilmadi")
     if not promo.get('is_active'):
@@ -102,106 +123,87 @@ def _validate_promocode(code: str, plan_type: str, amount: Decimal):
     }
 
 
-def _notify_telegram(payload: dict) -> None:
-    if not payload or not BOT_TOKEN:
-        return
-    try:
-        display_tariff = 'Max' if payload['tariff'] == 'PRO' else payload['tariff']
-        message = (
-            f"✅ To'lov {int(payload['amount']):,} so'm muvaffaqiyatli amalga oshirildi!\n\n"
-            f"Tarifingiz faollashtirildi: {display_tariff}"
-        )
-        package_info = payload.get('package')
-        if package_info:
-            message += (
-                f"\nPaket: {package_info.get('title', payload.get('package_code'))} "
-                f"({package_info.get('text_limit', 0)} ta matn / {package_info.get('voice_limit', 0)} ta ovoz)"
-            )
-        requests.post(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-            json={'chat_id': payload['user_id'], 'text': message},
-            timeout=5,
-        )
-    except Exception as err:
-        logging.error(f"Telegram notification error: {err}")
-
-
 def _process_payment_success(merchant_trans_id: str, amount_value: float, *, update_payment: bool = True, send_notification: bool = True) -> None:
     try:
-        if update_payment:
-            try:
+        # All completion writes share one connection and one transaction, so
+        # a failure leaves neither a confirmed payment without a tariff nor
+        # a tariff without its package.
+        with db.session(transaction=True):
+            # The row lock serialises concurrent runs for one payment. Database
+            # errors are not swallowed anywhere in this block: after a deadlock
+            # or lock wait timeout MySQL has already rolled the transaction
+            # back, so carrying on would commit only the writes that follow.
+            # They propagate and the job is retried as a whole.
+            payment_rec = db.get_payment_by_merchant_trans_id(merchant_trans_id, for_update=True)
+
+            if update_payment:
+                if payment_rec and payment_rec.get('status') == 'confirmed':
+                    logging.info(f"Payment {merchant_trans_id} already completed, skipping")
+                    return
                 db.update_payment_complete(merchant_trans_id, status='confirmed', error_code=0, error_note='Success')
-            except Exception as update_err:
-                logging.error(f"Payment status update error: {update_err}")
-
-        payment_rec = None
-        try:
-            payment_rec = db.get_payment_by_merchant_trans_id(merchant_trans_id)
-        except Exception as fetch_err:
-            logging.error(f"Fetch payment error: {fetch_err}")
 
-        user_id = None
-        normalized_tariff = None
-        package_code = None
-        promo_code_value = None
-        months = 1
+            user_id = None
+            normalized_tariff = None
+            package_code = None
+            promo_code_value = None
+            months = 1
 
-        if payment_rec:
-            try:
-                user_id = int(payment_rec.get('user_id'))
-            except (TypeError, ValueError):
-                user_id = None
-            normalized_tariff = (payment_rec.get('tariff') or 'PLUS').upper()
-            package_code = payment_rec.get('package_code')
-            promo_code_value = (payment_rec.get('promo_code') or '').strip() or None
-            try:
-                amount_value = float(payment_rec.get('amount') or amount_value or 0)
-            except (TypeError, ValueError):
-                amount_value = float(amount_value or 0)
-        else:
-            parts = merchant_trans_id.split('_') if merchant_trans_id else []
-            if len(parts) >= 2:
+            if payment_rec:
                 try:
-                    user_id = int(parts[0])
+                    user_id = int(payment_rec.get('user_id'))
                 except (TypeError, ValueError):
                     user_id = None
-                tariff_token = parts[1].upper()
-                normalized_tariff = 'PLUS' if tariff_token == 'PLUS' else tariff_token
-                if tariff_token == 'PLUS' and len(parts) >= 3:
-                    third = parts[2]
-                    if third.isdigit():
-                        months = int(third)
-                    else:
-                        package_code = third.upper()
-                elif len(parts) >= 3 and parts[2].isdigit():
-                    months = int(parts[2])
-
-        if not (normalized_tariff and user_id):
-            return
+                normalized_tariff = (payment_rec.get('tariff') or 'PLUS').upper()
+                package_code = payment_rec.get('package_code')
+                promo_code_value = (payment_rec.get('promo_code') or '').strip() or None
+                try:
+                    amount_value = float(payment_rec.get('amount') or amount_value or 0)
+                except (TypeError, ValueError):
+                    amount_value = float(amount_value or 0)
+            else:
+                parts = merchant_trans_id.split('_') if merchant_trans_id else []
+                if len(parts) >= 2:
+                    try:
+                        user_id = int(parts[0])
+                    except (TypeError, ValueError):
+                        user_id = None
+                    tariff_token = parts[1].upper()
+                    normalized_tariff = 'PLUS' if tariff_token == 'PLUS' else tariff_token
+                    if tariff_token == 'PLUS' and len(parts) >= 3:
+                        third = parts[2]
+                        if third.isdigit():
+                            months = int(third)
+                        else:
+                            package_code = third.upper()
+                    elif len(parts) >= 3 and parts[2].isdigit():
+                        months = int(parts[2])
+
+            if not (normalized_tariff and user_id):
+                return
 
-        try:
             db.activate_tariff(user_id, normalized_tariff, months)
-        except Exception as activate_err:
-            logging.error(f"Activate tariff error: {activate_err}")
-
-        package_info = None
-        if promo_code_value:
-            try:
-                db.update_promo_redemption_status(merchant_trans_id, 'completed')
-                db.increment_promo_code_usage(promo_code_value)
-            except Exception as promo_err:
-                logging.error(f"Promo redemption complete error: {promo_err}")
 
-        if package_code:
-            package_info = PLUS_PACKAGES.get(package_code)
-            text_limit_val = int(package_info['text_limit']) if package_info and package_info.get('text_limit') is not None else 0
-            voice_limit_val = int(package_info['voice_limit']) if package_info and package_info.get('voice_limit') is not None else 0
-            if package_info:
+            package_info = None
+            if promo_code_value:
                 try:
+                    discount_percent = int(payment_rec.get('discount_percent') or 0)
+                except (TypeError, ValueError):
+                    logging.error(f"Invalid discount_percent on payment {merchant_trans_id}")
+                    discount_percent = 0
+                db.complete_promo_reservation(
+                    promo_code_value,
+                    user_id,
+                    merchant_trans_id,
+                    discount_percent,
+                    payment_rec.get('discount_amount') or 0,
+                )
+
+            if package_code:
+                package_info = PLUS_PACKAGES.get(package_code)
+                text_limit_val = int(package_info['text_limit']) if package_info and package_info.get('text_limit') is not None else 0
+                voice_limit_val = int(package_info['voice_limit']) if package_info and package_info.get('voice_limit') is not None else 0
+                if package_info:
                     db.assign_user_package(user_id, package_code, package_info['text_limit'], package_info['voice_limit'])
-                except Exception as assign_err:
-                    logging.error(f"Assign package error: {assign_err}")
-            try:
                 db.log_package_purchase(
                     user_id,
                     package_code,
@@ -211,20 +213,124 @@ def _process_payment_success(merchant_trans_id: str, amount_value: float, *, upd
                     voice_limit=voice_limit_val,
                     status='completed',
                 )
-            except Exception as log_err:
-                logging.error(f"Log package purchase error: {log_err}")
-
-        payload = {
-            'user_id': user_id,
-            'tariff': normalized_tariff,
-            'amount': amount_value,
-            'package': package_info,
-            'package_code': package_code,
-        }
-        if send_notification and payload:
-            threading.Thread(target=_notify_telegram, args=(payload,), daemon=True).start()
+
+            if send_notification and BOT_TOKEN:
+                # Written in the same transaction, so a message goes out only
+                # for a completion that actually committed, and only once.
+                db.enqueue_notification(
+                    user_id,
+                    build_payment_message({
+                        'tariff': normalized_tariff,
+                        'amount': amount_value,
+                        'package': package_info,
+                        'package_code': package_code,
+                    }),
+                    dedupe_key=f"payment:{merchant_trans_id}",
+                )
+
+        db.tariff_cache.invalidate(user_id)
+        if send_notification:
+            notifier.wake()
     except Exception as err:
         logging.error(f"Payment processing error: {err}")
+        raise
+
+
+def _run_payment_success_job(payload: dict) -> None:
+    _process_payment_success(
+        payload['merchant_trans_id'],
+        payload.get('amount') or 0,
+        update_payment=payload.get('update_payment', True),
+        send_notification=payload.get('send_notification', True),
+    )
+
+
+def _run_promo_release_job(payload: dict) -> None:
+    db.release_promo_reservation(payload['merchant_trans_id'])
+
+
+job_queue = JobQueue(db, **JOB_QUEUE_CONFIG)
+job_queue.register('payment_success', _run_payment_success_job)
+# Queued by async_app.py, whose cancel path does not run the promo release inline.
+job_queue.register('promo_release', _run_promo_release_job)
+job_queue.start()
+
+notifier = TelegramDispatcher(db, BOT_TOKEN, **NOTIFIER_CONFIG)
+notifier.start()
+
+payment_sweeper = PaymentSweeper(db, **PAYMENT_SWEEPER_CONFIG)
+payment_sweeper.start()
+
+tariff_expiry = TariffExpiryScheduler(db, notifier=notifier, send_reminders=bool(BOT_TOKEN), **TARIFF_EXPIRY_CONFIG)
+tariff_expiry.start()
+
+quota = QuotaEngine(db, **QUOTA_CONFIG)
+quota.start()
+
+
+def _rate_limit_rules() -> dict:
+    # IP buckets are larger: mobile carriers put many users behind one address.
+    factor = RATE_LIMIT_CONFIG['ip_factor']
+    rules = {}
+    for name in ('promo', 'checkout'):
+        rate = RATE_LIMIT_CONFIG[f'{name}_per_minute'] / 60
+        burst = RATE_LIMIT_CONFIG[f'{name}_burst']
+        rules[f'{name}_user'] = (rate, burst)
+        rules[f'{name}_ip'] = (rate * factor, burst * factor)
+    return rules
+
+
+rate_limiter = RateLimiter(
+    _rate_limit_rules(),
+    store=RedisBucketStore(RATE_LIMIT_CONFIG['redis_url']) if RATE_LIMIT_CONFIG['redis_url'] else None,
+    enabled=RATE_LIMIT_CONFIG['enabled'],
+)
+
+metrics = Metrics(
+    app,
+    db=db,
+    job_queue=job_queue,
+    notifier=notifier,
+    compression=compression,
+    token=METRICS_TOKEN,
+)
+
+
+@app.before_request
+def _ensure_background_workers():
+    # No-op once started; restarts the threads in a freshly forked worker.
+    job_queue.start()
+    notifier.start()
+    payment_sweeper.start()
+    tariff_expiry.start()
+    quota.start()
+
+
+RATE_LIMIT_MESSAGE = "Juda ko'p urinish. Birozdan so'ng qayta urinib ko'ring"
+
+
+def _client_ip() -> str:
+    # Each trusted proxy appends the address it saw; anything left of those
+    # entries was written by the client and is not trusted.
+    hops = RATE_LIMIT_CONFIG['trusted_proxies']
+    forwarded = [addr.strip() for addr in request.headers.get('X-Forwarded-For', '').split(',') if addr.strip()]
+    if hops > 0 and forwarded:
+        return forwarded[-min(hops, len(forwarded))]
+    return request.remote_addr
+
+
+def _rate_limit_wait(rule: str, user_id=None) -> float:
+    """Seconds the caller must wait before ``rule`` lets it through; 0 if allowed now."""
+    # Both buckets are checked before either is charged, so a request the
+    # IP rule refuses does not use up the user's allowance.
+    return rate_limiter.check((f'{rule}_user', user_id), (f'{rule}_ip', _client_ip()))
+
+
+def _too_many_requests(wait: float, payload: dict):
+    response = jsonify(payload)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
 
 
 @app.route('/')
@@ -232,24 +338,40 @@ def root():
     return redirect('/payment-plus')
 
 
+# Both checkout pages are identical for every user, so they are rendered
+# once per catalog version and served from memory.
+page_cache = PageCache()
+CATALOG_VERSION = hashlib.sha256(
+    json.dumps([PLUS_PACKAGES, PLUS_PACKAGE_SEQUENCE], sort_keys=True).encode('utf-8')
+).hexdigest()[:16]
+
+
+def _plus_package_list() -> list:
+    packages = []
+    for code in PLUS_PACKAGE_SEQUENCE:
+        package = PLUS_PACKAGES.get(code)
+        if not package:
+            continue
+        packages.append({
+            'code': package['code'],
+            'title': package['title'],
+            'tagline': package['tagline'],
+            'text_limit': package['text_limit'],
+            'voice_limit': package['voice_limit'],
+            'price': package['price'],
+            'badge': package.get('badge')
+        })
+    return packages
+
+
 @app.route('/payment-plus', methods=['GET', 'POST'])
 def payment_plus():
     if request.method == 'GET':
-        packages = []
-        for code in PLUS_PACKAGE_SEQUENCE:
-            package = PLUS_PACKAGES.get(code)
-            if not package:
-                continue
-            packages.append({
-                'code': package['code'],
-                'title': package['title'],
-                'tagline': package['tagline'],
-                'text_limit': package['text_limit'],
-                'voice_limit': package['voice_limit'],
-                'price': package['price'],
-                'badge': package.get('badge')
-            })
-        return render_template('payment-plus.html', plus_packages=packages)
+        return page_cache.respond(
+            'payment-plus',
+            CATALOG_VERSION,
+            lambda: render_template('payment-plus.html', plus_packages=_plus_package_list()),
+        )
 
     try:
         user_id_raw = request.form.get('user_id', CLICK_MERCHANT_USER_ID)
@@ -266,6 +388,9 @@ def payment_plus():
         except (TypeError, ValueError):
             logging.error(f"Invalid user_id provided: {user_id_raw}")
             return jsonify({'error': 'Invalid user identifier'}), 400
+        wait = _rate_limit_wait('checkout', user_id)
+        if wait > 0:
+            return _too_many_requests(wait, {'error': RATE_LIMIT_MESSAGE})
 
         package = PLUS_PACKAGES[package_code]
         original_amount = Decimal(str(package['price']))
@@ -296,32 +421,34 @@ def payment_plus():
         merchant_trans_id = f"{user_id}_PLUS_{package_code}_{timestamp}"
 
         try:
-            db.create_payment_record(
-                user_id,
-                merchant_trans_id,
-                amount,
-                'PLUS',
-                payment_method,
-                package_code=package_code,
-                promo_code=promo_code if promo_code else None,
-                discount_percent=discount_percent,
-                discount_amount=discount_amount_int,
-                original_amount=original_amount_int,
-            )
+            # The payment row and the promo reservation commit together; a
+            # code whose limit ran out rolls both back.
+            with db.session(transaction=True):
+                db.create_payment_record(
+                    user_id,
+                    merchant_trans_id,
+                    amount,
+                    'PLUS',
+                    payment_method,
+                    package_code=package_code,
+                    promo_code=promo_code if promo_code else None,
+                    discount_percent=discount_percent,
+                    discount_amount=discount_amount_int,
+                    original_amount=original_amount_int,
+                )
+                if promo_code and not db.reserve_promo_code(
+                    promo_code,
+                    user_id,
+                    merchant_trans_id,
+                    discount_percent,
+                    discount_amount_int,
+                ):
+                    raise ValueError("Promokod qo'llanish limiti tugagan")
+        except ValueError as promo_err:
+            logging.info("Promo reservation failed (%s): %s", promo_code, promo_err)
+            return jsonify({'error': str(promo_err)}), 400
         except Exception as e:
             logging.error(f"Error creating payment record: {e}")
-        else:
-            if promo_code:
-                try:
-                    db.upsert_promo_redemption(
-                        promo_code,
-                        user_id,
-                        merchant_trans_id,
-                        discount_percent,
-                        discount_amount_int,
-                    )
-                except Exception as promo_err:
-                    logging.error(f"Promo redemption reserve error: {promo_err}")
 
         import urllib.parse
         click_url = (
@@ -356,6 +483,14 @@ def validate_promocode_api():
     if not payload:
         payload = request.form.to_dict()
 
+    try:
+        user_id = int(payload.get('user_id'))
+    except (TypeError, ValueError):
+        user_id = None
+    wait = _rate_limit_wait('promo', user_id)
+    if wait > 0:
+        return _too_many_requests(wait, {'success': False, 'message': RATE_LIMIT_MESSAGE})
+
     code_raw = (payload.get('code') or payload.get('promo_code') or '').strip()
     plan_type = (payload.get('plan_type') or payload.get('plan') or 'PLUS').strip()
     amount_raw = payload.get('amount')
@@ -394,10 +529,13 @@ def validate_promocode_api():
 @app.route('/payment-pro', methods=['GET', 'POST'])
 def payment_pro():
     if request.method == 'GET':
-        return render_template('payment-pro.html')
+        return page_cache.respond('payment-pro', CATALOG_VERSION, lambda: render_template('payment-pro.html'))
 
     try:
         user_id = int(request.form.get('user_id', CLICK_MERCHANT_USER_ID))
+        wait = _rate_limit_wait('checkout', user_id)
+        if wait > 0:
+            return _too_many_requests(wait, {'error': RATE_LIMIT_MESSAGE})
         months_raw = request.form.get('months')
         payment_method = (request.form.get('payment_method') or 'click').strip().lower()
 
@@ -436,31 +574,33 @@ def payment_pro():
         merchant_trans_id = f"{user_id}_PRO_{months}_{timestamp}"
 
         try:
-            db.create_payment_record(
-                user_id,
-                merchant_trans_id,
-                amount,
-                'PRO',
-                payment_method,
-                promo_code=promo_code if promo_code else None,
-                discount_percent=discount_percent,
-                discount_amount=discount_amount_int,
-                original_amount=original_amount_int,
-            )
+            # The payment row and the promo reservation commit together; a
+            # code whose limit ran out rolls both back.
+            with db.session(transaction=True):
+                db.create_payment_record(
+                    user_id,
+                    merchant_trans_id,
+                    amount,
+                    'PRO',
+                    payment_method,
+                    promo_code=promo_code if promo_code else None,
+                    discount_percent=discount_percent,
+                    discount_amount=discount_amount_int,
+                    original_amount=original_amount_int,
+                )
+                if promo_code and not db.reserve_promo_code(
+                    promo_code,
+                    user_id,
+                    merchant_trans_id,
+                    discount_percent,
+                    discount_amount_int,
+                ):
+                    raise ValueError("Promokod qo'llanish limiti tugagan")
+        except ValueError as promo_err:
+            logging.info("Promo reservation failed (%s): %s", promo_code, promo_err)
+            return jsonify({'error': str(promo_err)}), 400
         except Exception as e:
             logging.error(f"Error creating payment record (MAX): {e}")
-        else:
-            if promo_code:
-                try:
-                    db.upsert_promo_redemption(
-                        promo_code,
-                        user_id,
-                        merchant_trans_id,
-                        discount_percent,
-                        discount_amount_int,
-                    )
-                except Exception as promo_err:
-                    logging.error(f"Promo redemption reserve error: {promo_err}")
 
         import urllib.parse
         click_url = (
@@ -566,56 +706,66 @@ if not click_logger.handlers:
     handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     click_logger.addHandler(handler)
 
+# Answers already given to Click, keyed by (action, click_trans_id,
+# merchant_trans_id). Click retries callbacks; a retry gets the original
+# response back without redoing any work. The LRU sits in front of the
+# click_callbacks table, which is the source of truth across workers.
+click_responses = TTLCache(maxsize=CLICK_IDEMPOTENCY_CACHE_SIZE, ttl=CLICK_IDEMPOTENCY_CACHE_TTL)
 
-@app.route('/api/click/prepare', methods=['POST'])
-def click_prepare():
-    try:
-        params = request.form.to_dict()
-        click_logger.info(f"PREPARE_REQUEST: {params}")
 
-        required_fields = ['click_trans_id', 'service_id', 'amount', 'action', 'sign_time', 'sign_string']
-        for field in required_fields:
-            if field not in params:
-                return jsonify({'error': -8, 'error_note': f'Missing parameter: {field}'}), 400
+def _stored_click_response(action: str, click_trans_id: str, merchant_trans_id: str):
+    key = (action, click_trans_id, merchant_trans_id)
+    stored = click_responses.get(key)
+    if stored is not None:
+        return stored
+    try:
+        stored = db.get_click_callback_response(action, click_trans_id, merchant_trans_id)
+    except Exception as err:
+        logging.error(f"Click idempotency lookup error: {err}")
+        return None
+    if stored is not None:
+        click_responses.set(key, stored)
+    return stored
 
-        click_trans_id = params['click_trans_id']
-        service_id = params['service_id']
-        amount = params['amount']
-        action = params['action']
-        sign_time = params['sign_time']
-        received_sign = params['sign_string']
-        merchant_trans_id = params.get('merchant_trans_id') or params.get('transaction_param')
 
-        if not merchant_trans_id:
-            return jsonify({'error': -5, 'error_note': 'Merchant transaction not found'}), 400
+def _remember_click_response(action: str, click_trans_id: str, merchant_trans_id: str, response: dict) -> dict:
+    try:
+        if not db.store_click_callback_response(action, click_trans_id, merchant_trans_id, response):
+            # A concurrent duplicate answered first; stay consistent with it.
+            response = db.get_click_callback_response(action, click_trans_id, merchant_trans_id) or response
+    except Exception as err:
+        logging.error(f"Click idempotency store error: {err}")
+    click_responses.set((action, click_trans_id, merchant_trans_id), response)
+    return response
 
-        sign_string = f"{click_trans_id}{service_id}{CLICK_SECRET_KEY}{merchant_trans_id}{amount}{action}{sign_time}"
-        calculated_sign = hashlib.md5(sign_string.encode('utf-8')).hexdigest()
 
-        if calculated_sign != received_sign:
-            return jsonify({'error': -1, 'error_note': 'SIGN CHECK FAILED'}), 400
+@app.route('/api/click/prepare', methods=['POST'])
+def click_prepare():
+    try:
+        params = request.form.to_dict()
+        click_logger.info(f"PREPARE_REQUEST: {params}")
 
         try:
-            if float(amount) <= 0:
-                return jsonify({'error': -2, 'error_note': 'Incorrect parameter amount'}), 400
-        except ValueError:
-            return jsonify({'error': -2, 'error_note': 'Incorrect parameter amount'}), 400
+            merchant_trans_id = click_api.check_prepare(params)
+        except click_api.ClickError as err:
+            return jsonify(err.payload()), err.status
+        click_trans_id = params['click_trans_id']
 
-        if action not in ['0', '1']:
-            return jsonify({'error': -3, 'error_note': 'Action not found'}), 400
+        stored = _stored_click_response('prepare', click_trans_id, merchant_trans_id)
+        if stored is not None:
+            click_logger.info(f"PREPARE_REPLAY: {stored}")
+            return jsonify(stored)
 
         try:
             db.update_payment_prepare(merchant_trans_id, click_trans_id)
-        except Exception:
-            pass
-
-        response = {
-            'error': 0,
-            'error_note': 'Success',
-            'click_trans_id': int(click_trans_id),
-            'merchant_trans_id': merchant_trans_id,
-            'merchant_prepare_id': int(datetime.now().timestamp()),
-        }
+        except Exception as prepare_err:
+            # Not remembered, so Click's retry runs the prepare write again.
+            logging.error(f"Payment prepare update failed for {merchant_trans_id}: {prepare_err}")
+            err = click_api.ClickError(-7, 'Failed to update user', status=500)
+            return jsonify(err.payload()), err.status
+
+        response = click_api.prepare_response(click_trans_id, merchant_trans_id)
+        response = _remember_click_response('prepare', click_trans_id, merchant_trans_id, response)
         click_logger.info(f"PREPARE_RESPONSE: {response}")
         return jsonify(response)
     except Exception as e:
@@ -632,61 +782,48 @@ def click_complete():
         params = request.form.to_dict()
         click_logger.info(f"COMPLETE_REQUEST: {params}")
 
-        required_fields = ['click_trans_id', 'amount', 'action', 'sign_time', 'sign_string', 'error']
-        for field in required_fields:
-            if field not in params:
-                return jsonify({'error': -8, 'error_note': f'Missing parameter: {field}'}), 400
-
+        try:
+            merchant_trans_id = click_api.check_complete(params)
+        except click_api.ClickError as err:
+            return jsonify(err.payload()), err.status
         click_trans_id = params['click_trans_id']
-        merchant_trans_id = params.get('merchant_trans_id') or params.get('transaction_param')
-        amount = params['amount']
-        action = params['action']
-        sign_time = params['sign_time']
-        received_sign = params['sign_string']
-        service_id = params.get('service_id', CLICK_SERVICE_ID)
-        merchant_prepare_id = params.get('merchant_prepare_id', '')
-
-        sign_string = f"{click_trans_id}{service_id}{CLICK_SECRET_KEY}{merchant_trans_id}{merchant_prepare_id}{amount}{action}{sign_time}"
-        calculated_sign = hashlib.md5(sign_string.encode('utf-8')).hexdigest()
-
-        if calculated_sign != received_sign:
-            allow_debug = os.getenv('CLICK_ALLOW_DEBUG_SIGNATURE', 'false').lower() == 'true'
-            if not allow_debug:
-                return jsonify({'error': -1, 'error_note': 'SIGN CHECK FAILED'}), 400
+
+        stored = _stored_click_response('complete', click_trans_id, merchant_trans_id)
+        if stored is not None:
+            click_logger.info(f"COMPLETE_REPLAY: {stored}")
+            return jsonify(stored)
 
         error_code = int(params.get('error', -1))
 
         if error_code != 0:
             db.update_payment_complete(merchant_trans_id, status='failed', error_code=error_code, error_note='Transaction cancelled')
             try:
-                db.update_promo_redemption_status(merchant_trans_id, 'cancelled')
+                db.release_promo_reservation(merchant_trans_id)
             except Exception as promo_err:
                 logging.error(f"Promo redemption cancel error: {promo_err}")
-            response = {
-                'click_trans_id': int(click_trans_id),
-                'merchant_trans_id': merchant_trans_id,
-                'merchant_confirm_id': int(datetime.now().timestamp()),
-                'error': error_code,
-                'error_note': 'Transaction cancelled',
-            }
+            response = click_api.complete_response(click_trans_id, merchant_trans_id, error_code, 'Transaction cancelled')
+            response = _remember_click_response('complete', click_trans_id, merchant_trans_id, response)
             click_logger.info(f"COMPLETE_RESPONSE_FAILED: {response}")
             return jsonify(response)
 
-        amount_value = float(amount) if amount else 0
-        threading.Thread(
-            target=_process_payment_success,
-            args=(merchant_trans_id, amount_value),
-            kwargs={'update_payment': True, 'send_notification': True},
-            daemon=True,
-        ).start()
-
-        response = {
-            'click_trans_id': int(click_trans_id),
-            'merchant_trans_id': merchant_trans_id,
-            'merchant_confirm_id': int(datetime.now().timestamp()),
-            'error': 0,
-            'error_note': 'Success',
-        }
+        job_payload = click_api.payment_success_job(merchant_trans_id, params['amount'])
+        try:
+            job_queue.enqueue('payment_success', job_payload, dedupe_key=merchant_trans_id)
+        except Exception as enqueue_err:
+            # Without a durable job the completion would be lost, so do the
+            # work inline and let Click wait for it.
+            logging.error(f"Payment job enqueue error: {enqueue_err}")
+            try:
+                _run_payment_success_job(job_payload)
+            except Exception as process_err:
+                # Neither queued nor applied: answer with an error that is not
+                # remembered, so Click retries the callback.
+                logging.error(f"Inline payment completion failed for {merchant_trans_id}: {process_err}")
+                err = click_api.ClickError(-7, 'Failed to update user', status=500)
+                return jsonify(err.payload()), err.status
+
+        response = click_api.complete_response(click_trans_id, merchant_trans_id)
+        response = _remember_click_response('complete', click_trans_id, merchant_trans_id, response)
         click_logger.info(f"COMPLETE_RESPONSE: {response}")
 
         return jsonify(response)
@@ -695,50 +832,241 @@ def click_complete():
         return jsonify({'error': -9, 'error_note': 'Transaction not found'}), 500
 
 
+def _load_tariff_payload(user_id: int) -> dict:
+    tariff_info = db.get_user_tariff(user_id)
+    package_info = db.get_user_package_limits(user_id)
+    last_payment = db.get_last_payment(user_id, tariff_info.get('tariff', 'Bepul'))
+    return click_api.build_tariff_payload(tariff_info, package_info, last_payment)
+
+
 @app.route('/api/user/tariff/<int:user_id>')
 def get_user_tariff(user_id):
+    try:
+        data = db.tariff_cache.get_or_load(user_id, lambda: _load_tariff_payload(user_id))
+        return jsonify({'success': True, 'data': data})
+    except Exception as e:
+        logging.error(f"Get user tariff error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+BULK_TARIFF_LIMIT = 1000
+
+
+def _load_tariff_payloads(user_ids) -> dict:
+    rows = db.get_user_tariffs(user_ids)
+    return {user_id: click_api.build_tariff_payload(*rows[user_id]) for user_id in user_ids}
+
+
+@app.route('/api/users/tariffs', methods=['POST'])
+def get_user_tariffs():
+    payload = request.get_json(silent=True) or {}
+    user_ids = payload.get('user_ids')
+    try:
+        user_ids = [int(user_id) for user_id in user_ids] if isinstance(user_ids, list) else None
+    except (TypeError, ValueError):
+        user_ids = None
+    if not user_ids or len(user_ids) > BULK_TARIFF_LIMIT:
+        return jsonify({
+            'success': False,
+            'message': f"user_ids 1 dan {BULK_TARIFF_LIMIT} tagacha butun sonlar ro'yxati bo'lishi kerak",
+        }), 400
+
+    try:
+        # Shares entries with /api/user/tariff/<id>; only misses hit MySQL.
+        data = db.tariff_cache.get_or_load_many(user_ids, _load_tariff_payloads)
+        return jsonify({'success': True, 'data': {str(user_id): value for user_id, value in data.items()}})
+    except Exception as e:
+        logging.error(f"Get user tariffs error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@app.route('/api/user/<int:user_id>/quota/consume', methods=['POST'])
+def consume_quota(user_id):
+    if not quota.enabled:
+        return abort(404)
+    payload = request.get_json(silent=True) or {}
+    kind = payload.get('kind', 'text')
+    try:
+        amount = int(payload.get('amount', 1))
+    except (TypeError, ValueError):
+        amount = 0
+    if kind not in quota.KINDS or amount <= 0:
+        return jsonify({'success': False, 'message': "kind 'text' yoki 'voice', amount musbat son bo'lishi kerak"}), 400
+
+    try:
+        result = quota.consume(user_id, kind, amount)
+    except Exception as e:
+        logging.error(f"Quota consume error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+    if not result['allowed']:
+        return jsonify({'success': False, 'message': 'Paket limiti tugagan', 'data': result}), 403
+    return jsonify({'success': True, 'data': result})
+
+
+HISTORY_PAGE_LIMIT = 100
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def _json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _json_row(row: dict) -> dict:
+    return {key: _json_value(value) for key, value in row.items()}
+
+
+def _encode_history_cursor(moment: datetime, row_id: int) -> str:
+    token = f"{moment.isoformat()}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(token).decode('ascii').rstrip('=')
+
+
+def _decode_history_cursor(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        moment, row_id = raw.split('|')
+        return datetime.fromisoformat(moment), int(row_id)
+    except ValueError:
+        raise ValueError("Noto'g'ri cursor")
+
+
+@app.route('/api/user/<int:user_id>/payments')
+def get_user_payments(user_id):
+    source = request.args.get('source', 'payments')
+    if source not in db.HISTORY_SOURCES:
+        return jsonify({'success': False, 'message': "Noto'g'ri manba"}), 400
+    try:
+        limit = max(1, min(HISTORY_PAGE_LIMIT, int(request.args.get('limit', 20))))
+        cursor = request.args.get('cursor')
+        before = _decode_history_cursor(cursor) if cursor else None
+    except ValueError as err:
+        return jsonify({'success': False, 'message': str(err)}), 400
+
+    try:
+        # One row past the page tells whether there is a next one.
+        rows = db.get_payment_history(user_id, source, limit + 1, before)
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = _encode_history_cursor(last[db.HISTORY_SOURCES[source]['time_column']], last['id'])
+        return jsonify({
+            'success': True,
+            'data': [_json_row(row) for row in rows],
+            'next_cursor': next_cursor,
+        })
+    except Exception as e:
+        logging.error(f"Get user payments error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+def _export_csv(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_json_value(row[column]) for column in columns])
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _export_json(rows):
+    chunk = ['[']
+    size = 1
+    separator = ''
+    for row in rows:
+        item = separator + json.dumps(_json_row(row), ensure_ascii=False)
+        separator = ','
+        chunk.append(item)
+        size += len(item)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def _logged_export(chunks, user_id):
+    try:
+        yield from chunks
+    except Exception as err:
+        # Headers are already sent; dropping the connection is the only way
+        # left to tell the client the file is incomplete.
+        logging.error(f"Payment export error for {user_id}: {err}")
+        raise
+
+
+@app.route('/api/user/<int:user_id>/payments/export')
+def export_user_payments(user_id):
+    source = request.args.get('source', 'payments')
+    export_format = request.args.get('format', 'csv')
+    if source not in db.HISTORY_SOURCES or export_format not in ('csv', 'json'):
+        return jsonify({'success': False, 'message': "Noto'g'ri parametr"}), 400
+
     try:
         tariff_info = db.get_user_tariff(user_id)
-        tariff_code = tariff_info.get('tariff', 'Bepul')
-        expires_at = tariff_info.get('expires_at')
-        limits = TARIFF_LIMITS.get(tariff_code, TARIFF_LIMITS['Plus'])
-        package_info = db.get_user_package_limits(user_id)
-        payload = None
-        if package_info:
-            package_code = (package_info.get('package_code') or '').upper()
-            package_meta = PLUS_PACKAGES.get(package_code)
-            payload = {
-                'code': package_code,
-                'text_limit': package_info.get('text_limit'),
-                'voice_limit': package_info.get('voice_limit'),
-                'text_used': package_info.get('text_used'),
-                'voice_used': package_info.get('voice_used'),
-                'title': package_meta.get('title') if package_meta else None,
-                'tagline': package_meta.get('tagline') if package_meta else None,
-                'price': package_meta.get('price') if package_meta else None,
-                'badge': package_meta.get('badge') if package_meta else None,
-                'updated_at': package_info.get('updated_at').isoformat() if package_info.get('updated_at') else None,
-            }
-        last_payment = db.get_last_payment(user_id, tariff_code)
-        last_payment_payload = None
-        if last_payment:
-            paid_at = last_payment.get('complete_time') or last_payment.get('created_at')
-            last_payment_payload = {
-                'amount': float(last_payment.get('amount') or 0),
-                'paid_at': paid_at.isoformat() if paid_at else None,
-            }
+    except Exception as e:
+        logging.error(f"Payment export tariff error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+    if not click_api.tariff_limits(tariff_info.get('tariff', 'Bepul')).get('export_data'):
+        return jsonify({'success': False, 'message': "Eksport faqat Plus va Max tariflarida mavjud"}), 403
+
+    # Rows are read and written one batch at a time while the response is
+    # sent, so a multi-year history never sits in the worker's memory.
+    rows = db.stream_payment_history(user_id, source)
+    if export_format == 'csv':
+        chunks, mimetype = _export_csv(rows, db.HISTORY_SOURCES[source]['columns']), 'text/csv'
+    else:
+        chunks, mimetype = _export_json(rows), 'application/json'
+    filename = f"{source}_{user_id}_{datetime.now():%Y%m%d}.{export_format}"
+    return Response(
+        _logged_export(chunks, user_id),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Accel-Buffering': 'no',
+        },
+    )
+
+
+def _admin_authorized() -> bool:
+    provided = request.args.get('token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return bool(ADMIN_API_TOKEN) and hmac.compare_digest(provided, ADMIN_API_TOKEN)
+
+
+@app.route('/api/admin/revenue')
+def revenue_report():
+    if not _admin_authorized():
+        return abort(404)
+    try:
+        until = date.fromisoformat(request.args['to']) if request.args.get('to') else date.today()
+        since = date.fromisoformat(request.args['from']) if request.args.get('from') else until - timedelta(days=29)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'from/to must be YYYY-MM-DD'}), 400
+    group_by = [item for item in request.args.get('group_by', 'day').split(',') if item]
+    unknown = set(group_by) - set(db.REVENUE_DIMENSIONS)
+    if unknown:
+        return jsonify({'success': False, 'message': f"Unknown group_by: {', '.join(sorted(unknown))}"}), 400
+    status = request.args.get('status')
+    if status and status not in db.REVENUE_STATUSES:
+        return jsonify({'success': False, 'message': f'Unknown status: {status}'}), 400
+
+    try:
+        rows = db.revenue_summary(since, until, group_by=group_by, status=status)
         return jsonify({
             'success': True,
-            'data': {
-                'tariff': tariff_code,
-                'expires_at': expires_at.isoformat() if expires_at else None,
-                'limits': limits,
-                'package': payload,
-                'last_payment': last_payment_payload,
-            },
+            'from': since.isoformat(),
+            'to': until.isoformat(),
+            'data': [_json_row(row) for row in rows],
         })
     except Exception as e:
-        logging.error(f"Get user tariff error: {e}")
+        logging.error(f"Revenue report error: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
@@ -757,15 +1085,6 @@ def manual_complete_payment():
         tariff_token = parts[1].upper()
         months = 1
         package_code = None
-        promo_code_value = None
-        payment_rec = None
-
-        try:
-            payment_rec = db.get_payment_by_merchant_trans_id(merchant_trans_id)
-            if payment_rec:
-                promo_code_value = (payment_rec.get('promo_code') or '').strip() or None
-        except Exception as err:
-            logging.error(f"Manual complete fetch error: {err}")
 
         if tariff_token == 'PLUS' and len(parts) >= 3:
             third = parts[2]
@@ -778,33 +1097,42 @@ def manual_complete_payment():
 
         normalized_tariff = 'PLUS' if tariff_token == 'PLUS' else tariff_token
 
-        db.update_payment_complete(merchant_trans_id, status='confirmed', error_code=0, error_note='Manually completed')
-        db.activate_tariff(user_id, normalized_tariff, months)
-
-        if package_code and package_code in PLUS_PACKAGES:
-            package = PLUS_PACKAGES[package_code]
-            db.assign_user_package(user_id, package_code, package['text_limit'], package['voice_limit'])
-            amount_value = float(payment_rec.get('amount')) if payment_rec and payment_rec.get('amount') else 0
-            text_limit_val = int(package.get('text_limit')) if package.get('text_limit') is not None else 0
-            voice_limit_val = int(package.get('voice_limit')) if package.get('voice_limit') is not None else 0
-            db.log_package_purchase(
-                user_id,
-                package_code,
-                amount_value,
-                merchant_trans_id,
-                text_limit=text_limit_val,
-                voice_limit=voice_limit_val,
-                status='completed',
-            )
-
-        if promo_code_value:
-            try:
-                db.update_promo_redemption_status(merchant_trans_id, 'completed')
-                db.increment_promo_code_usage(promo_code_value)
-            except Exception as promo_err:
-                logging.error(f"Promo redemption manual complete error: {promo_err}")
-
         display_tariff = 'Max' if normalized_tariff == 'PRO' else normalized_tariff
+        with db.session(transaction=True):
+            # As in _process_payment_success: the row lock serialises repeated
+            # calls, and database errors abort the whole unit of work.
+            payment_rec = db.get_payment_by_merchant_trans_id(merchant_trans_id, for_update=True)
+            if payment_rec and payment_rec.get('status') == 'confirmed':
+                return jsonify({'success': True, 'message': f'Already completed: {display_tariff}', 'merchant_trans_id': merchant_trans_id})
+            promo_code_value = ((payment_rec or {}).get('promo_code') or '').strip() or None
+            db.update_payment_complete(merchant_trans_id, status='confirmed', error_code=0, error_note='Manually completed')
+            db.activate_tariff(user_id, normalized_tariff, months)
+
+            if package_code and package_code in PLUS_PACKAGES:
+                package = PLUS_PACKAGES[package_code]
+                db.assign_user_package(user_id, package_code, package['text_limit'], package['voice_limit'])
+                amount_value = float(payment_rec.get('amount')) if payment_rec and payment_rec.get('amount') else 0
+                text_limit_val = int(package.get('text_limit')) if package.get('text_limit') is not None else 0
+                voice_limit_val = int(package.get('voice_limit')) if package.get('voice_limit') is not None else 0
+                db.log_package_purchase(
+                    user_id,
+                    package_code,
+                    amount_value,
+                    merchant_trans_id,
+                    text_limit=text_limit_val,
+                    voice_limit=voice_limit_val,
+                    status='completed',
+                )
+
+            if promo_code_value:
+                db.complete_promo_reservation(
+                    promo_code_value,
+                    user_id,
+                    merchant_trans_id,
+                    int(payment_rec.get('discount_percent') or 0),
+                    payment_rec.get('discount_amount') or 0,
+                )
+
         return jsonify({'success': True, 'message': f'Tariff activated: {display_tariff}', 'merchant_trans_id': merchant_trans_id})
     except Exception as e:
         logging.error(f"Manual complete error: {e}")
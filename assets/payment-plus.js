@@ -0,0 +1,521 @@
+(function () {
+    const tg = window.Telegram?.WebApp;
+    if (tg) {
+        tg.ready();
+        tg.expand();
+        tg.disableVerticalSwipes();
+    }
+
+    const elements = {
+        packages: Array.from(document.querySelectorAll('.package-card')),
+        purchaseBtn: document.getElementById('purchaseBtn'),
+        infoBanner: document.getElementById('infoBanner'),
+        subscriptionInfo: document.getElementById('subscriptionInfo'),
+        subscriptionStatus: document.getElementById('subscriptionStatus'),
+        subscriptionName: document.getElementById('subscriptionName'),
+        subscriptionExpiry: document.getElementById('subscriptionExpiry'),
+        subscriptionLimits: document.getElementById('subscriptionLimits'),
+        loadingOverlay: document.getElementById('loadingOverlay'),
+        blockedView: document.getElementById('blockedView'),
+        content: document.getElementById('content'),
+        footer: document.getElementById('footer'),
+        blockedCloseBtn: document.getElementById('blockedCloseBtn'),
+        checkoutOverlay: document.getElementById('checkoutOverlay'),
+        checkoutSheet: document.getElementById('checkoutSheet'),
+        checkoutCloseBtn: document.getElementById('checkoutCloseBtn'),
+        checkoutTitle: document.getElementById('checkoutTitle'),
+        checkoutTagline: document.getElementById('checkoutTagline'),
+        checkoutLimits: document.getElementById('checkoutLimits'),
+        checkoutOriginalPrice: document.getElementById('checkoutOriginalPrice'),
+        checkoutDiscountRow: document.getElementById('checkoutDiscountRow'),
+        checkoutDiscountValue: document.getElementById('checkoutDiscountValue'),
+        checkoutFinalPrice: document.getElementById('checkoutFinalPrice'),
+        checkoutPayBtn: document.getElementById('checkoutPayBtn'),
+        promoInput: document.getElementById('promoInput'),
+        promoApplyBtn: document.getElementById('promoApplyBtn'),
+        promoFeedback: document.getElementById('promoFeedback'),
+        promoRemoveBtn: document.getElementById('promoRemoveBtn'),
+        paymentMethodCards: Array.from(document.querySelectorAll('.payment-method-card')),
+    };
+
+    const state = {
+        userId: null,
+        selectedPackage: null,
+        currentPackageCode: null,
+        currentTariff: null,
+        currentPackageMeta: null,
+        currentExpiry: null,
+        appliedPromo: null,
+        paymentMethod: 'click',
+    };
+
+    function haptic(type = 'light') {
+        if (tg?.HapticFeedback?.impactOccurred) {
+            tg.HapticFeedback.impactOccurred(type);
+        }
+    }
+
+    function formatPrice(amount) {
+        const numeric = Number(amount) || 0;
+        return numeric.toString().replace(/\B(?=(\d{3})+(?!\d))/g, ' ');
+    }
+
+    function parsePrice(value) {
+        const parsed = parseInt(value, 10);
+        return Number.isFinite(parsed) ? parsed : 0;
+    }
+
+    function hideLoading() {
+        elements.loadingOverlay.classList.add('hidden');
+        elements.content.style.visibility = 'visible';
+        elements.footer.style.visibility = 'visible';
+    }
+
+    function showBanner(text) {
+        if (!elements.infoBanner) return;
+        elements.infoBanner.textContent = text;
+        elements.infoBanner.classList.add('show');
+    }
+
+    function hideBanner() {
+        if (!elements.infoBanner) return;
+        elements.infoBanner.classList.remove('show');
+    }
+
+    function getBaseAmount() {
+        if (!state.selectedPackage) return 0;
+        return parsePrice(state.selectedPackage.dataset.price);
+    }
+
+    function updateButton() {
+        const btn = elements.purchaseBtn;
+        if (!btn) return;
+        if (!state.selectedPackage) {
+            btn.textContent = 'Paketni tanlang';
+            btn.setAttribute('disabled', 'true');
+            return;
+        }
+        const baseAmount = getBaseAmount();
+        const effectiveAmount = state.appliedPromo ? state.appliedPromo.final_amount : baseAmount;
+        let label = `${formatPrice(effectiveAmount)} so'mga sotib olish`;
+        if (state.selectedPackage.dataset.code === state.currentPackageCode) {
+            label = `${formatPrice(effectiveAmount)} so'mga limitni yangilash`;
+        }
+        btn.textContent = label;
+        btn.removeAttribute('disabled');
+    }
+
+    function markActivePackages() {
+        elements.packages.forEach((card) => {
+            if (card.dataset.code === state.currentPackageCode) {
+                card.classList.add('active');
+            } else {
+                card.classList.remove('active');
+            }
+        });
+    }
+
+    function clearPromo(options = {}) {
+        const keepInput = options.keepInput || false;
+        state.appliedPromo = null;
+        if (!keepInput && elements.promoInput) {
+            elements.promoInput.value = '';
+        }
+        if (elements.promoFeedback) {
+            elements.promoFeedback.textContent = '';
+            elements.promoFeedback.className = 'promo-feedback';
+        }
+        if (elements.promoRemoveBtn) {
+            elements.promoRemoveBtn.style.display = 'none';
+        }
+        if (elements.checkoutDiscountRow) {
+            elements.checkoutDiscountRow.style.display = 'none';
+        }
+        renderCheckoutSummary();
+        updateButton();
+    }
+
+    function selectPackage(card, options = {}) {
+        if (!card) return;
+        const allowReselect = options.allowReselect || false;
+        const skipPromoReset = options.skipPromoReset || false;
+        const silent = options.silent || false;
+        const skipBanner = options.skipBanner || false;
+        if (!allowReselect && card === state.selectedPackage) {
+            return;
+        }
+        elements.packages.forEach(pkg => pkg.classList.remove('selected'));
+        card.classList.add('selected');
+        state.selectedPackage = card;
+        if (!skipBanner) {
+            hideBanner();
+            if (card.dataset.code === state.currentPackageCode) {
+                showBanner('Bu paket sizda allaqachon faol. Sotib olsangiz limitlar yangilanadi.');
+            }
+        }
+        if (!skipPromoReset) {
+            clearPromo();
+        } else {
+            renderCheckoutSummary();
+            updateButton();
+        }
+        if (!silent) {
+            haptic();
+        }
+    }
+
+    function renderCheckoutSummary() {
+        if (!state.selectedPackage) return;
+        const titleEl = state.selectedPackage.querySelector('.package-title');
+        const taglineEl = state.selectedPackage.querySelector('.package-tagline');
+        const baseAmount = getBaseAmount();
+        const discountAmount = state.appliedPromo ? state.appliedPromo.discount_amount : 0;
+        const finalAmount = state.appliedPromo ? state.appliedPromo.final_amount : baseAmount;
+
+        if (elements.checkoutTitle) {
+            elements.checkoutTitle.textContent = titleEl ? titleEl.textContent : 'Plus paket';
+        }
+        if (elements.checkoutTagline) {
+            elements.checkoutTagline.textContent = taglineEl ? taglineEl.textContent : '';
+        }
+        if (elements.checkoutLimits) {
+            const textLimitRaw = state.selectedPackage.dataset.text;
+            const voiceLimitRaw = state.selectedPackage.dataset.voice;
+            const formatLimit = (value) => {
+                if (value === undefined || value === null || value === '') return '-';
+                return value === '-1' ? 'Cheksiz' : value;
+            };
+            const textLimit = formatLimit(textLimitRaw);
+            const voiceLimit = formatLimit(voiceLimitRaw);
+            elements.checkoutLimits.innerHTML = `
+                <span>Matn limiti: <strong>${textLimit}</strong></span>
+                <span>Ovoz limiti: <strong>${voiceLimit}</strong></span>
+            `;
+        }
+        if (elements.checkoutOriginalPrice) {
+            elements.checkoutOriginalPrice.textContent = `${formatPrice(baseAmount)} so'm`;
+        }
+        if (elements.checkoutDiscountRow) {
+            if (discountAmount > 0) {
+                elements.checkoutDiscountRow.style.display = 'flex';
+                if (elements.checkoutDiscountValue) {
+                    elements.checkoutDiscountValue.textContent = `- ${formatPrice(discountAmount)} so'm`;
+                }
+            } else {
+                elements.checkoutDiscountRow.style.display = 'none';
+            }
+        }
+        if (elements.checkoutFinalPrice) {
+            elements.checkoutFinalPrice.textContent = `${formatPrice(finalAmount)} so'm`;
+        }
+        if (elements.checkoutPayBtn) {
+            elements.checkoutPayBtn.textContent = `${formatPrice(finalAmount)} so'mga to'lash`;
+        }
+    }
+
+    function openCheckoutSheet() {
+        if (!state.selectedPackage) return;
+        haptic('medium');
+        renderCheckoutSummary();
+        elements.checkoutOverlay?.classList.add('active');
+        elements.checkoutSheet?.classList.add('active');
+    }
+
+    function closeCheckoutSheet() {
+        elements.checkoutOverlay?.classList.remove('active');
+        elements.checkoutSheet?.classList.remove('active');
+    }
+
+    function showPromoFeedback(message, isError) {
+        if (!elements.promoFeedback) return;
+        elements.promoFeedback.textContent = message;
+        elements.promoFeedback.className = 'promo-feedback';
+        if (message) {
+            elements.promoFeedback.classList.add(isError ? 'error' : 'success');
+        }
+    }
+
+    async function applyPromo() {
+        if (!state.selectedPackage || !elements.promoInput || !elements.promoApplyBtn) return;
+        const code = elements.promoInput.value.trim();
+        if (!code) {
+            showPromoFeedback('Iltimos, promokodni kiriting.', true);
+            haptic();
+            return;
+        }
+        const baseAmount = getBaseAmount();
+        if (!baseAmount) {
+            showPromoFeedback('Paket narxi aniqlanmadi.', true);
+            return;
+        }
+
+        elements.promoApplyBtn.disabled = true;
+        elements.promoApplyBtn.textContent = 'Tekshirilmoqda...';
+        showPromoFeedback('', false);
+
+        try {
+            const response = await fetch('/api/promocode/validate', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    code,
+                    plan_type: 'PLUS',
+                    amount: baseAmount,
+                    user_id: state.userId,
+                }),
+            });
+            const json = await response.json();
+            if (!response.ok || !json?.success) {
+                throw new Error(json?.message || 'Promokod topilmadi.');
+            }
+            const data = json.data || {};
+            state.appliedPromo = {
+                code: data.code,
+                discount_percent: data.discount_percent,
+                discount_amount: data.discount_amount,
+                final_amount: data.final_amount,
+            };
+            if (elements.promoRemoveBtn) {
+                elements.promoRemoveBtn.style.display = 'inline-flex';
+            }
+            showPromoFeedback(`${state.appliedPromo.discount_percent}% chegirma qo'llandi.`, false);
+            renderCheckoutSummary();
+            updateButton();
+            haptic('medium');
+        } catch (err) {
+            state.appliedPromo = null;
+            showPromoFeedback(err.message || 'Promokodni qo\'llab bo\'lmadi.', true);
+            if (elements.promoRemoveBtn) {
+                elements.promoRemoveBtn.style.display = 'none';
+            }
+            renderCheckoutSummary();
+            updateButton();
+        } finally {
+            elements.promoApplyBtn.disabled = false;
+            elements.promoApplyBtn.textContent = "Qo'llash";
+        }
+    }
+
+    function removePromo() {
+        clearPromo({ keepInput: true });
+        if (elements.promoInput) {
+            elements.promoInput.focus();
+        }
+        haptic();
+    }
+
+    function selectPaymentMethod(card) {
+        if (!card) return;
+        const method = card.dataset.method || 'click';
+        const available = card.dataset.available !== 'false';
+        if (!available) {
+            if (tg?.showAlert) {
+                tg.showAlert('Bu to\'lov usuli tez orada ishga tushadi.');
+            } else {
+                alert('Bu to\'lov usuli tez orada ishga tushadi.');
+            }
+            return;
+        }
+        state.paymentMethod = method;
+        elements.paymentMethodCards.forEach(item => {
+            item.classList.toggle('active', item === card);
+        });
+        haptic();
+    }
+
+    function createHiddenInput(name, value) {
+        const input = document.createElement('input');
+        input.type = 'hidden';
+        input.name = name;
+        input.value = value;
+        return input;
+    }
+
+    function submitPayment() {
+        if (!state.selectedPackage || !state.userId) return;
+        if (state.paymentMethod !== 'click') {
+            if (tg?.showAlert) {
+                tg.showAlert('Bu to\'lov usuli tez orada ishga tushadi.');
+            } else {
+                alert('Bu to\'lov usuli tez orada ishga tushadi.');
+            }
+            return;
+        }
+        try {
+            haptic('medium');
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = '/payment-plus';
+            form.appendChild(createHiddenInput('user_id', state.userId));
+            form.appendChild(createHiddenInput('package_code', state.selectedPackage.dataset.code));
+            form.appendChild(createHiddenInput('payment_method', state.paymentMethod));
+            if (state.appliedPromo?.code) {
+                form.appendChild(createHiddenInput('promo_code', state.appliedPromo.code));
+            }
+            document.body.appendChild(form);
+            form.submit();
+        } catch (err) {
+            console.error('Checkout error:', err);
+            if (tg?.showAlert) {
+                tg.showAlert('To\'lovni boshlashda xatolik yuz berdi.');
+            } else {
+                alert('To\'lovni boshlashda xatolik yuz berdi.');
+            }
+        }
+    }
+
+    elements.packages.forEach(card => {
+        card.addEventListener('click', () => selectPackage(card));
+    });
+
+    elements.purchaseBtn?.addEventListener('click', () => {
+        if (!state.selectedPackage) return;
+        if (!state.userId) {
+            if (tg?.showAlert) {
+                tg.showAlert('Telegram foydalanuvchisini aniqlab bo\'lmadi.');
+            } else {
+                alert('Telegram foydalanuvchisini aniqlab bo\'lmadi.');
+            }
+            return;
+        }
+        openCheckoutSheet();
+    });
+
+    elements.checkoutOverlay?.addEventListener('click', closeCheckoutSheet);
+    elements.checkoutCloseBtn?.addEventListener('click', closeCheckoutSheet);
+    elements.checkoutPayBtn?.addEventListener('click', submitPayment);
+    elements.promoApplyBtn?.addEventListener('click', applyPromo);
+    elements.promoRemoveBtn?.addEventListener('click', removePromo);
+
+    elements.paymentMethodCards.forEach(card => {
+        card.addEventListener('click', () => selectPaymentMethod(card));
+    });
+
+    if (elements.blockedCloseBtn) {
+        elements.blockedCloseBtn.addEventListener('click', () => {
+            if (tg) {
+                tg.close();
+            } else {
+                window.close();
+            }
+        });
+    }
+
+    async function resolveUserId() {
+        if (tg?.initDataUnsafe?.user?.id) {
+            return tg.initDataUnsafe.user.id;
+        }
+        if (tg?.initData) {
+            try {
+                const params = new URLSearchParams(tg.initData);
+                const userStr = params.get('user');
+                if (userStr) {
+                    const parsed = JSON.parse(decodeURIComponent(userStr));
+                    if (parsed?.id) return parsed.id;
+                }
+            } catch (err) {
+                console.error('initData parse error:', err);
+            }
+        }
+        return null;
+    }
+
+    function showBlockedView(tariffCode) {
+        if (!elements.blockedView) return;
+        elements.content.style.display = 'none';
+        elements.footer.style.display = 'none';
+        elements.blockedView.style.display = 'flex';
+        const title = elements.blockedView.querySelector('h2');
+        const text = elements.blockedView.querySelector('p');
+        if (!title || !text) return;
+        if (tariffCode === 'PRO' || tariffCode === 'MAX') {
+            title.textContent = 'Max obuna allaqachon faol';
+            text.textContent = 'Sizda eng yuqori tarif ishga tushgan. Qo\'shimcha paket sotib olish mavjud imkoniyatlarni o\'zgartirmaydi.';
+        }
+    }
+
+    function renderSubscriptionInfo() {
+        if (!elements.subscriptionInfo) return;
+        elements.subscriptionInfo.classList.add('show');
+        elements.subscriptionStatus.textContent = 'Faol paket';
+        const title = state.currentPackageMeta?.title || 'Plus';
+        elements.subscriptionName.textContent = title;
+        const textLimit = state.currentPackageMeta?.text_limit;
+        const voiceLimit = state.currentPackageMeta?.voice_limit;
+        if (textLimit && voiceLimit) {
+            elements.subscriptionLimits.textContent = `${textLimit} ta matn / ${voiceLimit} ta ovoz`;
+        } else {
+            elements.subscriptionLimits.textContent = 'Limitlar mavjud';
+        }
+        if (state.currentExpiry) {
+            try {
+                const date = new Date(state.currentExpiry);
+                elements.subscriptionExpiry.textContent = date.toLocaleDateString('uz-UZ', {
+                    year: 'numeric',
+                    month: 'long',
+                    day: 'numeric'
+                });
+            } catch (_) {
+                elements.subscriptionExpiry.textContent = state.currentExpiry;
+            }
+        } else {
+            elements.subscriptionExpiry.textContent = 'Avtomatik yangilanadi';
+        }
+        showBanner('Faol paket maʼlumotlari yangilandi.');
+    }
+
+    async function loadTariff() {
+        try {
+            const response = await fetch(`/api/user/tariff/${state.userId}`);
+            if (!response.ok) return true;
+            const json = await response.json();
+            state.currentTariff = (json?.data?.tariff || 'Bepul').toString().toUpperCase();
+            state.currentPackageCode = (json?.data?.package?.code || '').toString().toUpperCase();
+            state.currentPackageMeta = json?.data?.package || null;
+            state.currentExpiry = json?.data?.expires_at || null;
+            if (elements.subscriptionInfo) {
+                elements.subscriptionInfo.classList.remove('show');
+            }
+            if (state.currentTariff === 'PRO' || state.currentTariff === 'MAX') {
+                showBlockedView(state.currentTariff);
+                return false;
+            }
+            if (state.currentTariff === 'PLUS') {
+                renderSubscriptionInfo();
+            }
+            markActivePackages();
+            if (state.currentPackageCode) {
+                const activeCard = elements.packages.find(card => card.dataset.code === state.currentPackageCode);
+                if (activeCard) {
+                    selectPackage(activeCard, { silent: true, skipPromoReset: true });
+                }
+            }
+            return true;
+        } catch (err) {
+            console.error('Tariff load error:', err);
+            return true;
+        }
+    }
+
+    async function init() {
+        state.userId = await resolveUserId();
+        if (!state.userId) {
+            hideLoading();
+            if (tg?.showAlert) {
+                tg.showAlert('Telegram foydalanuvchisini aniqlab bo\'lmadi. Iltimos, mini ilovani Telegram orqali oching.');
+            }
+            return;
+        }
+        const proceed = await loadTariff();
+        hideLoading();
+        if (proceed === false) {
+            return;
+        }
+        if (!state.selectedPackage && elements.packages.length) {
+            selectPackage(elements.packages[0], { silent: true });
+        }
+        updateButton();
+    }
+
+    init();
+})();
@@ -0,0 +1,347 @@
+        const tg = window.Telegram?.WebApp;
+        if (tg) {
+            tg.ready();
+            tg.expand();
+            tg.disableVerticalSwipes();
+        }
+
+        const loadingOverlay = document.getElementById('loadingOverlay');
+        const mainView = document.getElementById('mainView');
+        const subscriptionSummary = document.getElementById('subscriptionSummary');
+        const summaryPurchasedAt = document.getElementById('summaryPurchasedAt');
+        const summaryExpiry = document.getElementById('summaryExpiry');
+        const summaryRemaining = document.getElementById('summaryRemaining');
+        const summaryAmount = document.getElementById('summaryAmount');
+        const subscriptionBenefits = document.getElementById('subscriptionBenefits');
+        const openSheetBtn = document.getElementById('openSheetBtn');
+        const payBtn = document.getElementById('payBtn');
+        const bottomSheetOverlay = document.getElementById('bottomSheetOverlay');
+        const bottomSheet = document.getElementById('bottomSheet');
+        const sheetClose = bottomSheet.querySelector('.sheet-close');
+        const featuresList = document.getElementById('featuresList');
+const promoInput = document.getElementById('promoInput');
+const promoApplyBtn = document.getElementById('promoApplyBtn');
+const promoFeedback = document.getElementById('promoFeedback');
+const promoRemoveBtn = document.getElementById('promoRemoveBtn');
+const summaryOriginalPrice = document.getElementById('summaryOriginalPrice');
+const summaryFinalPrice = document.getElementById('summaryFinalPrice');
+const promoDiscountRow = document.getElementById('promoDiscountRow');
+const promoDiscountValue = document.getElementById('promoDiscountValue');
+
+        let currentDuration = 1;
+        let userId = null;
+        let currentTariff = 'Bepul';
+        let currentExpiry = null;
+        let lastPayment = null;
+let appliedPromo = null;
+const monthlyPrice = 49990;
+const durationPrices = {
+    1: monthlyPrice,
+    12: Math.round(monthlyPrice * 12 * 0.9),
+};
+
+        function hideLoading() {
+            loadingOverlay.style.display = 'none';
+            mainView.style.visibility = 'visible';
+        }
+
+        function formatDate(isoString) {
+            if (!isoString) return 'Avtomatik yangilanadi';
+            try {
+                const date = new Date(isoString);
+                return date.toLocaleDateString('uz-UZ', { year: 'numeric', month: 'long', day: 'numeric' });
+            } catch (e) {
+                return isoString;
+            }
+        }
+
+        function openBottomSheet() {
+            hapticFeedback();
+    updateSummary();
+            if (bottomSheetOverlay) bottomSheetOverlay.classList.add('active');
+            if (bottomSheet) bottomSheet.classList.add('active');
+        }
+
+        function closeBottomSheet() {
+            hapticFeedback();
+            if (bottomSheetOverlay) bottomSheetOverlay.classList.remove('active');
+            if (bottomSheet) bottomSheet.classList.remove('active');
+        }
+
+        function hapticFeedback() {
+            if (tg?.HapticFeedback) tg.HapticFeedback.impactOccurred('light');
+        }
+
+function formatPriceValue(amount) {
+    const numeric = Number(amount) || 0;
+    return numeric.toString().replace(/\B(?=(\d{3})+(?!\d))/g, ' ');
+}
+
+function getBasePrice(months = currentDuration) {
+    return durationPrices[months] || durationPrices[1];
+}
+
+function updateDurationLabels() {
+    const price1El = document.getElementById('price1Month');
+    const price12El = document.getElementById('price12Month');
+    if (price1El) {
+        price1El.textContent = `${formatPriceValue(durationPrices[1])} so'm`;
+    }
+    if (price12El) {
+        price12El.textContent = `${formatPriceValue(durationPrices[12])} so'm`;
+    }
+}
+
+function showPromoFeedback(message, isError) {
+    if (!promoFeedback) return;
+    promoFeedback.textContent = message;
+    promoFeedback.className = 'promo-feedback';
+    if (message) {
+        promoFeedback.classList.add(isError ? 'error' : 'success');
+    }
+}
+
+function clearPromo(options = {}) {
+    const keepInput = options.keepInput || false;
+    appliedPromo = null;
+    if (!keepInput && promoInput) {
+        promoInput.value = '';
+    }
+    if (promoRemoveBtn) {
+        promoRemoveBtn.style.display = 'none';
+    }
+    showPromoFeedback('', false);
+    if (promoDiscountRow) {
+        promoDiscountRow.style.display = 'none';
+    }
+    updateSummary();
+}
+
+function updateSummary() {
+    const basePrice = getBasePrice();
+    const finalPrice = appliedPromo ? appliedPromo.final_amount : basePrice;
+    const discountAmount = appliedPromo ? appliedPromo.discount_amount : 0;
+    if (summaryOriginalPrice) {
+        summaryOriginalPrice.textContent = `${formatPriceValue(basePrice)} so'm`;
+    }
+    if (promoDiscountRow) {
+        if (discountAmount > 0) {
+            promoDiscountRow.style.display = 'flex';
+            if (promoDiscountValue) {
+                promoDiscountValue.textContent = `- ${formatPriceValue(discountAmount)} so'm`;
+            }
+        } else {
+            promoDiscountRow.style.display = 'none';
+        }
+    }
+    if (summaryFinalPrice) {
+        summaryFinalPrice.textContent = `${formatPriceValue(finalPrice)} so'm`;
+    }
+    const actionBtnText = document.getElementById('actionBtnText');
+    if (actionBtnText) {
+        actionBtnText.textContent = `${formatPriceValue(finalPrice)} so'm evaziga yangilanish`;
+    }
+    if (payBtn) {
+        payBtn.textContent = `${formatPriceValue(finalPrice)} so'mga to'lash`;
+    }
+}
+
+        function selectDuration(months, element) {
+            hapticFeedback();
+            currentDuration = months;
+            document.querySelectorAll('.duration-card').forEach(c => c.classList.remove('selected'));
+            element.classList.add('selected');
+    clearPromo({ keepInput: true });
+    updateActionButton();
+        }
+
+        function updateActionButton() {
+    updateDurationLabels();
+    updateSummary();
+        }
+
+async function applyPromo() {
+    if (!promoInput || !promoApplyBtn) return;
+    const code = promoInput.value.trim();
+    if (!code) {
+        showPromoFeedback('Iltimos, promokodni kiriting.', true);
+        hapticFeedback();
+        return;
+    }
+    const basePrice = getBasePrice();
+    promoApplyBtn.disabled = true;
+    promoApplyBtn.textContent = 'Tekshirilmoqda...';
+    showPromoFeedback('', false);
+    try {
+        const response = await fetch('/api/promocode/validate', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                code,
+                plan_type: 'PRO',
+                amount: basePrice,
+                user_id: userId,
+            }),
+        });
+        const json = await response.json();
+        if (!response.ok || !json?.success) {
+            throw new Error(json?.message || 'Promokod topilmadi.');
+        }
+        const data = json.data || {};
+        appliedPromo = {
+            code: data.code,
+            discount_percent: data.discount_percent,
+            discount_amount: data.discount_amount,
+            final_amount: data.final_amount,
+        };
+        if (promoRemoveBtn) {
+            promoRemoveBtn.style.display = 'inline-flex';
+        }
+        showPromoFeedback(`${appliedPromo.discount_percent}% chegirma qo'llandi.`, false);
+        updateSummary();
+        hapticFeedback();
+    } catch (err) {
+        appliedPromo = null;
+        showPromoFeedback(err.message || 'Promokodni qo\'llab bo\'lmadi.', true);
+        if (promoRemoveBtn) {
+            promoRemoveBtn.style.display = 'none';
+        }
+        updateSummary();
+    } finally {
+        promoApplyBtn.disabled = false;
+        promoApplyBtn.textContent = "Qo'llash";
+    }
+}
+
+function removePromo() {
+    clearPromo({ keepInput: true });
+    if (promoInput) {
+        promoInput.focus();
+    }
+    hapticFeedback();
+}
+
+        async function resolveUserId() {
+            if (tg?.initDataUnsafe?.user?.id) return tg.initDataUnsafe.user.id;
+            if (tg?.initData) {
+                try {
+                    const params = new URLSearchParams(tg.initData);
+                    const userStr = params.get('user');
+                    if (userStr) {
+                        const parsed = JSON.parse(decodeURIComponent(userStr));
+                        if (parsed?.id) return parsed.id;
+                    }
+                } catch (e) {
+                    console.error('initData parse error:', e);
+                }
+            }
+            return null;
+        }
+
+        function renderSubscription() {
+            const isActive = currentTariff === 'PRO' || currentTariff === 'MAX';
+            if (isActive) {
+                const paidDisplay = lastPayment?.paid_at ? formatDate(lastPayment.paid_at) : '—';
+                const amountDisplay = lastPayment?.amount ? `${lastPayment.amount.toLocaleString('uz-UZ')} so'm` : '—';
+                const expiryDisplay = formatDate(currentExpiry);
+                let remainingDays = '—';
+                if (currentExpiry) {
+                    try {
+                        const diffMs = new Date(currentExpiry) - new Date();
+                        if (!Number.isNaN(diffMs)) {
+                            const days = Math.max(0, Math.ceil(diffMs / (1000 * 60 * 60 * 24)));
+                            remainingDays = `${days} kun`;
+                        }
+                    } catch (_) {}
+                }
+                summaryPurchasedAt.textContent = paidDisplay;
+                summaryExpiry.textContent = expiryDisplay;
+                summaryRemaining.textContent = remainingDays;
+                summaryAmount.textContent = amountDisplay;
+                subscriptionSummary.style.display = 'flex';
+                subscriptionBenefits.style.display = 'flex';
+                if (featuresList) featuresList.style.display = 'none';
+                if (openSheetBtn) openSheetBtn.style.display = 'none';
+                if (payBtn) payBtn.style.display = 'none';
+                closeBottomSheet();
+            } else {
+                subscriptionSummary.style.display = 'none';
+                subscriptionBenefits.style.display = 'none';
+                if (featuresList) featuresList.style.display = 'flex';
+                if (openSheetBtn) openSheetBtn.style.display = 'block';
+                if (payBtn) payBtn.style.display = 'block';
+            }
+        }
+
+        async function loadTariff() {
+            try {
+                const response = await fetch(`/api/user/tariff/${userId}`);
+                if (!response.ok) return;
+                const json = await response.json();
+                currentTariff = (json?.data?.tariff || 'Bepul').toString().toUpperCase();
+                currentExpiry = json?.data?.expires_at || null;
+                lastPayment = json?.data?.last_payment || null;
+                renderSubscription();
+            } catch (e) {
+                console.error('Tariff load error:', e);
+            }
+        }
+
+        async function processPayment() {
+            hapticFeedback();
+            if (!userId) {
+                if (tg) tg.showAlert('❌ User ID topilmadi');
+                else alert('❌ User ID topilmadi');
+                return;
+            }
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = '/payment-pro';
+            form.appendChild(createHiddenInput('user_id', userId));
+            form.appendChild(createHiddenInput('months', currentDuration.toString()));
+    form.appendChild(createHiddenInput('payment_method', 'click'));
+    if (appliedPromo?.code) {
+        form.appendChild(createHiddenInput('promo_code', appliedPromo.code));
+    }
+            document.body.appendChild(form);
+            form.submit();
+        }
+
+        function createHiddenInput(name, value) {
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = name;
+            input.value = value;
+            return input;
+        }
+
+        async function init() {
+            updateActionButton();
+            userId = await resolveUserId();
+            if (!userId) {
+                hideLoading();
+                if (tg?.showAlert) {
+                    tg.showAlert('Telegram foydalanuvchisini aniqlashning imkoni bo\'lmadi.');
+                }
+                return;
+            }
+            await loadTariff();
+            hideLoading();
+        }
+
+        if (openSheetBtn) openSheetBtn.addEventListener('click', openBottomSheet);
+        if (bottomSheetOverlay) bottomSheetOverlay.addEventListener('click', closeBottomSheet);
+        if (sheetClose) sheetClose.addEventListener('click', closeBottomSheet);
+        if (payBtn) payBtn.addEventListener('click', processPayment);
+if (promoApplyBtn) promoApplyBtn.addEventListener('click', applyPromo);
+if (promoRemoveBtn) promoRemoveBtn.addEventListener('click', removePromo);
+if (promoInput) {
+    promoInput.addEventListener('keydown', (event) => {
+        if (event.key === 'Enter') {
+            event.preventDefault();
+            applyPromo();
+        }
+    });
+}
+
+        init();
@@ -0,0 +1,228 @@
+"""asyncio entry point for the Click callbacks and the tariff API.
+
+Serves ``/api/click/prepare``, ``/api/click/complete`` and
+``/api/user/tariff/<id>`` on an aiohttp event loop, so callback bursts wait
+on MySQL (aiomysql) and Telegram (aiohttp) without holding a thread each.
+Every other route stays on the Flask app; send just these paths here at the
+proxy::
+
+    gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker --bind 0.0.0.0:$PORT
+
+Request checks and signing come from ``click_api``, replayed callbacks are
+answered from the same ``click_callbacks`` table, and completions go through
+the same ``payment_jobs`` queue. The schema bootstrap and the job worker
+threads are those of ``app.py``, imported below.
+"""
+import asyncio
+import json
+import logging
+import os
+from functools import partial
+
+from aiohttp import web
+
+import app as wsgi
+import click_api
+from async_db import AsyncDatabase
+from config import BOT_TOKEN, NOTIFIER_CONFIG
+from notifier import AsyncTelegramDispatcher
+
+click_logger = wsgi.click_logger
+adb = AsyncDatabase()
+
+# Payment jobs wake ``app.notifier`` after committing a message; in this
+# process that has to be the dispatcher running on the event loop.
+notifier = AsyncTelegramDispatcher(wsgi.db, BOT_TOKEN, **NOTIFIER_CONFIG)
+wsgi.notifier.shutdown()
+wsgi.notifier = notifier
+wsgi.tariff_expiry.notifier = notifier
+
+# Same encoding as Flask's jsonify, so both entry points answer identically.
+_dumps = partial(json.dumps, sort_keys=True, separators=(',', ':'))
+
+
+def _json(data, status=200) -> web.Response:
+    return web.json_response(data, status=status, dumps=_dumps)
+
+
+async def _form(request) -> dict:
+    form = await request.post()
+    return {key: form.get(key) for key in form.keys()}
+
+
+async def _stored_click_response(action: str, click_trans_id: str, merchant_trans_id: str):
+    key = (action, click_trans_id, merchant_trans_id)
+    stored = wsgi.click_responses.get(key)
+    if stored is not None:
+        return stored
+    try:
+        stored = await adb.get_click_callback_response(action, click_trans_id, merchant_trans_id)
+    except Exception as err:
+        logging.error(f"Click idempotency lookup error: {err}")
+        return None
+    if stored is not None:
+        wsgi.click_responses.set(key, stored)
+    return stored
+
+
+async def _remember_click_response(action: str, click_trans_id: str, merchant_trans_id: str, response: dict) -> dict:
+    try:
+        if not await adb.store_click_callback_response(action, click_trans_id, merchant_trans_id, response):
+            # A concurrent duplicate answered first; stay consistent with it.
+            response = await adb.get_click_callback_response(action, click_trans_id, merchant_trans_id) or response
+    except Exception as err:
+        logging.error(f"Click idempotency store error: {err}")
+    wsgi.click_responses.set((action, click_trans_id, merchant_trans_id), response)
+    return response
+
+
+async def _enqueue_job(kind: str, payload: dict, dedupe_key: str) -> None:
+    await adb.enqueue_job(kind, dedupe_key, payload, max_attempts=wsgi.job_queue.max_attempts)
+    wsgi.job_queue.wake()
+
+
+async def click_prepare(request):
+    try:
+        params = await _form(request)
+        click_logger.info(f"PREPARE_REQUEST: {params}")
+
+        try:
+            merchant_trans_id = click_api.check_prepare(params)
+        except click_api.ClickError as err:
+            return _json(err.payload(), err.status)
+        click_trans_id = params['click_trans_id']
+
+        stored = await _stored_click_response('prepare', click_trans_id, merchant_trans_id)
+        if stored is not None:
+            click_logger.info(f"PREPARE_REPLAY: {stored}")
+            return _json(stored)
+
+        try:
+            await adb.update_payment_prepare(merchant_trans_id, click_trans_id)
+        except Exception as prepare_err:
+            # Not remembered, so Click's retry runs the prepare write again.
+            logging.error(f"Payment prepare update failed for {merchant_trans_id}: {prepare_err}")
+            err = click_api.ClickError(-7, 'Failed to update user', status=500)
+            return _json(err.payload(), err.status)
+
+        response = click_api.prepare_response(click_trans_id, merchant_trans_id)
+        response = await _remember_click_response('prepare', click_trans_id, merchant_trans_id, response)
+        click_logger.info(f"PREPARE_RESPONSE: {response}")
+        return _json(response)
+    except Exception as e:
+        logging.error(f"Click Prepare error: {e}")
+        return _json({'error': -9, 'error_note': 'Transaction not found'}, 500)
+
+
+async def click_complete(request):
+    if request.method == 'GET':
+        return _json({'status': 'ok', 'message': 'Complete endpoint ready'})
+
+    try:
+        params = await _form(request)
+        click_logger.info(f"COMPLETE_REQUEST: {params}")
+
+        try:
+            merchant_trans_id = click_api.check_complete(params)
+        except click_api.ClickError as err:
+            return _json(err.payload(), err.status)
+        click_trans_id = params['click_trans_id']
+
+        stored = await _stored_click_response('complete', click_trans_id, merchant_trans_id)
+        if stored is not None:
+            click_logger.info(f"COMPLETE_REPLAY: {stored}")
+            return _json(stored)
+
+        error_code = int(params.get('error', -1))
+
+        if error_code != 0:
+            await adb.update_payment_complete(merchant_trans_id, status='failed', error_code=error_code, error_note='Transaction cancelled')
+            try:
+                # The release spans several statements in one transaction,
+                # which is the synchronous Database's job.
+                await _enqueue_job('promo_release', {'merchant_trans_id': merchant_trans_id}, merchant_trans_id)
+            except Exception as promo_err:
+                logging.error(f"Promo redemption cancel error: {promo_err}")
+            response = click_api.complete_response(click_trans_id, merchant_trans_id, error_code, 'Transaction cancelled')
+            response = await _remember_click_response('complete', click_trans_id, merchant_trans_id, response)
+            click_logger.info(f"COMPLETE_RESPONSE_FAILED: {response}")
+            return _json(response)
+
+        job_payload = click_api.payment_success_job(merchant_trans_id, params['amount'])
+        try:
+            await _enqueue_job('payment_success', job_payload, merchant_trans_id)
+        except Exception as enqueue_err:
+            # Without a durable job the completion would be lost, so do the
+            # work inline (off the loop) and let Click wait for it.
+            logging.error(f"Payment job enqueue error: {enqueue_err}")
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, wsgi._run_payment_success_job, job_payload)
+            except Exception as process_err:
+                # Neither queued nor applied: answer with an error that is not
+                # remembered, so Click retries the callback.
+                logging.error(f"Inline payment completion failed for {merchant_trans_id}: {process_err}")
+                err = click_api.ClickError(-7, 'Failed to update user', status=500)
+                return _json(err.payload(), err.status)
+
+        response = click_api.complete_response(click_trans_id, merchant_trans_id)
+        response = await _remember_click_response('complete', click_trans_id, merchant_trans_id, response)
+        click_logger.info(f"COMPLETE_RESPONSE: {response}")
+
+        return _json(response)
+    except Exception as e:
+        logging.error(f"Click Complete error: {e}")
+        return _json({'error': -9, 'error_note': 'Transaction not found'}, 500)
+
+
+async def _load_tariff_payload(user_id: int) -> dict:
+    tariff_info = await adb.get_user_tariff(user_id)
+    package_info, last_payment = await asyncio.gather(
+        adb.get_user_package_limits(user_id),
+        adb.get_last_payment(user_id, tariff_info.get('tariff', 'Bepul')),
+    )
+    return click_api.build_tariff_payload(tariff_info, package_info, last_payment)
+
+
+async def get_user_tariff(request):
+    user_id = int(request.match_info['user_id'])
+    try:
+        # Shares the synchronous cache, so invalidations made by payment
+        # jobs in this process apply here too.
+        data = await wsgi.db.tariff_cache.get_or_load_async(user_id, lambda: _load_tariff_payload(user_id))
+        return _json({'success': True, 'data': data})
+    except Exception as e:
+        logging.error(f"Get user tariff error: {e}")
+        return _json({'success': False, 'message': str(e)}, 500)
+
+
+async def _on_startup(application) -> None:
+    await adb.connect()
+    # Threads do not survive gunicorn's fork; start this worker's pool.
+    wsgi.job_queue.start()
+    wsgi.payment_sweeper.start()
+    wsgi.tariff_expiry.start()
+    wsgi.quota.start()
+    await notifier.start_async()
+
+
+async def _on_cleanup(application) -> None:
+    await notifier.shutdown_async()
+    await adb.close()
+
+
+def create_app() -> web.Application:
+    application = web.Application()
+    application.router.add_post('/api/click/prepare', click_prepare)
+    application.router.add_get('/api/click/complete', click_complete)
+    application.router.add_post('/api/click/complete', click_complete)
+    application.router.add_get(r'/api/user/tariff/{user_id:\d+}', get_user_tariff)
+    application.on_startup.append(_on_startup)
+    application.on_cleanup.append(_on_cleanup)
+    return application
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    web.run_app(app, port=int(os.getenv('PORT', 8080)))
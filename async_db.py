@@ -0,0 +1,164 @@
+import asyncio
+import json
+
+import aiomysql
+
+from click_api import resolve_tariff
+from config import DB_CONFIG, DB_POOL_CONFIG
+from database import Database, PoolTimeout
+
+
+class AsyncDatabase:
+    """aiomysql-backed subset of ``Database`` for the asyncio entry point.
+
+    Only the queries on the Click callback and tariff hot paths live here;
+    they read and write the same tables with the same statements as their
+    ``Database`` counterparts. Schema management stays with ``Database``.
+    """
+
+    def __init__(self, size=None, timeout=None) -> None:
+        self.size = size or DB_POOL_CONFIG['size']
+        self.timeout = timeout or DB_POOL_CONFIG['timeout']
+        self.pool = None
+
+    async def connect(self) -> None:
+        if self.pool is not None:
+            return
+        self.pool = await aiomysql.create_pool(
+            host=DB_CONFIG['host'],
+            port=DB_CONFIG['port'],
+            user=DB_CONFIG['user'],
+            password=DB_CONFIG['password'],
+            db=DB_CONFIG['database'],
+            minsize=1,
+            maxsize=self.size,
+            pool_recycle=int(DB_POOL_CONFIG['max_lifetime']),
+            charset='utf8mb4',
+            cursorclass=aiomysql.DictCursor,
+            autocommit=True,
+        )
+
+    async def close(self) -> None:
+        if self.pool is None:
+            return
+        self.pool.close()
+        await self.pool.wait_closed()
+        self.pool = None
+
+    def pool_stats(self) -> dict:
+        if self.pool is None:
+            return {'size': 0, 'idle': 0, 'max_size': self.size}
+        return {'size': self.pool.size, 'idle': self.pool.freesize, 'max_size': self.pool.maxsize}
+
+    async def _execute(self, query, params=None, fetchone=False, fetchall=False):
+        try:
+            connection = await asyncio.wait_for(self.pool.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"No database connection available within {self.timeout}s")
+        discard = False
+        try:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query, params or ())
+                if cursor.description:
+                    return await cursor.fetchone() if fetchone else await cursor.fetchall()
+                return cursor.rowcount
+        except aiomysql.OperationalError:
+            discard = True
+            raise
+        finally:
+            if discard:
+                connection.close()
+            self.pool.release(connection)
+
+    async def _transaction(self, statements) -> None:
+        """Run ``(query, params)`` pairs on one connection in one transaction."""
+        try:
+            connection = await asyncio.wait_for(self.pool.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(f"No database connection available within {self.timeout}s")
+        discard = False
+        try:
+            await connection.begin()
+            async with connection.cursor() as cursor:
+                for query, params in statements:
+                    await cursor.execute(query, params)
+            await connection.commit()
+        except aiomysql.OperationalError:
+            discard = True
+            raise
+        except BaseException:
+            await connection.rollback()
+            raise
+        finally:
+            if discard:
+                connection.close()
+            self.pool.release(connection)
+
+    async def update_payment_prepare(self, merchant_trans_id, click_trans_id):
+        query = (
+            "UPDATE payments SET click_trans_id = %s, status = 'prepared', prepare_time = NOW() "
+            "WHERE merchant_trans_id = %s"
+        )
+        await self._transaction((
+            ("SELECT id FROM payments WHERE merchant_trans_id = %s FOR UPDATE", (merchant_trans_id,)),
+            (Database.REVENUE_DELTA_QUERY, {'sign': -1, 'merchant_trans_id': merchant_trans_id}),
+            (query, (click_trans_id, merchant_trans_id)),
+        ))
+
+    async def update_payment_complete(self, merchant_trans_id, status='confirmed', error_code=0, error_note='Success'):
+        query = (
+            "UPDATE payments SET status = %s, error_code = %s, error_note = %s, complete_time = NOW() "
+            "WHERE merchant_trans_id = %s"
+        )
+        delta = Database.REVENUE_DELTA_QUERY
+        await self._transaction((
+            ("SELECT id FROM payments WHERE merchant_trans_id = %s FOR UPDATE", (merchant_trans_id,)),
+            (delta, {'sign': -1, 'merchant_trans_id': merchant_trans_id}),
+            (query, (status, error_code, error_note, merchant_trans_id)),
+            (delta, {'sign': 1, 'merchant_trans_id': merchant_trans_id}),
+        ))
+
+    async def get_click_callback_response(self, action, click_trans_id, merchant_trans_id):
+        query = """
+        SELECT response
+        FROM click_callbacks
+        WHERE action = %s AND click_trans_id = %s AND merchant_trans_id = %s
+        """
+        row = await self._execute(query, (action, click_trans_id, merchant_trans_id), fetchone=True)
+        return json.loads(row['response']) if row else None
+
+    async def store_click_callback_response(self, action, click_trans_id, merchant_trans_id, response):
+        """Record the answer to a callback; False if one was stored first."""
+        query = """
+        INSERT INTO click_callbacks (action, click_trans_id, merchant_trans_id, response)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = id
+        """
+        return await self._execute(query, (action, click_trans_id, merchant_trans_id, json.dumps(response))) == 1
+
+    async def enqueue_job(self, kind, dedupe_key, payload, max_attempts=8):
+        query = """
+        INSERT INTO payment_jobs (kind, dedupe_key, payload, max_attempts)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = id
+        """
+        inserted = await self._execute(query, (kind, dedupe_key, json.dumps(payload, default=str), max_attempts))
+        return inserted == 1
+
+    async def get_user_tariff(self, user_id):
+        query = "SELECT tariff, tariff_expires_at FROM users WHERE user_id = %s"
+        return resolve_tariff(await self._execute(query, (user_id,), fetchone=True))
+
+    async def get_user_package_limits(self, user_id):
+        query = "SELECT * FROM user_package_limits WHERE user_id = %s"
+        return await self._execute(query, (user_id,), fetchone=True)
+
+    async def get_last_payment(self, user_id, tariff_code):
+        query = """
+        SELECT amount, paid_at
+        FROM payments
+        WHERE user_id = %s AND tariff = %s AND status = 'confirmed'
+        ORDER BY paid_at DESC
+        LIMIT 1
+        """
+        return await self._execute(query, (user_id, tariff_code), fetchone=True)
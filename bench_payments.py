@@ -0,0 +1,208 @@
+"""Benchmark the last-payment lookup before and after the payment_indexes migration.
+
+Builds a scratch database (never the application's) with the baseline
+``payments`` table, fills it with ``--rows`` deterministic rows (10M by
+default; same rows on every run), then measures the original
+``get_last_payment`` query on the baseline schema and the rewritten one
+after ``Database._migrate_payment_indexes``:
+
+- optimizer cost and chosen plan (``EXPLAIN FORMAT=JSON``)
+- rows InnoDB actually read, per lookup (``Innodb_rows_read``)
+- latency p50/p95/p99 over ``--samples`` users
+
+::
+
+    DB_HOST=127.0.0.1 DB_PORT=3307 DB_USER=root DB_PASSWORD=loadtest \\
+        python bench_payments.py --rows 10000000 --database pulbot_bench
+
+Against the MySQL in docker-compose.loadtest.yml, generating 10M rows takes
+a few minutes; pass ``--reuse`` to skip it on later runs.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from database import Database
+
+LEGACY_QUERY = """
+SELECT amount, complete_time, created_at
+FROM payments
+WHERE user_id = %s AND tariff = %s AND status = 'confirmed'
+ORDER BY COALESCE(complete_time, created_at) DESC
+LIMIT 1
+"""
+
+CURRENT_QUERY = """
+SELECT amount, paid_at
+FROM payments
+WHERE user_id = %s AND tariff = %s AND status = 'confirmed'
+ORDER BY paid_at DESC
+LIMIT 1
+"""
+
+BATCH = 100_000
+TARIFFS = "ELT(1 + MOD(n, 3), 'PLUS', 'PRO', 'MAX')"
+# 70% confirmed; the rest spread over the other states.
+STATUSES = "ELT(1 + MOD(n, 10), 'confirmed', 'confirmed', 'confirmed', 'confirmed', 'confirmed', " \
+           "'confirmed', 'confirmed', 'pending', 'failed', 'cancelled')"
+
+
+def bench_database(name) -> Database:
+    admin = Database()
+    admin.connection_config.pop('database', None)
+    connection = admin._connect()
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{name}`")
+    connection.close()
+
+    db = Database()
+    db.connection_config['database'] = name
+    # The migration indexes this table too; it stays empty here.
+    db.create_promo_code_redemptions_table()
+    return db
+
+
+def populate(db, rows, users) -> None:
+    db._execute("DROP TABLE IF EXISTS payments")
+    db.create_payments_table()
+    db.ensure_payments_package_column()
+    db.ensure_payments_discount_columns()
+    # The session keeps one connection, which the temporary table lives on.
+    with db.session():
+        db._execute("CREATE TEMPORARY TABLE bench_digits (d TINYINT PRIMARY KEY)")
+        db._execute("INSERT INTO bench_digits VALUES (0),(1),(2),(3),(4),(5),(6),(7),(8),(9)")
+        for offset in range(0, rows, BATCH):
+            size = min(BATCH, rows - offset)
+            # Row n belongs to user MOD(n * 7919, users), so each user's
+            # payments are spread over the whole table like real traffic.
+            db._execute(
+                f"""
+                INSERT INTO payments (
+                    user_id, click_trans_id, merchant_trans_id, amount, tariff,
+                    status, complete_time, created_at
+                )
+                SELECT
+                    1 + MOD(n * 7919, %s),
+                    NULL,
+                    CONCAT('bench_', n),
+                    9900 + MOD(n, 5) * 10000,
+                    {TARIFFS},
+                    {STATUSES},
+                    IF(MOD(n, 10) < 7, TIMESTAMP('2023-01-01') + INTERVAL n * 3 + 40 SECOND, NULL),
+                    TIMESTAMP('2023-01-01') + INTERVAL n * 3 SECOND
+                FROM (
+                    SELECT %s + a.d * 10000 + b.d * 1000 + c.d * 100 + e.d * 10 + f.d AS n
+                    FROM bench_digits a, bench_digits b, bench_digits c, bench_digits e, bench_digits f
+                ) seq
+                WHERE n < %s
+                """,
+                (users, offset, offset + size),
+            )
+            print(f"  {offset + size:>12,} rows", end='\r', flush=True)
+    print()
+    db._execute("ANALYZE TABLE payments")
+
+
+def _innodb_rows_read(cursor) -> int:
+    cursor.execute("SHOW SESSION STATUS LIKE 'Innodb_rows_read'")
+    return int(cursor.fetchone()['Value'])
+
+
+def measure(db, query, samples, users, seed) -> dict:
+    connection = db._connect()
+    rng = random.Random(seed)
+    keys = [(rng.randint(1, users), rng.choice(('PLUS', 'PRO', 'MAX'))) for _ in range(samples)]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN FORMAT=JSON {query}", keys[0])
+            plan = json.loads(cursor.fetchone()['EXPLAIN'])
+            block = plan['query_block']
+            table = block.get('ordering_operation', block).get('table', block.get('table', {}))
+
+            timings = []
+            rows_before = _innodb_rows_read(cursor)
+            for key in keys:
+                started = time.perf_counter()
+                cursor.execute(query, key)
+                cursor.fetchall()
+                timings.append(time.perf_counter() - started)
+            rows_read = _innodb_rows_read(cursor) - rows_before
+    finally:
+        connection.close()
+
+    timings.sort()
+
+    def percentile(percent):
+        return 1000 * timings[max(0, -(-percent * len(timings) // 100) - 1)]
+
+    return {
+        'query_cost': float(block.get('cost_info', {}).get('query_cost', 0)),
+        'access_type': table.get('access_type'),
+        'key': table.get('key'),
+        'using_index': table.get('using_index', False),
+        'filesort': block.get('ordering_operation', {}).get('using_filesort', False),
+        'rows_examined_per_scan': table.get('rows_examined_per_scan'),
+        'innodb_rows_read_per_lookup': rows_read / len(keys),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', default='pulbot_bench')
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=500_000)
+    parser.add_argument('--samples', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reuse', action='store_true', help='keep the existing bench table')
+    parser.add_argument('--output', help='write the JSON results here')
+    args = parser.parse_args(argv)
+
+    db = bench_database(args.database)
+    if not args.reuse:
+        print(f"Generating {args.rows:,} payments for {args.users:,} users in {args.database}")
+        populate(db, args.rows, args.users)
+    else:
+        # Put the reused table back to the baseline schema.
+        existing = db._table_indexes('payments')
+        clauses = [f"DROP INDEX {name}" for name, _ in Database.PAYMENT_INDEXES['payments'] if name in existing]
+        if 'paid_at' in db._table_columns('payments'):
+            clauses.append('DROP COLUMN paid_at')
+        if clauses:
+            db._execute(f"ALTER TABLE payments {', '.join(clauses)}")
+
+    results = {'rows': args.rows, 'users': args.users, 'samples': args.samples}
+    print('Measuring baseline schema ...')
+    results['before'] = measure(db, LEGACY_QUERY, args.samples, args.users, args.seed)
+    print('Applying payment_indexes migration ...')
+    started = time.perf_counter()
+    db._migrate_payment_indexes()
+    results['migration_seconds'] = time.perf_counter() - started
+    db._execute("ANALYZE TABLE payments")
+    print('Measuring migrated schema ...')
+    results['after'] = measure(db, CURRENT_QUERY, args.samples, args.users, args.seed)
+
+    print()
+    print(f"{'':<30}{'before':>16}{'after':>16}")
+    for key in (
+        'query_cost', 'access_type', 'key', 'using_index', 'filesort',
+        'rows_examined_per_scan', 'innodb_rows_read_per_lookup', 'p50_ms', 'p95_ms', 'p99_ms',
+    ):
+        before, after = results['before'][key], results['after'][key]
+        fmt = (lambda value: f"{value:>16.2f}") if isinstance(before, float) else (lambda value: f"{str(value):>16}")
+        print(f"{key:<30}{fmt(before)}{fmt(after)}")
+    print(f"migration took {results['migration_seconds']:.1f}s")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            json.dump(results, handle, indent=2)
+            handle.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""Build fingerprinted static assets for the mini app templates.
+
+Reads the CSS/JS sources in ``assets/``, minifies them, writes
+``static/dist/<name>.<hash>.<ext>`` together with pre-compressed ``.gz``
+(and ``.br`` when Brotli is installed) siblings, and records the mapping in
+``static/dist/manifest.json``. Templates resolve files through
+``asset_url()``, so run this after editing anything under ``assets/``::
+
+    python build_assets.py
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BASE_DIR, 'assets')
+OUTPUT_DIR = os.path.join(BASE_DIR, 'static', 'dist')
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, 'manifest.json')
+
+
+# Quoted strings, which are copied verbatim, and comments, which are dropped.
+CSS_STRING_OR_COMMENT = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/''', re.S)
+
+
+def _minify_css_code(text: str) -> str:
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    # Only the space after ':' is dropped; one before it is a descendant
+    # combinator in selectors such as ".card :hover".
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}')
+
+
+def minify_css(source: str) -> str:
+    text = CSS_STRING_OR_COMMENT.sub(lambda match: match.group(1) or '', source)
+    # Odd-numbered parts are the quoted strings.
+    parts = re.split(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''', text)
+    parts[::2] = [_minify_css_code(part) for part in parts[::2]]
+    return ''.join(parts).strip() + '\n'
+
+
+def minify_js(source: str) -> str:
+    """Conservative JS minifier: trims indentation, blank and comment lines.
+
+    Newlines are kept so automatic semicolon insertion behaves exactly as in
+    the source, and lines inside multi-line template literals are copied
+    verbatim.
+    """
+    lines = []
+    in_template = False
+    for line in source.splitlines():
+        if in_template:
+            lines.append(line)
+        else:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('//'):
+                continue
+            lines.append(stripped)
+        backticks = len(re.findall(r'(?<!\\)`', line))
+        if backticks % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+
+MINIFIERS = {
+    '.css': minify_css,
+    '.js': minify_js,
+}
+
+
+def build() -> dict:
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest = {}
+    written = {'manifest.json'}
+    for filename in sorted(os.listdir(SOURCE_DIR)):
+        stem, ext = os.path.splitext(filename)
+        minify = MINIFIERS.get(ext)
+        if minify is None:
+            continue
+        with open(os.path.join(SOURCE_DIR, filename), encoding='utf-8') as handle:
+            content = minify(handle.read()).encode('utf-8')
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        hashed_name = f'{stem}.{digest}{ext}'
+        variants = {
+            hashed_name: content,
+            f'{hashed_name}.gz': gzip.compress(content, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            variants[f'{hashed_name}.br'] = brotli.compress(content, quality=11, mode=brotli.MODE_TEXT)
+        for name, data in variants.items():
+            with open(os.path.join(OUTPUT_DIR, name), 'wb') as handle:
+                handle.write(data)
+            written.add(name)
+        manifest[filename] = hashed_name
+
+    for stale in set(os.listdir(OUTPUT_DIR)) - written:
+        os.remove(os.path.join(OUTPUT_DIR, stale))
+
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+        handle.write('\n')
+    return manifest
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.parse_args(argv)
+    result = build()
+    for source, target in sorted(result.items()):
+        print(f'{source} -> static/dist/{target}')
+    if brotli is None:
+        print('Brotli is not installed; only gzip variants were written.', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    __slots__ = ('event', 'value', 'error', 'stale', 'future')
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+        self.future = None
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds.
+
+    ``get_or_load`` collapses concurrent misses for the same key into a single
+    call of the loader (single-flight); the other callers wait for its result.
+    Invalidating a key while its load is in flight discards that load's result
+    so a value read before a write can never be cached after it.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30.0) -> None:
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > now:
+                self._data.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            if entry:
+                del self._data[key]
+        return default
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > now:
+                self._data.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self._stats['misses'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if flight.error is None and not flight.stale:
+                    self._store(key, flight.value)
+            flight.event.set()
+        return flight.value
+
+    def get_or_load_many(self, keys, loader) -> dict:
+        """``get_or_load`` for many keys with one ``loader(missing_keys)`` call.
+
+        ``loader`` returns a dict with a value for every key it was given.
+        Keys another caller is already loading are waited for rather than
+        loaded twice, and invalidation discards results exactly as in
+        ``get_or_load``.
+        """
+        now = time.monotonic()
+        values, owned, waiting = {}, {}, {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._data.get(key)
+                if entry and entry[0] > now:
+                    self._data.move_to_end(key)
+                    self._stats['hits'] += 1
+                    values[key] = entry[1]
+                elif key in self._inflight:
+                    self._stats['coalesced'] += 1
+                    waiting[key] = self._inflight[key]
+                else:
+                    self._stats['misses'] += 1
+                    owned[key] = self._inflight[key] = _Flight()
+
+        if owned:
+            error = None
+            try:
+                loaded = loader(list(owned))
+            except BaseException as exc:
+                error = exc
+                raise
+            finally:
+                with self._lock:
+                    for key, flight in owned.items():
+                        self._inflight.pop(key, None)
+                        if error is None:
+                            flight.value = loaded.get(key)
+                            if not flight.stale:
+                                self._store(key, flight.value)
+                        else:
+                            flight.error = error
+                for flight in owned.values():
+                    flight.event.set()
+            values.update((key, flight.value) for key, flight in owned.items())
+
+        for key, flight in waiting.items():
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            values[key] = flight.value
+        return values
+
+    async def get_or_load_async(self, key, loader):
+        """``get_or_load`` for coroutines: ``loader`` is awaited, never run in a thread.
+
+        Waiters on the event loop await the leader's future instead of
+        blocking; a load already in flight on a worker thread is waited for
+        in the default executor.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and entry[0] > now:
+                self._data.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                flight.future = asyncio.get_running_loop().create_future()
+                self._inflight[key] = flight
+                self._stats['misses'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            if flight.future is not None and flight.future.get_loop() is asyncio.get_running_loop():
+                await asyncio.shield(flight.future)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, flight.event.wait)
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = await loader()
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if flight.error is None and not flight.stale:
+                    self._store(key, flight.value)
+            flight.event.set()
+            flight.future.set_result(None)
+        return flight.value
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            flight = self._inflight.get(key)
+            if flight is not None:
+                flight.stale = True
+            self._stats['invalidations'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            for flight in self._inflight.values():
+                flight.stale = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+        return stats
+
+
+class RefreshingSnapshot:
+    """Process-local copy of a small dataset, refreshed in the background.
+
+    The first ``get`` loads synchronously. Afterwards a stale snapshot keeps
+    being served while a single background thread reloads it, so readers never
+    wait on the database. If a reload fails the previous snapshot stays in
+    place and the next read schedules another attempt.
+    """
+
+    def __init__(self, loader, interval=30.0, name='snapshot') -> None:
+        self._loader = loader
+        self.interval = interval
+        self.name = name
+        self._value = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._stats = {
+            'reads': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+        }
+
+    def get(self):
+        with self._lock:
+            self._stats['reads'] += 1
+            loaded_at = self._loaded_at
+            value = self._value
+        if loaded_at is None:
+            return self.refresh()
+        if time.monotonic() - loaded_at >= self.interval:
+            self._refresh_in_background()
+        return value
+
+    def refresh(self):
+        try:
+            value = self._loader()
+        except Exception:
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+                self._refreshing = False
+            raise
+        with self._lock:
+            self._value = value
+            self._loaded_at = time.monotonic()
+            self._refreshing = False
+            self._stats['refreshes'] += 1
+        return value
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as err:
+                logging.error(f"{self.name} refresh error: {err}")
+
+        threading.Thread(target=run, name=f'{self.name}-refresh', daemon=True).start()
+
+    def invalidate(self) -> None:
+        """Mark the snapshot stale so the next read triggers a reload."""
+        with self._lock:
+            if self._loaded_at is not None:
+                self._loaded_at = float('-inf')
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['age'] = None if self._loaded_at is None else time.monotonic() - self._loaded_at
+        return stats
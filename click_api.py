@@ -0,0 +1,173 @@
+"""Click SHOP-API callback checks and the user tariff payload.
+
+Shared by the Flask views in ``app.py`` and the asyncio entry point in
+``async_app.py`` so both serve byte-for-byte the same answers; nothing in
+here touches the database or a request object.
+"""
+import hashlib
+import os
+from datetime import datetime
+
+from config import CLICK_SECRET_KEY, CLICK_SERVICE_ID, PLUS_PACKAGES, TARIFF_LIMITS
+
+PREPARE_REQUIRED_FIELDS = ('click_trans_id', 'service_id', 'amount', 'action', 'sign_time', 'sign_string')
+COMPLETE_REQUIRED_FIELDS = ('click_trans_id', 'amount', 'action', 'sign_time', 'sign_string', 'error')
+
+
+class ClickError(Exception):
+    """A callback rejected before any work was done."""
+
+    def __init__(self, code, note, status=400) -> None:
+        super().__init__(note)
+        self.code = code
+        self.note = note
+        self.status = status
+
+    def payload(self) -> dict:
+        return {'error': self.code, 'error_note': self.note}
+
+
+def _md5(value: str) -> str:
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+def _require(params: dict, fields) -> None:
+    for field in fields:
+        if field not in params:
+            raise ClickError(-8, f'Missing parameter: {field}')
+
+
+def merchant_trans_id_of(params: dict):
+    return params.get('merchant_trans_id') or params.get('transaction_param')
+
+
+def prepare_sign(params: dict, merchant_trans_id: str) -> str:
+    return _md5(
+        f"{params['click_trans_id']}{params['service_id']}{CLICK_SECRET_KEY}{merchant_trans_id}"
+        f"{params['amount']}{params['action']}{params['sign_time']}"
+    )
+
+
+def complete_sign(params: dict, merchant_trans_id: str) -> str:
+    service_id = params.get('service_id', CLICK_SERVICE_ID)
+    merchant_prepare_id = params.get('merchant_prepare_id', '')
+    return _md5(
+        f"{params['click_trans_id']}{service_id}{CLICK_SECRET_KEY}{merchant_trans_id}{merchant_prepare_id}"
+        f"{params['amount']}{params['action']}{params['sign_time']}"
+    )
+
+
+def check_prepare(params: dict) -> str:
+    """Validate a prepare callback; returns its merchant_trans_id."""
+    _require(params, PREPARE_REQUIRED_FIELDS)
+    merchant_trans_id = merchant_trans_id_of(params)
+    if not merchant_trans_id:
+        raise ClickError(-5, 'Merchant transaction not found')
+    if prepare_sign(params, merchant_trans_id) != params['sign_string']:
+        raise ClickError(-1, 'SIGN CHECK FAILED')
+    try:
+        if float(params['amount']) <= 0:
+            raise ClickError(-2, 'Incorrect parameter amount')
+    except ValueError:
+        raise ClickError(-2, 'Incorrect parameter amount')
+    if params['action'] not in ['0', '1']:
+        raise ClickError(-3, 'Action not found')
+    return merchant_trans_id
+
+
+def check_complete(params: dict) -> str:
+    """Validate a complete callback; returns its merchant_trans_id."""
+    _require(params, COMPLETE_REQUIRED_FIELDS)
+    merchant_trans_id = merchant_trans_id_of(params)
+    if complete_sign(params, merchant_trans_id) != params['sign_string']:
+        allow_debug = os.getenv('CLICK_ALLOW_DEBUG_SIGNATURE', 'false').lower() == 'true'
+        if not allow_debug:
+            raise ClickError(-1, 'SIGN CHECK FAILED')
+    return merchant_trans_id
+
+
+def prepare_response(click_trans_id, merchant_trans_id) -> dict:
+    return {
+        'error': 0,
+        'error_note': 'Success',
+        'click_trans_id': int(click_trans_id),
+        'merchant_trans_id': merchant_trans_id,
+        'merchant_prepare_id': int(datetime.now().timestamp()),
+    }
+
+
+def complete_response(click_trans_id, merchant_trans_id, error_code=0, error_note='Success') -> dict:
+    return {
+        'click_trans_id': int(click_trans_id),
+        'merchant_trans_id': merchant_trans_id,
+        'merchant_confirm_id': int(datetime.now().timestamp()),
+        'error': error_code,
+        'error_note': error_note,
+    }
+
+
+def payment_success_job(merchant_trans_id, amount) -> dict:
+    return {
+        'merchant_trans_id': merchant_trans_id,
+        'amount': float(amount) if amount else 0,
+        'update_payment': True,
+        'send_notification': True,
+    }
+
+
+def resolve_tariff(row) -> dict:
+    """The tariff a ``users`` row entitles to right now.
+
+    ``TariffExpiryScheduler`` writes lapsed tariffs back as Bepul in bulk;
+    until it reaches a row, the expiry is still enforced here.
+    """
+    if not row:
+        return {'tariff': 'Bepul', 'expires_at': None}
+
+    expires_at = row.get('tariff_expires_at')
+    tariff = row.get('tariff') or 'Bepul'
+
+    if expires_at and expires_at <= datetime.now():
+        return {'tariff': 'Bepul', 'expires_at': expires_at}
+
+    return {'tariff': tariff, 'expires_at': expires_at}
+
+
+def tariff_limits(tariff_code) -> dict:
+    return TARIFF_LIMITS.get(tariff_code, TARIFF_LIMITS['Plus'])
+
+
+def build_tariff_payload(tariff_info: dict, package_info, last_payment) -> dict:
+    tariff_code = tariff_info.get('tariff', 'Bepul')
+    expires_at = tariff_info.get('expires_at')
+    limits = tariff_limits(tariff_code)
+    payload = None
+    if package_info:
+        package_code = (package_info.get('package_code') or '').upper()
+        package_meta = PLUS_PACKAGES.get(package_code)
+        payload = {
+            'code': package_code,
+            'text_limit': package_info.get('text_limit'),
+            'voice_limit': package_info.get('voice_limit'),
+            'text_used': package_info.get('text_used'),
+            'voice_used': package_info.get('voice_used'),
+            'title': package_meta.get('title') if package_meta else None,
+            'tagline': package_meta.get('tagline') if package_meta else None,
+            'price': package_meta.get('price') if package_meta else None,
+            'badge': package_meta.get('badge') if package_meta else None,
+            'updated_at': package_info.get('updated_at').isoformat() if package_info.get('updated_at') else None,
+        }
+    last_payment_payload = None
+    if last_payment:
+        paid_at = last_payment.get('paid_at')
+        last_payment_payload = {
+            'amount': float(last_payment.get('amount') or 0),
+            'paid_at': paid_at.isoformat() if paid_at else None,
+        }
+    return {
+        'tariff': tariff_code,
+        'expires_at': expires_at.isoformat() if expires_at else None,
+        'limits': limits,
+        'package': payload,
+        'last_payment': last_payment_payload,
+    }
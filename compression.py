@@ -0,0 +1,122 @@
+import gzip
+import threading
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available.
+    brotli = None
+
+DEFAULT_MIMETYPES = frozenset({
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+})
+
+
+class Compression:
+    """Negotiated gzip/brotli compression for dynamic Flask responses.
+
+    Responses are compressed after the view runs when the client accepts an
+    encoding, the mimetype is allow-listed and the body is at least
+    ``min_size`` bytes. Streamed and file responses, bodies that already carry
+    a Content-Encoding and the endpoints in ``exclude_endpoints`` are left
+    alone. Per-endpoint byte counts are kept in ``stats()`` and passed to
+    observers, which ``Metrics`` exports as counters.
+    """
+
+    def __init__(
+        self,
+        app=None,
+        min_size=512,
+        gzip_level=6,
+        brotli_quality=4,
+        mimetypes=DEFAULT_MIMETYPES,
+        exclude_endpoints=(),
+    ) -> None:
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.mimetypes = frozenset(mimetypes)
+        self.exclude_endpoints = set(exclude_endpoints)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._observers = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app) -> None:
+        app.after_request(self._compress_response)
+        app.extensions['compression'] = self
+
+    def add_observer(self, observer) -> None:
+        """Call ``observer(endpoint, encoding, size_in, size_out)`` after every compressed response."""
+        self._observers.append(observer)
+
+    def exclude(self, *endpoints) -> None:
+        self.exclude_endpoints.update(endpoints)
+
+    def _encoding(self):
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br'] and accepted['br'] >= accepted['gzip']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def _compress_response(self, response):
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or request.endpoint in self.exclude_endpoints
+            or response.mimetype not in self.mimetypes
+        ):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self._encoding()
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(data, compresslevel=self.gzip_level)
+        if len(compressed) >= len(data):
+            return response
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(f'{etag}-{encoding}')
+        self._record(request.endpoint or 'unknown', encoding, len(data), len(compressed))
+        return response
+
+    def _record(self, endpoint, encoding, size_in, size_out) -> None:
+        with self._lock:
+            entry = self._stats.setdefault(endpoint, {'responses': 0, 'bytes_in': 0, 'bytes_out': 0})
+            entry['responses'] += 1
+            entry['bytes_in'] += size_in
+            entry['bytes_out'] += size_out
+        for observer in self._observers:
+            observer(endpoint, encoding, size_in, size_out)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {}
+            for endpoint, entry in self._stats.items():
+                stats[endpoint] = dict(entry)
+                stats[endpoint]['ratio'] = entry['bytes_out'] / entry['bytes_in'] if entry['bytes_in'] else 1.0
+        return stats
@@ -12,8 +12,110 @@ DB_CONFIG = {
     'database': os.getenv('DB_NAME', ''),
 }
 
+def _default_pool_size() -> int:
+    # Each gunicorn worker owns its own pool, so split the server-wide
+    # connection budget between workers when no explicit size is given.
+    explicit = os.getenv('DB_POOL_SIZE')
+    if explicit:
+        return max(1, int(explicit))
+    budget = os.getenv('DB_MAX_CONNECTIONS')
+    if budget:
+        workers = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+        return max(1, int(budget) // workers)
+    return 5
+
+
+DB_POOL_CONFIG = {
+    'size': _default_pool_size(),
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+    'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', 300)),
+    'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+    'ping_interval': float(os.getenv('DB_POOL_PING_INTERVAL', 30)),
+}
+
+TARIFF_CACHE_TTL = float(os.getenv('TARIFF_CACHE_TTL', 30))
+TARIFF_CACHE_SIZE = int(os.getenv('TARIFF_CACHE_SIZE', 10000))
+PROMO_CACHE_TTL = float(os.getenv('PROMO_CACHE_TTL', 30))
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 512))
+SLOW_QUERY_CONFIG = {
+    'enabled': os.getenv('SLOW_QUERY_LOG', 'true').lower() == 'true',
+    'threshold_ms': float(os.getenv('SLOW_QUERY_MS', 200)),
+    'path': os.getenv('SLOW_QUERY_LOG_PATH', 'slow_queries.log'),
+    'max_bytes': int(os.getenv('SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024)),
+    'backup_count': int(os.getenv('SLOW_QUERY_LOG_BACKUPS', 5)),
+    'explain': os.getenv('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true',
+}
+# When set, /metrics answers only with ?token= or 'Authorization: Bearer <token>'.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Bearer token for the /api/admin/* reporting endpoints; unset disables them.
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')
+CLICK_IDEMPOTENCY_CACHE_SIZE = int(os.getenv('CLICK_IDEMPOTENCY_CACHE_SIZE', 10000))
+CLICK_IDEMPOTENCY_CACHE_TTL = float(os.getenv('CLICK_IDEMPOTENCY_CACHE_TTL', 86400))
+
 BOT_TOKEN = os.getenv('BOT_TOKEN', '')
 
+NOTIFIER_CONFIG = {
+    'api_url': os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/'),
+    'rate': float(os.getenv('TELEGRAM_RATE_LIMIT', 25)),
+    'batch_size': int(os.getenv('NOTIFY_BATCH_SIZE', 50)),
+    'poll_interval': float(os.getenv('NOTIFY_POLL_INTERVAL', 1)),
+    'max_attempts': int(os.getenv('NOTIFY_MAX_ATTEMPTS', 10)),
+    'enabled': os.getenv('NOTIFY_DISPATCHER', 'true').lower() == 'true',
+}
+
+JOB_QUEUE_CONFIG = {
+    'workers': int(os.getenv('JOB_WORKERS', 2)),
+    'poll_interval': float(os.getenv('JOB_POLL_INTERVAL', 2)),
+    'lease_seconds': int(os.getenv('JOB_LEASE_SECONDS', 120)),
+    'max_attempts': int(os.getenv('JOB_MAX_ATTEMPTS', 8)),
+    'backoff_base': float(os.getenv('JOB_BACKOFF_BASE', 5)),
+    'backoff_max': float(os.getenv('JOB_BACKOFF_MAX', 900)),
+    'drain_timeout': float(os.getenv('JOB_DRAIN_TIMEOUT', 20)),
+}
+
+# Abandoned checkouts: pending/prepared payments older than stale_minutes
+# are cancelled and their promo reservations released (scheduler.py).
+PAYMENT_SWEEPER_CONFIG = {
+    'enabled': os.getenv('PAYMENT_SWEEPER', 'true').lower() == 'true',
+    'interval': float(os.getenv('PAYMENT_SWEEP_INTERVAL', 60)),
+    'stale_minutes': int(os.getenv('PAYMENT_STALE_MINUTES', 60)),
+    'batch_size': int(os.getenv('PAYMENT_SWEEP_BATCH', 200)),
+    'max_batches': int(os.getenv('PAYMENT_SWEEP_MAX_BATCHES', 50)),
+    'duty_cycle': float(os.getenv('PAYMENT_SWEEP_DUTY_CYCLE', 0.1)),
+}
+# Lapsed tariffs are downgraded and reminders queued by scheduler.py; reads
+# trust users.tariff, so keep this enabled on at least one deployment.
+TARIFF_EXPIRY_CONFIG = {
+    'enabled': os.getenv('TARIFF_EXPIRY', 'true').lower() == 'true',
+    'interval': float(os.getenv('TARIFF_EXPIRY_INTERVAL', 300)),
+    'chunk_size': int(os.getenv('TARIFF_EXPIRY_CHUNK', 1000)),
+    'remind_days': int(os.getenv('TARIFF_REMIND_DAYS', 3)),
+    'duty_cycle': float(os.getenv('TARIFF_EXPIRY_DUTY_CYCLE', 0.5)),
+}
+# In-memory package quota (quota.py): units are leased from MySQL per user
+# in blocks of grant_size and used units flushed every flush_interval.
+QUOTA_CONFIG = {
+    'enabled': os.getenv('QUOTA_ENGINE', 'true').lower() == 'true',
+    'grant_size': int(os.getenv('QUOTA_GRANT_SIZE', 20)),
+    'flush_interval': float(os.getenv('QUOTA_FLUSH_INTERVAL', 1)),
+    'lease_seconds': int(os.getenv('QUOTA_LEASE_SECONDS', 120)),
+    'idle_seconds': float(os.getenv('QUOTA_IDLE_SECONDS', 30)),
+}
+# Token buckets for /api/promocode/validate and the checkout POSTs
+# (ratelimit.py), per user_id and per client IP. Buckets live in each
+# worker unless redis_url is set; trusted_proxies is how many proxies
+# append to X-Forwarded-For in front of the app (0: use the socket address).
+RATE_LIMIT_CONFIG = {
+    'enabled': os.getenv('RATE_LIMIT', 'true').lower() == 'true',
+    'redis_url': os.getenv('RATE_LIMIT_REDIS_URL', ''),
+    'trusted_proxies': int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', 1)),
+    'promo_per_minute': float(os.getenv('RATE_LIMIT_PROMO_PER_MINUTE', 20)),
+    'promo_burst': int(os.getenv('RATE_LIMIT_PROMO_BURST', 10)),
+    'checkout_per_minute': float(os.getenv('RATE_LIMIT_CHECKOUT_PER_MINUTE', 10)),
+    'checkout_burst': int(os.getenv('RATE_LIMIT_CHECKOUT_BURST', 5)),
+    'ip_factor': float(os.getenv('RATE_LIMIT_IP_FACTOR', 5)),
+}
+
 CLICK_SECRET_KEY = os.getenv('CLICK_SECRET_KEY', '')
 CLICK_SERVICE_ID = os.getenv('CLICK_SERVICE_ID', '')
 CLICK_MERCHANT_ID = os.getenv('CLICK_MERCHANT_ID', '')
@@ -78,6 +180,8 @@ PLUS_PACKAGES = {
 
 PLUS_PACKAGE_SEQUENCE = ['T300V100', 'T750V250', 'T1750V600']
 
+# Optional 'shards' splits a high-volume code's usage counter across that
+# many rows so concurrent reservations do not queue on a single row lock.
 PROMO_CODES = {
     '50FRIEND50': {
         'discount_percent': 60,
@@ -1,14 +1,321 @@
+import hashlib
+import json
 import logging
+import os
+import random
+import sys
+import threading
+import time
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import timedelta
 
 import pymysql
-from pymysql.cursors import DictCursor
+from pymysql.cursors import DictCursor, SSDictCursor
 
-from config import DB_CONFIG, PROMO_CODES
+from cache import RefreshingSnapshot, TTLCache
+from click_api import resolve_tariff
+from config import (
+    DB_CONFIG,
+    DB_POOL_CONFIG,
+    PROMO_CACHE_TTL,
+    PROMO_CODES,
+    TARIFF_CACHE_SIZE,
+    TARIFF_CACHE_TTL,
+)
+
+
+class PoolTimeout(pymysql.err.OperationalError):
+    pass
+
+
+class _PooledConnection:
+    __slots__ = ('connection', 'created_at', 'last_used')
+
+    def __init__(self, connection) -> None:
+        now = time.monotonic()
+        self.connection = connection
+        self.created_at = now
+        self.last_used = now
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of PyMySQL connections.
+
+    Connections are created lazily up to ``size``. Idle connections older than
+    ``max_lifetime`` or unused for longer than ``max_idle`` are recycled, and a
+    connection that sat idle for more than ``ping_interval`` is pinged before
+    it is handed out again.
+    """
+
+    def __init__(self, connect, size=5, timeout=10.0, max_idle=300.0, max_lifetime=3600.0, ping_interval=30.0) -> None:
+        self._connect = connect
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self._idle = []
+        self._opened = 0
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'ping_failures': 0,
+        }
+
+    def _reset_after_fork(self) -> None:
+        # Sockets inherited from the parent process must never be shared with
+        # it, so a forked worker starts with an empty pool of its own.
+        self._idle = []
+        self._opened = 0
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+
+    def _close_quietly(self, connection) -> None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _is_expired(self, item, now) -> bool:
+        if self.max_lifetime and now - item.created_at > self.max_lifetime:
+            return True
+        if self.max_idle and now - item.last_used > self.max_idle:
+            return True
+        return False
+
+    def _is_healthy(self, item, now) -> bool:
+        if not self.ping_interval or now - item.last_used < self.ping_interval:
+            return True
+        try:
+            item.connection.ping(reconnect=False)
+            return True
+        except Exception as exc:
+            logging.debug(f'Pooled connection ping failed: {exc}')
+            self._stats['ping_failures'] += 1
+            return False
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    item = self._idle.pop()
+                    if self._is_expired(item, now) or not self._is_healthy(item, now):
+                        self._opened -= 1
+                        self._stats['recycled'] += 1
+                        self._close_quietly(item.connection)
+                        continue
+                    self._stats['checkouts'] += 1
+                    return item
+                if self._opened < self.size:
+                    self._opened += 1
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'Timed out after {self.timeout}s waiting for a database connection')
+                if not waited:
+                    waited = True
+                    self._stats['waits'] += 1
+                self._condition.wait(remaining)
+
+        try:
+            item = _PooledConnection(self._connect())
+        except Exception:
+            with self._condition:
+                self._opened -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._stats['created'] += 1
+            self._stats['checkouts'] += 1
+        return item
+
+    def release(self, item, discard=False) -> None:
+        with self._condition:
+            if discard or item.connection.open is False:
+                self._opened -= 1
+                self._stats['discarded'] += 1
+                self._close_quietly(item.connection)
+            else:
+                item.last_used = time.monotonic()
+                self._idle.append(item)
+            self._condition.notify()
+
+    def close(self) -> None:
+        with self._condition:
+            while self._idle:
+                item = self._idle.pop()
+                self._opened -= 1
+                self._close_quietly(item.connection)
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update(
+                {
+                    'size': self.size,
+                    'opened': self._opened,
+                    'idle': len(self._idle),
+                    'in_use': self._opened - len(self._idle),
+                }
+            )
+        return stats
+
+
+class DatabaseSession:
+    """Unit of work bound to a single pooled connection.
+
+    While a session is open on a thread every ``Database`` helper called from
+    that thread runs on the session's connection, so existing methods can be
+    used unchanged inside ``with db.session() as s:``. ``results`` collects
+    the result of every statement in execution order.
+    """
+
+    def __init__(self, db, connection, transaction) -> None:
+        self.db = db
+        self.connection = connection
+        self.transaction = transaction
+        self.results = []
+        self._after_commit = []
+
+    def execute(self, query, params=None, fetchone=False, fetchall=False):
+        return self.db._execute(query, params, fetchone=fetchone, fetchall=fetchall)
+
+    def on_commit(self, callback) -> None:
+        if self.transaction:
+            self._after_commit.append(callback)
+        else:
+            callback()
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
 
 
 class Database:
+    # Ordered schema migrations as (version, name, method). Append new entries
+    # with a higher version; never edit or reorder ones that already shipped.
+    MIGRATIONS = (
+        (1, 'baseline', '_migrate_baseline'),
+        (2, 'payment_jobs', 'create_payment_jobs_table'),
+        (3, 'notification_outbox', 'create_notification_outbox_table'),
+        (4, 'promo_reservations', '_migrate_promo_reservations'),
+        (5, 'click_callbacks', 'create_click_callbacks_table'),
+        (6, 'payment_indexes', '_migrate_payment_indexes'),
+        (7, 'history_indexes', '_migrate_history_indexes'),
+        (8, 'revenue_daily', '_migrate_revenue_daily'),
+        (9, 'quota_leases', '_migrate_quota_leases'),
+        (10, 'scheduler_cursors', 'create_scheduler_cursors_table'),
+    )
+    # Repeatable migrations run again whenever their checksum changes.
+    REPEATABLE_MIGRATIONS = (
+        ('seed_promo_codes', '_promo_codes_checksum', 'seed_promo_codes'),
+    )
+    MIGRATION_LOCK_NAME = 'pulbot_schema_migrations'
+    MIGRATION_LOCK_TIMEOUT = 60
+    # Secondary indexes added by _migrate_payment_indexes, per table. InnoDB
+    # appends the primary key to every secondary index, so the payments one
+    # covers get_last_payment without touching the clustered rows.
+    PAYMENT_INDEXES = {
+        'payments': (
+            ('idx_user_tariff_status_paid', '(user_id, tariff, status, paid_at, amount)'),
+            ('idx_status_created', '(status, created_at)'),
+        ),
+        'promo_code_redemptions': (
+            ('idx_merchant_status', '(merchant_trans_id, status)'),
+            ('idx_status_created', '(status, created_at)'),
+        ),
+    }
+    # Keyset indexes for a user's history, added by _migrate_history_indexes
+    # together with the single-column user indexes they make redundant.
+    HISTORY_INDEXES = {
+        'payments': (('idx_user_created', '(user_id, created_at)'), 'idx_user_id'),
+        'plus_package_purchases': (('idx_user_purchased', '(user_id, purchased_at)'), 'idx_user'),
+    }
+    # What /api/user/<id>/payments serves per source: table, the column it
+    # is ordered by (with id as tie-breaker) and the columns returned.
+    HISTORY_SOURCES = {
+        'payments': {
+            'table': 'payments',
+            'time_column': 'created_at',
+            'columns': (
+                'id', 'merchant_trans_id', 'tariff', 'package_code', 'amount', 'original_amount',
+                'discount_amount', 'discount_percent', 'promo_code', 'payment_method', 'status',
+                'paid_at', 'created_at',
+            ),
+        },
+        'packages': {
+            'table': 'plus_package_purchases',
+            'time_column': 'purchased_at',
+            'columns': (
+                'id', 'merchant_trans_id', 'package_code', 'amount', 'text_limit', 'text_used',
+                'voice_limit', 'voice_used', 'status', 'purchased_at',
+            ),
+        },
+    }
+    # Seconds the server waits on a stalled export client before aborting.
+    STREAM_NET_WRITE_TIMEOUT = 600
+    # Payment statuses counted in revenue_daily. A payment enters the rollup
+    # when it reaches one of them and is moved between buckets afterwards.
+    REVENUE_STATUSES = ('confirmed', 'cancelled', 'failed')
+    REVENUE_DIMENSIONS = ('day', 'tariff', 'package_code', 'promo_code', 'status')
+    # Adds the payments matching {condition} to revenue_daily, grouped.
+    REVENUE_ADD_QUERY = """
+    INSERT INTO revenue_daily (day, tariff, package_code, promo_code, status, payments, original_amount, discount_amount, amount)
+    SELECT
+        DATE(paid_at),
+        tariff,
+        COALESCE(package_code, ''),
+        COALESCE(promo_code, ''),
+        status,
+        COUNT(*),
+        SUM(COALESCE(original_amount, amount)),
+        SUM(COALESCE(discount_amount, 0)),
+        SUM(amount)
+    FROM payments
+    WHERE {condition} AND status IN ('confirmed', 'cancelled', 'failed')
+    GROUP BY 1, 2, 3, 4, 5
+    ON DUPLICATE KEY UPDATE
+        payments = payments + VALUES(payments),
+        original_amount = original_amount + VALUES(original_amount),
+        discount_amount = discount_amount + VALUES(discount_amount),
+        amount = amount + VALUES(amount)
+    """
+    # Adds (sign = 1) or removes (sign = -1) the rows of one payment from
+    # its revenue_daily bucket. Shared with AsyncDatabase.
+    REVENUE_DELTA_QUERY = """
+    INSERT INTO revenue_daily (day, tariff, package_code, promo_code, status, payments, original_amount, discount_amount, amount)
+    SELECT
+        DATE(paid_at),
+        tariff,
+        COALESCE(package_code, ''),
+        COALESCE(promo_code, ''),
+        status,
+        %(sign)s,
+        %(sign)s * COALESCE(original_amount, amount),
+        %(sign)s * COALESCE(discount_amount, 0),
+        %(sign)s * amount
+    FROM payments
+    WHERE merchant_trans_id = %(merchant_trans_id)s AND status IN ('confirmed', 'cancelled', 'failed')
+    ON DUPLICATE KEY UPDATE
+        payments = payments + VALUES(payments),
+        original_amount = original_amount + VALUES(original_amount),
+        discount_amount = discount_amount + VALUES(discount_amount),
+        amount = amount + VALUES(amount)
+    """
+
     def __init__(self) -> None:
         self.connection_config = DB_CONFIG.copy()
         self.connection_config.update(
@@ -18,23 +325,276 @@ class Database:
                 'autocommit': True,
             }
         )
+        self.pool = ConnectionPool(self._connect, **DB_POOL_CONFIG)
+        self._local = threading.local()
+        self._query_observers = []
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        # Assembled /api/user/tariff payloads keyed by user_id. Writes that
+        # change a user's entitlement invalidate their entry.
+        self.tariff_cache = TTLCache(maxsize=TARIFF_CACHE_SIZE, ttl=TARIFF_CACHE_TTL)
+        # The promo_codes table is tiny and rarely changes; validation reads
+        # a snapshot of all of it instead of querying per request.
+        self.promo_codes_snapshot = RefreshingSnapshot(self._load_promo_codes, interval=PROMO_CACHE_TTL, name='promo_codes')
+
+    def _connect(self):
+        return pymysql.connect(**self.connection_config)
 
     @contextmanager
     def _get_connection(self):
-        connection = pymysql.connect(**self.connection_config)
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            yield session.connection
+            return
+        item = self.pool.acquire()
+        discard = False
         try:
-            yield connection
+            yield item.connection
+        except pymysql.err.OperationalError:
+            # Lost connections and server-side timeouts leave the socket in an
+            # unknown state; never hand such a connection back out.
+            discard = True
+            raise
+        except pymysql.err.InterfaceError:
+            discard = True
+            raise
         finally:
-            connection.close()
+            self.pool.release(item, discard=discard)
+
+    @contextmanager
+    def session(self, transaction=False):
+        """Run many statements on one connection, optionally in one transaction.
+
+        With ``transaction=True`` everything executed inside the block is
+        committed together when it exits cleanly and rolled back if it
+        raises. Nested ``session()`` calls join the outer unit of work.
+        """
+        current = getattr(self._local, 'session', None)
+        if current is not None:
+            yield current
+            return
+
+        item = self.pool.acquire()
+        session = DatabaseSession(self, item.connection, transaction)
+        discard = False
+        self._local.session = session
+        try:
+            if transaction:
+                item.connection.begin()
+            yield session
+            if transaction:
+                item.connection.commit()
+        except BaseException as exc:
+            if isinstance(exc, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+                discard = True
+            if transaction and not discard:
+                try:
+                    item.connection.rollback()
+                except Exception:
+                    discard = True
+            raise
+        finally:
+            self._local.session = None
+            self.pool.release(item, discard=discard)
+
+        for callback in session._after_commit:
+            callback()
+
+    def _current_session(self):
+        return getattr(self._local, 'session', None)
+
+    def _invalidate_tariff(self, user_id):
+        user_id = int(user_id)
+        self.tariff_cache.invalidate(user_id)
+        session = self._current_session()
+        if session is not None:
+            # A concurrent reader could re-cache the pre-commit row, so drop
+            # the entry again once the transaction is visible.
+            session.on_commit(lambda: self.tariff_cache.invalidate(user_id))
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def ensure_schema(self):
+        """Bring the schema up to date once per process.
+
+        Request handlers call this before touching the database; after the
+        first successful run it is a flag check and issues no statements.
+        """
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            # DDL implicitly commits, so never run it on a caller's session.
+            session = self._current_session()
+            self._local.session = None
+            try:
+                self.run_migrations()
+            finally:
+                self._local.session = session
+            self._schema_ready = True
+
+    def create_schema_migrations_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name VARCHAR(100) PRIMARY KEY,
+            version INT NULL,
+            checksum VARCHAR(64) NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_version (version)
+        )
+        """
+        self._execute(query)
+
+    def _applied_migrations(self):
+        try:
+            rows = self._execute("SELECT name, version, checksum FROM schema_migrations", fetchall=True)
+        except pymysql.err.ProgrammingError as exc:
+            if exc.args and exc.args[0] == 1146:
+                return None
+            raise
+        return {row['name']: row for row in rows}
+
+    def _pending_migrations(self, applied):
+        applied = applied or {}
+        applied_versions = {row['version'] for row in applied.values() if row.get('version') is not None}
+        pending = []
+        for version, name, method in self.MIGRATIONS:
+            if version not in applied_versions:
+                pending.append((name, version, None, method))
+        for name, checksum_method, method in self.REPEATABLE_MIGRATIONS:
+            checksum = getattr(self, checksum_method)()
+            row = applied.get(name)
+            if not row or row.get('checksum') != checksum:
+                pending.append((name, None, checksum, method))
+        return pending
+
+    def run_migrations(self):
+        """Apply pending migrations under a MySQL advisory lock.
+
+        When the schema is current this costs a single SELECT against
+        ``schema_migrations``. Otherwise the runner takes ``GET_LOCK`` on a
+        dedicated connection so concurrent workers wait for one another,
+        re-reads the applied set and runs only what is still missing.
+        """
+        if not self._pending_migrations(self._applied_migrations()):
+            return 0
+
+        lock_connection = self._connect()
+        try:
+            with lock_connection.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, %s) AS acquired", (self.MIGRATION_LOCK_NAME, self.MIGRATION_LOCK_TIMEOUT))
+                row = cursor.fetchone()
+            if not row or row.get('acquired') != 1:
+                raise RuntimeError('Could not acquire schema migration lock')
+            try:
+                applied = self._applied_migrations()
+                if applied is None:
+                    self.create_schema_migrations_table()
+                pending = self._pending_migrations(applied)
+                for name, version, checksum, method in pending:
+                    logging.info(f'Applying schema migration {name}')
+                    getattr(self, method)()
+                    self._execute(
+                        """
+                        INSERT INTO schema_migrations (name, version, checksum)
+                        VALUES (%s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            checksum = VALUES(checksum),
+                            applied_at = CURRENT_TIMESTAMP
+                        """,
+                        (name, version, checksum),
+                    )
+                return len(pending)
+            finally:
+                with lock_connection.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (self.MIGRATION_LOCK_NAME,))
+        finally:
+            lock_connection.close()
+
+    def _migrate_baseline(self):
+        # Existing deployments already have some of these tables and columns;
+        # the create/ensure helpers below tolerate that.
+        self.create_users_table()
+        self.create_payments_table()
+        self.create_user_package_limits_table()
+        self.ensure_payments_package_column()
+        self.create_plus_package_purchases_table()
+        self.ensure_plus_purchase_columns()
+        self.ensure_user_package_limit_defaults()
+        self.ensure_payments_discount_columns()
+        self.create_promo_codes_table()
+        self.create_promo_code_redemptions_table()
+
+    def _promo_codes_checksum(self):
+        payload = json.dumps(PROMO_CODES, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def add_query_observer(self, observer) -> None:
+        """Call ``observer(method, query, params, seconds, error)`` after every query.
+
+        ``method`` is the name of the Database method that issued the query.
+        Observers run on the request thread and must be cheap and must not
+        raise.
+        """
+        self._query_observers.append(observer)
 
     def _execute(self, query, params=None, fetchone=False, fetchall=False):
-        with self._get_connection() as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query, params or ())
-                if cursor.description:
-                    result = cursor.fetchone() if fetchone else cursor.fetchall()
-                    return result
-                return cursor.rowcount
+        started = time.perf_counter()
+        error = None
+        try:
+            with self._get_connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(query, params or ())
+                    if cursor.description:
+                        result = cursor.fetchone() if fetchone else cursor.fetchall()
+                    else:
+                        result = cursor.rowcount
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            if self._query_observers:
+                elapsed = time.perf_counter() - started
+                frame = sys._getframe(1)
+                if frame.f_code is DatabaseSession.execute.__code__:
+                    frame = frame.f_back
+                method = frame.f_code.co_name
+                for observer in self._query_observers:
+                    observer(method, query, params, elapsed, error)
+        session = self._current_session()
+        if session is not None:
+            session.results.append(result)
+        return result
+
+    def stream(self, query, params=None, batch_size=500):
+        """Yield the rows of a SELECT without buffering the result set.
+
+        Rows come from an unbuffered server-side cursor on a connection of
+        its own, opened for this call and closed when the generator is
+        exhausted or closed, so memory stays at one batch however many rows
+        match and a long export neither holds a pool slot nor hands its
+        session settings back to the pool. The connection is outside any
+        ``session()``. Query observers are not called.
+        """
+        connection = self._connect()
+        try:
+            cursor = connection.cursor(SSDictCursor)
+            cursor.execute("SET SESSION net_write_timeout = %s", (self.STREAM_NET_WRITE_TIMEOUT,))
+            cursor.execute(query, params or ())
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # Closing the cursor of an abandoned stream would first read and
+            # drop every remaining row; closing the connection does not.
+            try:
+                connection.close()
+            except Exception:
+                pass
 
     def create_users_table(self):
         query = """
@@ -110,6 +670,33 @@ class Database:
         """
         self._execute(query)
 
+    def _migrate_quota_leases(self):
+        # limits_version changes whenever the package is (re)assigned, so
+        # usage leased against an old package is dropped.
+        if 'limits_version' not in self._table_columns('user_package_limits'):
+            self._execute(
+                "ALTER TABLE user_package_limits ADD COLUMN limits_version INT NOT NULL DEFAULT 0 AFTER voice_used"
+            )
+        self.create_quota_leases_table()
+
+    def create_quota_leases_table(self):
+        # One row per QuotaEngine grant: ``units`` are reserved by the worker
+        # named in ``lease_id`` and not yet written to *_used. Rows are only
+        # reclaimed by other workers once ``expires_at`` has passed, and every
+        # flush by the owner pushes it forward.
+        query = """
+        CREATE TABLE IF NOT EXISTS quota_leases (
+            user_id BIGINT NOT NULL,
+            kind ENUM('text', 'voice') NOT NULL,
+            lease_id VARCHAR(64) NOT NULL,
+            units INT NOT NULL DEFAULT 0,
+            limits_version INT NOT NULL,
+            expires_at DATETIME NOT NULL,
+            PRIMARY KEY (user_id, kind, lease_id)
+        )
+        """
+        self._execute(query)
+
     def create_plus_package_purchases_table(self):
         query = """
         CREATE TABLE IF NOT EXISTS plus_package_purchases (
@@ -290,8 +877,162 @@ class Database:
                         bool(meta.get('is_active', True)),
                     ),
                 )
+                shards = int(meta.get('shards') or 0)
+                if shards > 1:
+                    self.configure_promo_shards(code, shards)
             except Exception as exc:
                 logging.error(f"Promo code seed error ({code}): {exc}")
+        self.promo_codes_snapshot.invalidate()
+
+    def _migrate_promo_reservations(self):
+        self.create_promo_code_counters_table()
+        for table, clause in (
+            ('promo_codes', 'ADD COLUMN counter_shards INT NOT NULL DEFAULT 0 AFTER usage_count'),
+            ('promo_code_redemptions', 'ADD COLUMN counter_shard INT NULL AFTER status'),
+        ):
+            try:
+                self._execute(f"ALTER TABLE {table} {clause}")
+            except Exception as exc:
+                if 'Duplicate column name' in str(exc):
+                    logging.debug(f'{table}: {clause} already applied')
+                else:
+                    raise
+        # usage_count now counts live reservations as well as completed
+        # redemptions. Reservations abandoned long ago are released first so
+        # they do not eat into the limit.
+        self._execute(
+            """
+            UPDATE promo_code_redemptions
+            SET status = 'cancelled'
+            WHERE status = 'reserved' AND created_at < DATE_SUB(NOW(), INTERVAL 1 DAY)
+            """
+        )
+        self._execute(
+            """
+            UPDATE promo_codes p
+            SET usage_count = (
+                SELECT COUNT(*)
+                FROM promo_code_redemptions r
+                WHERE r.code = p.code AND r.status IN ('reserved', 'completed')
+            )
+            """
+        )
+
+    def _table_indexes(self, table):
+        rows = self._execute(
+            """
+            SELECT DISTINCT index_name AS name
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s
+            """,
+            (table,),
+            fetchall=True,
+        ) or []
+        return {row['name'] for row in rows}
+
+    def _table_columns(self, table):
+        rows = self._execute(
+            """
+            SELECT column_name AS name
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s
+            """,
+            (table,),
+            fetchall=True,
+        ) or []
+        return {row['name'] for row in rows}
+
+    def _migrate_payment_indexes(self):
+        # paid_at is the moment a payment counts from. Indexed, so
+        # get_last_payment can order by a column instead of sorting every
+        # payment the user ever made by COALESCE(...). Virtual, so adding it
+        # does not copy the table; InnoDB materialises it in the indexes.
+        # Each table gets a single ALTER.
+        for table, indexes in self.PAYMENT_INDEXES.items():
+            existing = self._table_indexes(table)
+            clauses = []
+            if table == 'payments' and 'paid_at' not in self._table_columns(table):
+                clauses.append(
+                    "ADD COLUMN paid_at TIMESTAMP AS (COALESCE(complete_time, created_at)) VIRTUAL NULL AFTER complete_time"
+                )
+            clauses.extend(
+                f"ADD INDEX {name} {columns}" for name, columns in indexes if name not in existing
+            )
+            if table == 'promo_code_redemptions' and 'idx_merchant_trans_id' in existing:
+                # A prefix of idx_merchant_status, so only extra write cost.
+                clauses.append('DROP INDEX idx_merchant_trans_id')
+            if clauses:
+                self._execute(f"ALTER TABLE {table} {', '.join(clauses)}")
+
+    def _migrate_history_indexes(self):
+        # (user_id, time) plus the implicit trailing id is exactly the keyset
+        # order of get_payment_history and stream_payment_history.
+        for table, ((name, columns), redundant) in self.HISTORY_INDEXES.items():
+            existing = self._table_indexes(table)
+            clauses = []
+            if name not in existing:
+                clauses.append(f"ADD INDEX {name} {columns}")
+            if redundant in existing:
+                clauses.append(f"DROP INDEX {redundant}")
+            if clauses:
+                self._execute(f"ALTER TABLE {table} {', '.join(clauses)}")
+
+    def create_promo_code_counters_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS promo_code_counters (
+            code VARCHAR(64) NOT NULL,
+            shard INT NOT NULL,
+            used INT NOT NULL DEFAULT 0,
+            capacity INT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (code, shard)
+        )
+        """
+        self._execute(query)
+
+    def configure_promo_shards(self, code, shards):
+        """Split a promo code's usage counter across ``shards`` rows.
+
+        Each shard gets an equal slice of ``usage_limit`` as its capacity, so
+        concurrent reservations land on different rows while the sum of
+        capacities still equals the limit. A limited code gets at most
+        ``usage_limit`` shards, so none is left with no capacity; a code with a
+        limit of 1 is not sharded. Existing usage is spread over newly created
+        shards.
+        """
+        code = code.upper()
+        shards = max(2, int(shards))
+        with self.session(transaction=True):
+            promo = self._execute(
+                "SELECT usage_limit, usage_count, counter_shards FROM promo_codes WHERE code = %s FOR UPDATE",
+                (code,),
+                fetchone=True,
+            )
+            if not promo:
+                return
+            limit = int(promo.get('usage_limit') or 0)
+            if limit > 0:
+                shards = min(shards, limit)
+                if shards < 2:
+                    return
+            used = 0 if int(promo.get('counter_shards') or 0) > 1 else int(promo.get('usage_count') or 0)
+            rows = []
+            for shard in range(shards):
+                capacity = 0 if limit <= 0 else limit // shards + (1 if shard < limit % shards else 0)
+                shard_used = used // shards + (1 if shard < used % shards else 0)
+                rows.append((code, shard, shard_used, capacity))
+            query = """
+            INSERT INTO promo_code_counters (code, shard, used, capacity)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE capacity = VALUES(capacity)
+            """
+            for row in rows:
+                self._execute(query, row)
+            self._execute(
+                "DELETE FROM promo_code_counters WHERE code = %s AND shard >= %s AND used = 0",
+                (code, shards),
+            )
+            self._execute("UPDATE promo_codes SET counter_shards = %s WHERE code = %s", (shards, code))
 
     def get_promo_code(self, code):
         query = """
@@ -301,6 +1042,23 @@ class Database:
         """
         return self._execute(query, (code.upper(),), fetchone=True)
 
+    def _load_promo_codes(self):
+        query = """
+        SELECT
+            p.code, p.discount_percent, p.usage_limit, p.plan_type, p.is_active, p.starts_at, p.expires_at,
+            p.counter_shards,
+            IF(p.counter_shards > 1, COALESCE(c.used, 0), p.usage_count) AS usage_count
+        FROM promo_codes p
+        LEFT JOIN (
+            SELECT code, SUM(used) AS used FROM promo_code_counters GROUP BY code
+        ) c ON c.code = p.code
+        """
+        rows = self._execute(query, fetchall=True) or []
+        return {row['code'].upper(): row for row in rows}
+
+    def get_cached_promo_code(self, code):
+        return self.promo_codes_snapshot.get().get(code.upper())
+
     def increment_promo_code_usage(self, code):
         query = """
         UPDATE promo_codes
@@ -310,14 +1068,14 @@ class Database:
         """
         self._execute(query, (code.upper(),))
 
-    def decrement_promo_code_usage(self, code):
+    def decrement_promo_code_usage(self, code, count=1):
         query = """
         UPDATE promo_codes
-        SET usage_count = GREATEST(0, usage_count - 1),
+        SET usage_count = GREATEST(0, usage_count - %s),
             updated_at = CURRENT_TIMESTAMP
         WHERE code = %s
         """
-        self._execute(query, (code.upper(),))
+        self._execute(query, (count, code.upper()))
 
     def upsert_promo_redemption(self, code, user_id, merchant_trans_id, discount_percent, discount_amount):
         query = """
@@ -350,6 +1108,224 @@ class Database:
         """
         self._execute(query, (status, merchant_trans_id))
 
+    def _claim_promo_slot(self, code, shards, enforce_limit=True):
+        """Atomically take one use of ``code``; returns ``(claimed, shard)``.
+
+        The limit check and the increment are one conditional UPDATE, so two
+        checkouts can never both take the last slot. Sharded codes try their
+        shards starting at a random one, which spreads row locks. ``shards``
+        comes from the promo snapshot and may be stale; each UPDATE also
+        checks ``promo_codes.counter_shards``, and a claim that fails is
+        retried once with the count read under the row lock, so every worker
+        claims on the counter the code actually uses.
+        """
+        claimed, shard = self._try_claim_promo_slot(code, shards, enforce_limit)
+        if claimed:
+            return claimed, shard
+        row = self._execute(
+            "SELECT counter_shards FROM promo_codes WHERE code = %s FOR UPDATE",
+            (code,),
+            fetchone=True,
+        )
+        current = int(row.get('counter_shards') or 0) if row else 0
+        if current == shards or (current <= 1 and shards <= 1):
+            return False, None
+        self.promo_codes_snapshot.invalidate()
+        return self._try_claim_promo_slot(code, current, enforce_limit)
+
+    def _try_claim_promo_slot(self, code, shards, enforce_limit):
+        if shards > 1:
+            query = (
+                "UPDATE promo_code_counters AS c JOIN promo_codes AS p ON p.code = c.code "
+                "SET c.used = c.used + 1 "
+                "WHERE c.code = %s AND c.shard = %s AND p.counter_shards = %s"
+            )
+            if enforce_limit:
+                # Deactivating the code in promo_codes stops sharded claims too.
+                # A shard's capacity only means "no limit" when the code has none.
+                query += " AND p.is_active AND (p.usage_limit <= 0 OR c.used < c.capacity)"
+            start = random.randrange(shards)
+            for offset in range(shards):
+                shard = (start + offset) % shards
+                if self._execute(query, (code, shard, shards)) == 1:
+                    return True, shard
+            return False, None
+        query = (
+            "UPDATE promo_codes SET usage_count = usage_count + 1, updated_at = CURRENT_TIMESTAMP "
+            "WHERE code = %s AND counter_shards <= 1"
+        )
+        if enforce_limit:
+            query += " AND is_active AND (usage_limit <= 0 OR usage_count < usage_limit)"
+        return self._execute(query, (code,)) == 1, None
+
+    def _release_promo_slot(self, code, shard, count=1):
+        if shard is not None:
+            self._execute(
+                "UPDATE promo_code_counters SET used = GREATEST(0, used - %s) WHERE code = %s AND shard = %s",
+                (count, code, shard),
+            )
+        else:
+            self.decrement_promo_code_usage(code, count)
+
+    def _promo_shards(self, code):
+        promo = self.get_cached_promo_code(code)
+        return int(promo.get('counter_shards') or 0) if promo else 0
+
+    def reserve_promo_code(self, code, user_id, merchant_trans_id, discount_percent, discount_amount):
+        """Claim one use of ``code`` for a checkout; False once the limit is reached."""
+        code = code.upper()
+        with self.session(transaction=True):
+            existing = self._execute(
+                "SELECT status FROM promo_code_redemptions WHERE code = %s AND merchant_trans_id = %s FOR UPDATE",
+                (code, merchant_trans_id),
+                fetchone=True,
+            )
+            if existing and existing.get('status') in ('reserved', 'completed'):
+                return True
+            claimed, shard = self._claim_promo_slot(code, self._promo_shards(code))
+            if not claimed:
+                self.promo_codes_snapshot.invalidate()
+                return False
+            self._execute(
+                """
+                INSERT INTO promo_code_redemptions (code, user_id, merchant_trans_id, discount_percent, discount_amount, status, counter_shard)
+                VALUES (%s, %s, %s, %s, %s, 'reserved', %s)
+                ON DUPLICATE KEY UPDATE
+                    user_id = VALUES(user_id),
+                    discount_percent = VALUES(discount_percent),
+                    discount_amount = VALUES(discount_amount),
+                    status = 'reserved',
+                    counter_shard = VALUES(counter_shard),
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (code, user_id, merchant_trans_id, discount_percent, discount_amount, shard),
+            )
+            return True
+
+    def complete_promo_reservation(self, code, user_id, merchant_trans_id, discount_percent=0, discount_amount=0):
+        """Mark a reservation redeemed once its payment is confirmed.
+
+        A reservation that was already released (cancelled or expired) is
+        claimed again without the limit check: the user has paid, so the
+        discount is honoured.
+        """
+        code = code.upper()
+        with self.session(transaction=True):
+            row = self._execute(
+                "SELECT status FROM promo_code_redemptions WHERE code = %s AND merchant_trans_id = %s FOR UPDATE",
+                (code, merchant_trans_id),
+                fetchone=True,
+            )
+            status = row.get('status') if row else None
+            if status == 'completed':
+                return
+            if status == 'reserved':
+                self._execute(
+                    "UPDATE promo_code_redemptions SET status = 'completed' WHERE code = %s AND merchant_trans_id = %s",
+                    (code, merchant_trans_id),
+                )
+                return
+            _, shard = self._claim_promo_slot(code, self._promo_shards(code), enforce_limit=False)
+            self._execute(
+                """
+                INSERT INTO promo_code_redemptions (code, user_id, merchant_trans_id, discount_percent, discount_amount, status, counter_shard)
+                VALUES (%s, %s, %s, %s, %s, 'completed', %s)
+                ON DUPLICATE KEY UPDATE
+                    status = 'completed',
+                    counter_shard = VALUES(counter_shard),
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (code, user_id, merchant_trans_id, discount_percent, discount_amount, shard),
+            )
+
+    def release_promo_reservation(self, merchant_trans_id):
+        """Cancel a live reservation and give its use back; idempotent."""
+        with self.session(transaction=True):
+            row = self._execute(
+                """
+                SELECT code, counter_shard
+                FROM promo_code_redemptions
+                WHERE merchant_trans_id = %s AND status = 'reserved'
+                FOR UPDATE
+                """,
+                (merchant_trans_id,),
+                fetchone=True,
+            )
+            if not row:
+                return False
+            self._execute(
+                "UPDATE promo_code_redemptions SET status = 'cancelled' WHERE merchant_trans_id = %s AND status = 'reserved'",
+                (merchant_trans_id,),
+            )
+            self._release_promo_slot(row['code'], row.get('counter_shard'))
+            return True
+
+    def expire_stale_payments(self, older_than_minutes, limit):
+        """Cancel up to ``limit`` pending/prepared payments older than the cutoff.
+
+        One transaction per call: the payments, the revenue_daily rows they
+        now count in and their live promo reservations change together.
+        Rows a checkout or Click callback holds locked are skipped rather
+        than waited for. Returns ``{'payments': n, 'promo_released': m}``.
+        """
+        with self.session(transaction=True):
+            # Served by idx_status_created: two short ranges, no sort.
+            rows = self._execute(
+                """
+                SELECT id, merchant_trans_id
+                FROM payments
+                WHERE status IN ('pending', 'prepared') AND created_at < DATE_SUB(NOW(), INTERVAL %s MINUTE)
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+                """,
+                (older_than_minutes, limit),
+                fetchall=True,
+            ) or []
+            if not rows:
+                return {'payments': 0, 'promo_released': 0}
+
+            ids = [row['id'] for row in rows]
+            id_list = ', '.join(['%s'] * len(ids))
+            self._execute(
+                f"""
+                UPDATE payments
+                SET status = 'cancelled', error_note = 'Expired', complete_time = NOW()
+                WHERE id IN ({id_list})
+                """,
+                ids,
+            )
+            self._execute(self.REVENUE_ADD_QUERY.format(condition=f"id IN ({id_list})"), ids)
+
+            merchant_trans_ids = [row['merchant_trans_id'] for row in rows]
+            merchant_list = ', '.join(['%s'] * len(merchant_trans_ids))
+            reservations = self._execute(
+                f"""
+                SELECT code, counter_shard
+                FROM promo_code_redemptions
+                WHERE merchant_trans_id IN ({merchant_list}) AND status = 'reserved'
+                FOR UPDATE
+                """,
+                merchant_trans_ids,
+                fetchall=True,
+            ) or []
+            if reservations:
+                self._execute(
+                    f"""
+                    UPDATE promo_code_redemptions
+                    SET status = 'cancelled'
+                    WHERE merchant_trans_id IN ({merchant_list}) AND status = 'reserved'
+                    """,
+                    merchant_trans_ids,
+                )
+                released = {}
+                for row in reservations:
+                    key = (row['code'], row.get('counter_shard'))
+                    released[key] = released.get(key, 0) + 1
+                # A fixed order keeps concurrent sweeps off each other's locks.
+                for (code, shard), count in sorted(released.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+                    self._release_promo_slot(code, shard, count)
+            return {'payments': len(rows), 'promo_released': len(reservations)}
+
     def get_redemption_by_merchant_trans_id(self, merchant_trans_id):
         query = """
         SELECT code, discount_percent, discount_amount, status
@@ -411,23 +1387,68 @@ class Database:
             "UPDATE payments SET click_trans_id = %s, status = 'prepared', prepare_time = NOW() "
             "WHERE merchant_trans_id = %s"
         )
-        self._execute(query, (click_trans_id, merchant_trans_id))
+        # A retried payment can be prepared again after it failed; it then
+        # stops counting in revenue_daily until it completes.
+        with self.session(transaction=True):
+            self._execute("SELECT id FROM payments WHERE merchant_trans_id = %s FOR UPDATE", (merchant_trans_id,))
+            self._execute(self.REVENUE_DELTA_QUERY, {'sign': -1, 'merchant_trans_id': merchant_trans_id})
+            self._execute(query, (click_trans_id, merchant_trans_id))
 
     def update_payment_complete(self, merchant_trans_id, status='confirmed', error_code=0, error_note='Success'):
         query = (
             "UPDATE payments SET status = %s, error_code = %s, error_note = %s, complete_time = NOW() "
             "WHERE merchant_trans_id = %s"
         )
-        self._execute(query, (status, error_code, error_note, merchant_trans_id))
+        # The payment leaves the revenue_daily bucket it was counted in and
+        # joins its new one in the same transaction as the status change.
+        with self.session(transaction=True):
+            self._execute("SELECT id FROM payments WHERE merchant_trans_id = %s FOR UPDATE", (merchant_trans_id,))
+            self._execute(self.REVENUE_DELTA_QUERY, {'sign': -1, 'merchant_trans_id': merchant_trans_id})
+            self._execute(query, (status, error_code, error_note, merchant_trans_id))
+            self._execute(self.REVENUE_DELTA_QUERY, {'sign': 1, 'merchant_trans_id': merchant_trans_id})
 
     def get_payment_by_click_trans_id(self, click_trans_id):
         query = "SELECT * FROM payments WHERE click_trans_id = %s"
         return self._execute(query, (click_trans_id,), fetchone=True)
 
-    def get_payment_by_merchant_trans_id(self, merchant_trans_id):
+    def get_payment_by_merchant_trans_id(self, merchant_trans_id, for_update=False):
         query = "SELECT * FROM payments WHERE merchant_trans_id = %s"
+        if for_update:
+            query += " FOR UPDATE"
         return self._execute(query, (merchant_trans_id,), fetchone=True)
 
+    def create_click_callbacks_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS click_callbacks (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            action VARCHAR(16) NOT NULL,
+            click_trans_id VARCHAR(100) NOT NULL,
+            merchant_trans_id VARCHAR(255) NOT NULL,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_action_trans (action, click_trans_id, merchant_trans_id)
+        )
+        """
+        self._execute(query)
+
+    def get_click_callback_response(self, action, click_trans_id, merchant_trans_id):
+        query = """
+        SELECT response
+        FROM click_callbacks
+        WHERE action = %s AND click_trans_id = %s AND merchant_trans_id = %s
+        """
+        row = self._execute(query, (action, click_trans_id, merchant_trans_id), fetchone=True)
+        return json.loads(row['response']) if row else None
+
+    def store_click_callback_response(self, action, click_trans_id, merchant_trans_id, response):
+        """Record the answer to a callback; False if one was stored first."""
+        query = """
+        INSERT INTO click_callbacks (action, click_trans_id, merchant_trans_id, response)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = id
+        """
+        return self._execute(query, (action, click_trans_id, merchant_trans_id, json.dumps(response))) == 1
+
     def assign_user_package(self, user_id, package_code, text_limit, voice_limit):
         text_limit_val = int(text_limit) if text_limit is not None else 0
         voice_limit_val = int(voice_limit) if voice_limit is not None else 0
@@ -440,9 +1461,11 @@ class Database:
             voice_limit = VALUES(voice_limit),
             text_used = 0,
             voice_used = 0,
+            limits_version = limits_version + 1,
             updated_at = CURRENT_TIMESTAMP
         """
         self._execute(query, (user_id, package_code, text_limit_val, voice_limit_val))
+        self._invalidate_tariff(user_id)
 
     def log_package_purchase(
         self,
@@ -495,18 +1518,267 @@ class Database:
         query = "SELECT * FROM user_package_limits WHERE user_id = %s"
         return self._execute(query, (user_id,), fetchone=True)
 
+    def lease_quota(self, lease_id, user_id, kind, units, lease_seconds):
+        """Reserve up to ``units`` of a user's ``kind`` quota for grant ``lease_id``.
+
+        Returns ``{'granted', 'available', 'version'}`` (``available`` is what
+        is left unreserved afterwards), or None when the user has no package.
+        Other grants' leases are reclaimed only once they have expired or
+        belong to a previous package.
+        """
+        with self.session(transaction=True):
+            row = self._execute(
+                f"SELECT {kind}_limit AS quota_limit, {kind}_used AS used, limits_version "
+                "FROM user_package_limits WHERE user_id = %s FOR UPDATE",
+                (user_id,),
+                fetchone=True,
+            )
+            if not row:
+                return None
+            version = row['limits_version']
+            self._execute(
+                """
+                DELETE FROM quota_leases
+                WHERE user_id = %s AND kind = %s AND (expires_at < NOW() OR limits_version <> %s)
+                """,
+                (user_id, kind, version),
+            )
+            leases = self._execute(
+                "SELECT lease_id, units FROM quota_leases WHERE user_id = %s AND kind = %s",
+                (user_id, kind),
+                fetchall=True,
+            ) or []
+            reserved = sum(int(lease['units']) for lease in leases)
+            available = max(0, int(row['quota_limit']) - int(row['used'] or 0) - reserved)
+            granted = min(units, available)
+            if granted or any(lease['lease_id'] == lease_id for lease in leases):
+                self._execute(
+                    """
+                    INSERT INTO quota_leases (user_id, kind, lease_id, units, limits_version, expires_at)
+                    VALUES (%s, %s, %s, %s, %s, DATE_ADD(NOW(), INTERVAL %s SECOND))
+                    ON DUPLICATE KEY UPDATE
+                        units = units + VALUES(units),
+                        expires_at = VALUES(expires_at)
+                    """,
+                    (user_id, kind, lease_id, granted, version, lease_seconds),
+                )
+            return {'granted': granted, 'available': available - granted, 'version': version}
+
+    def flush_quota_usage(self, items, lease_seconds):
+        """Write QuotaEngine usage and renew the grants' leases.
+
+        ``items`` are ``(user_id, kind, lease_id, version, used, released,
+        retire)``: used units move from the lease to *_used, released ones go
+        back, and the lease is deleted when ``retire`` is set or renewed for
+        ``lease_seconds`` otherwise. Usage whose lease was already reclaimed,
+        or whose package was reassigned, is dropped rather than written past
+        the limit. Returns the number of items applied and the lease ids of
+        the dropped ones.
+        """
+        if not items:
+            return 0, []
+        items = sorted(items)
+        user_ids = sorted({item[0] for item in items})
+        keys = ', '.join(['(%s, %s, %s, %s)'] * len(items))
+        key_values = [value for item in items for value in item[:4]]
+        with self.session(transaction=True):
+            # Package rows first, in user_id order, as lease_quota locks them.
+            versions = {
+                row['user_id']: row['limits_version']
+                for row in self._execute(
+                    f"SELECT user_id, limits_version FROM user_package_limits "
+                    f"WHERE user_id IN ({', '.join(['%s'] * len(user_ids))}) ORDER BY user_id FOR UPDATE",
+                    user_ids,
+                    fetchall=True,
+                ) or []
+            }
+            leases = {
+                row['lease_id']: int(row['units'])
+                for row in self._execute(
+                    f"SELECT lease_id, units FROM quota_leases "
+                    f"WHERE (user_id, kind, lease_id, limits_version) IN ({keys}) FOR UPDATE",
+                    key_values,
+                    fetchall=True,
+                ) or []
+            }
+            usage = {}
+            renewed = []
+            applied, dropped = 0, []
+            for user_id, kind, lease_id, version, used, released, retire in items:
+                units = leases.get(lease_id)
+                if units is None or versions.get(user_id) != version:
+                    dropped.append(lease_id)
+                    continue
+                applied += 1
+                counts = usage.setdefault(user_id, {'text': 0, 'voice': 0})
+                counts[kind] += min(used, units)
+                if not retire:
+                    renewed.append((user_id, kind, lease_id, max(0, units - used - released), version))
+            if usage:
+                derived = ' UNION ALL '.join(['SELECT %s AS user_id, %s AS text_used, %s AS voice_used'] * len(usage))
+                self._execute(
+                    f"""
+                    UPDATE user_package_limits AS l
+                    JOIN ({derived}) AS d ON l.user_id = d.user_id
+                    SET l.text_used = l.text_used + d.text_used,
+                        l.voice_used = l.voice_used + d.voice_used
+                    """,
+                    [value for user_id, counts in usage.items() for value in (user_id, counts['text'], counts['voice'])],
+                )
+            # Renewed leases are written back fresh; rows of another package
+            # version under the same lease id are left alone.
+            self._execute(
+                f"DELETE FROM quota_leases WHERE (user_id, kind, lease_id, limits_version) IN ({keys})",
+                key_values,
+            )
+            if renewed:
+                self._execute(
+                    f"""
+                    INSERT INTO quota_leases (user_id, kind, lease_id, units, limits_version, expires_at)
+                    VALUES {', '.join(['(%s, %s, %s, %s, %s, DATE_ADD(NOW(), INTERVAL %s SECOND))'] * len(renewed))}
+                    """,
+                    [value for lease in renewed for value in (*lease, lease_seconds)],
+                )
+        return applied, dropped
+
     def get_last_payment(self, user_id, tariff_code):
+        # Served entirely from idx_user_tariff_status_paid: one backward
+        # index dive, no filesort, no clustered-row lookups.
         query = """
-        SELECT amount, complete_time, created_at
+        SELECT amount, paid_at
         FROM payments
         WHERE user_id = %s AND tariff = %s AND status = 'confirmed'
-        ORDER BY COALESCE(complete_time, created_at) DESC
+        ORDER BY paid_at DESC
         LIMIT 1
         """
         return self._execute(query, (user_id, tariff_code), fetchone=True)
 
+    def get_payment_history(self, user_id, source='payments', limit=20, before=None):
+        """One page of a user's history, newest first.
+
+        ``before`` is the ``(time, id)`` of the last row of the previous page;
+        the next page starts strictly after it in that order.
+        """
+        spec = self.HISTORY_SOURCES[source]
+        time_column = spec['time_column']
+        conditions = ['user_id = %s']
+        params = [user_id]
+        if before is not None:
+            # Spelled out rather than as a row comparison so the range
+            # optimizer uses the (user_id, time, id) index for it.
+            conditions.append(f"({time_column} < %s OR ({time_column} = %s AND id < %s))")
+            params.extend((before[0], before[0], before[1]))
+        query = f"""
+        SELECT {', '.join(spec['columns'])}
+        FROM {spec['table']}
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {time_column} DESC, id DESC
+        LIMIT %s
+        """
+        params.append(limit)
+        return self._execute(query, tuple(params), fetchall=True) or []
+
+    def stream_payment_history(self, user_id, source='payments'):
+        """Every row of a user's history, oldest first, via ``stream()``."""
+        spec = self.HISTORY_SOURCES[source]
+        query = f"""
+        SELECT {', '.join(spec['columns'])}
+        FROM {spec['table']}
+        WHERE user_id = %s
+        ORDER BY {spec['time_column']}, id
+        """
+        return self.stream(query, (user_id,))
+
+    def create_revenue_daily_table(self):
+        # NULL package and promo codes are stored as '' so they can be part
+        # of the primary key.
+        query = """
+        CREATE TABLE IF NOT EXISTS revenue_daily (
+            day DATE NOT NULL,
+            tariff VARCHAR(50) NOT NULL,
+            package_code VARCHAR(50) NOT NULL DEFAULT '',
+            promo_code VARCHAR(50) NOT NULL DEFAULT '',
+            status ENUM('confirmed', 'cancelled', 'failed') NOT NULL,
+            payments INT NOT NULL DEFAULT 0,
+            original_amount DECIMAL(18,2) NOT NULL DEFAULT 0,
+            discount_amount DECIMAL(18,2) NOT NULL DEFAULT 0,
+            amount DECIMAL(18,2) NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (day, tariff, package_code, promo_code, status)
+        )
+        """
+        self._execute(query)
+
+    def _migrate_revenue_daily(self):
+        # Only the empty table: migrations run at boot under the migration
+        # lock, so the backfill is left to `python revenue.py rebuild`.
+        self.create_revenue_daily_table()
+        logging.info("revenue_daily created; backfill it with `python revenue.py rebuild`")
+
+    def rebuild_revenue_daily(self, since=None, until=None, chunk_days=31):
+        """Recompute revenue_daily from payments for days in ``[since, until]``.
+
+        Both bounds are ``date`` objects and default to the first and last
+        day with a payment. Each chunk of ``chunk_days`` is replaced in its
+        own transaction; locking its payments first makes concurrent
+        completions wait and then apply their delta on top of the rebuilt
+        rows. Returns the number of days covered.
+        """
+        if 'idx_paid_at' not in self._table_indexes('payments'):
+            # Lets each chunk read one range of days. Built online, here rather
+            # than at boot.
+            self._execute("ALTER TABLE payments ADD INDEX idx_paid_at (paid_at)")
+        if since is None or until is None:
+            bounds = self._execute(
+                "SELECT DATE(MIN(paid_at)) AS first_day, DATE(MAX(paid_at)) AS last_day FROM payments",
+                fetchone=True,
+            ) or {}
+            since = since or bounds.get('first_day')
+            until = until or bounds.get('last_day')
+        if since is None or until is None or since > until:
+            return 0
+
+        insert_query = self.REVENUE_ADD_QUERY.format(condition="paid_at >= %s AND paid_at < %s")
+        start = since
+        while start <= until:
+            end = min(start + timedelta(days=chunk_days), until + timedelta(days=1))
+            with self.session(transaction=True):
+                # Lock the payments before the rollup rows, in the same order
+                # as update_payment_complete, so the two cannot deadlock.
+                self._execute(
+                    "SELECT COUNT(*) AS total FROM payments WHERE paid_at >= %s AND paid_at < %s LOCK IN SHARE MODE",
+                    (start, end),
+                    fetchone=True,
+                )
+                self._execute("DELETE FROM revenue_daily WHERE day >= %s AND day < %s", (start, end))
+                self._execute(insert_query, (start, end))
+            start = end
+        return (until - since).days + 1
+
+    def revenue_summary(self, since, until, group_by=('day',), status=None):
+        """Sums from revenue_daily for days in ``[since, until]``, grouped by ``group_by``."""
+        dimensions = [dimension for dimension in self.REVENUE_DIMENSIONS if dimension in group_by]
+        conditions = ['day >= %s', 'day <= %s']
+        params = [since, until]
+        if status:
+            conditions.append('status = %s')
+            params.append(status)
+        select = ', '.join(dimensions + [''])
+        group = f"GROUP BY {', '.join(dimensions)} ORDER BY {', '.join(dimensions)}" if dimensions else ''
+        query = f"""
+        SELECT {select}
+            CAST(SUM(payments) AS SIGNED) AS payments,
+            SUM(original_amount) AS original_amount,
+            SUM(discount_amount) AS discount_amount,
+            SUM(amount) AS amount
+        FROM revenue_daily
+        WHERE {' AND '.join(conditions)}
+        {group}
+        """
+        return self._execute(query, tuple(params), fetchall=True) or []
+
     def activate_tariff(self, user_id, tariff, months=1):
-        self.create_users_table()
+        self.ensure_schema()
         query = """
         INSERT INTO users (user_id, tariff, tariff_expires_at)
         VALUES (%s, %s, DATE_ADD(NOW(), INTERVAL %s MONTH))
@@ -516,18 +1788,355 @@ class Database:
             updated_at = CURRENT_TIMESTAMP
         """
         self._execute(query, (user_id, tariff, months))
+        self._invalidate_tariff(user_id)
+
+    def create_payment_jobs_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS payment_jobs (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            kind VARCHAR(50) NOT NULL,
+            dedupe_key VARCHAR(255) NOT NULL,
+            payload TEXT NOT NULL,
+            status ENUM('queued', 'running', 'done', 'failed') NOT NULL DEFAULT 'queued',
+            attempts INT NOT NULL DEFAULT 0,
+            max_attempts INT NOT NULL DEFAULT 8,
+            run_after DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            locked_by VARCHAR(64) NULL,
+            locked_until DATETIME NULL,
+            last_error VARCHAR(500) NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_kind_dedupe (kind, dedupe_key),
+            INDEX idx_status_run_after (status, run_after),
+            INDEX idx_locked_by (locked_by)
+        )
+        """
+        self._execute(query)
+
+    def enqueue_job(self, kind, dedupe_key, payload, max_attempts=8):
+        query = """
+        INSERT INTO payment_jobs (kind, dedupe_key, payload, max_attempts)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = id
+        """
+        inserted = self._execute(query, (kind, dedupe_key, json.dumps(payload, default=str), max_attempts))
+        return inserted == 1
+
+    def claim_job(self, token, lease_seconds):
+        # A job whose lease ran out killed or hung its worker without ever
+        # reaching fail_job; once it has used its attempts it is failed here
+        # rather than picked up again forever.
+        self._execute(
+            """
+            UPDATE payment_jobs
+            SET status = 'failed',
+                locked_by = NULL,
+                locked_until = NULL,
+                last_error = 'Lease expired on the final attempt'
+            WHERE status = 'running' AND locked_until < NOW() AND attempts >= max_attempts
+            """
+        )
+        # Claiming is a single conditional UPDATE, so two workers can never
+        # own the same job; jobs whose lease ran out are picked up again.
+        query = """
+        UPDATE payment_jobs
+        SET status = 'running',
+            locked_by = %s,
+            locked_until = DATE_ADD(NOW(), INTERVAL %s SECOND),
+            attempts = attempts + 1
+        WHERE (status = 'queued' AND run_after <= NOW())
+           OR (status = 'running' AND locked_until < NOW() AND attempts < max_attempts)
+        ORDER BY id
+        LIMIT 1
+        """
+        if not self._execute(query, (token, int(lease_seconds))):
+            return None
+        job = self._execute(
+            "SELECT id, kind, dedupe_key, payload, attempts, max_attempts FROM payment_jobs WHERE locked_by = %s",
+            (token,),
+            fetchone=True,
+        )
+        if job:
+            job['payload'] = json.loads(job['payload'] or '{}')
+        return job
+
+    def complete_job(self, job_id, token):
+        query = """
+        UPDATE payment_jobs
+        SET status = 'done', locked_by = NULL, locked_until = NULL, last_error = NULL
+        WHERE id = %s AND locked_by = %s
+        """
+        self._execute(query, (job_id, token))
+
+    def fail_job(self, job_id, token, error, retry_in):
+        query = """
+        UPDATE payment_jobs
+        SET status = IF(attempts >= max_attempts, 'failed', 'queued'),
+            run_after = DATE_ADD(NOW(), INTERVAL %s SECOND),
+            locked_by = NULL,
+            locked_until = NULL,
+            last_error = %s
+        WHERE id = %s AND locked_by = %s
+        """
+        self._execute(query, (int(retry_in), str(error)[:500], job_id, token))
+
+    def job_queue_depth(self):
+        query = """
+        SELECT status, COUNT(*) AS total
+        FROM payment_jobs
+        WHERE status IN ('queued', 'running', 'failed')
+        GROUP BY status
+        """
+        rows = self._execute(query, fetchall=True) or []
+        depth = {'queued': 0, 'running': 0, 'failed': 0}
+        for row in rows:
+            depth[row['status']] = int(row['total'])
+        return depth
+
+    def create_notification_outbox_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            dedupe_key VARCHAR(255) NOT NULL,
+            chat_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status ENUM('pending', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            locked_by VARCHAR(64) NULL,
+            locked_until DATETIME NULL,
+            last_error VARCHAR(500) NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME NULL,
+            UNIQUE KEY uq_dedupe_key (dedupe_key),
+            INDEX idx_status_next_attempt (status, next_attempt_at),
+            INDEX idx_locked_by (locked_by)
+        )
+        """
+        self._execute(query)
+
+    def enqueue_notification(self, chat_id, text, dedupe_key):
+        query = """
+        INSERT INTO notification_outbox (dedupe_key, chat_id, text)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE id = id
+        """
+        return self._execute(query, (dedupe_key, chat_id, text)) == 1
+
+    def enqueue_notifications(self, items):
+        """Bulk ``enqueue_notification`` for ``(chat_id, text, dedupe_key)`` items.
+
+        Returns how many were new; duplicates of a queued or sent key are
+        ignored.
+        """
+        if not items:
+            return 0
+        values = ', '.join(['(%s, %s, %s)'] * len(items))
+        params = []
+        for chat_id, text, dedupe_key in items:
+            params.extend((dedupe_key, chat_id, text))
+        query = f"""
+        INSERT INTO notification_outbox (dedupe_key, chat_id, text)
+        VALUES {values}
+        ON DUPLICATE KEY UPDATE id = id
+        """
+        return self._execute(query, params)
+
+    def claim_notifications(self, token, limit, lease_seconds):
+        query = """
+        UPDATE notification_outbox
+        SET status = 'sending',
+            locked_by = %s,
+            locked_until = DATE_ADD(NOW(), INTERVAL %s SECOND),
+            attempts = attempts + 1
+        WHERE (status = 'pending' AND next_attempt_at <= NOW())
+           OR (status = 'sending' AND locked_until < NOW())
+        ORDER BY id
+        LIMIT %s
+        """
+        if not self._execute(query, (token, int(lease_seconds), int(limit))):
+            return []
+        return self._execute(
+            "SELECT id, chat_id, text, attempts FROM notification_outbox WHERE locked_by = %s ORDER BY id",
+            (token,),
+            fetchall=True,
+        ) or []
+
+    def mark_notification_sent(self, notification_id, token):
+        query = """
+        UPDATE notification_outbox
+        SET status = 'sent', sent_at = NOW(), locked_by = NULL, locked_until = NULL, last_error = NULL
+        WHERE id = %s AND locked_by = %s
+        """
+        self._execute(query, (notification_id, token))
+
+    def reschedule_notification(self, notification_id, token, error, retry_in, give_up=False):
+        query = """
+        UPDATE notification_outbox
+        SET status = %s,
+            next_attempt_at = DATE_ADD(NOW(), INTERVAL %s SECOND),
+            locked_by = NULL,
+            locked_until = NULL,
+            last_error = %s
+        WHERE id = %s AND locked_by = %s
+        """
+        status = 'failed' if give_up else 'pending'
+        self._execute(query, (status, int(retry_in), str(error)[:500], notification_id, token))
+
+    def notification_outbox_depth(self):
+        query = """
+        SELECT status, COUNT(*) AS total
+        FROM notification_outbox
+        WHERE status IN ('pending', 'sending', 'failed')
+        GROUP BY status
+        """
+        rows = self._execute(query, fetchall=True) or []
+        depth = {'pending': 0, 'sending': 0, 'failed': 0}
+        for row in rows:
+            depth[row['status']] = int(row['total'])
+        return depth
+
+    def create_scheduler_cursors_table(self):
+        # Where a chunked PeriodicTask pass stopped, so whichever process
+        # holds the task's lock next resumes there.
+        query = """
+        CREATE TABLE IF NOT EXISTS scheduler_cursors (
+            name VARCHAR(64) PRIMARY KEY,
+            position BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+        """
+        self._execute(query)
+
+    def get_scheduler_cursor(self, name):
+        row = self._execute("SELECT position FROM scheduler_cursors WHERE name = %s", (name,), fetchone=True)
+        return int(row['position']) if row else 0
+
+    def set_scheduler_cursor(self, name, position):
+        self._execute(
+            """
+            INSERT INTO scheduler_cursors (name, position) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE position = VALUES(position)
+            """,
+            (name, position),
+        )
+
+    def users_chunk_bound(self, after_user_id, size):
+        """Highest user_id among the next ``size`` users after ``after_user_id``; None at the end."""
+        row = self._execute(
+            """
+            SELECT MAX(user_id) AS upper
+            FROM (SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s) AS chunk
+            """,
+            (after_user_id, size),
+            fetchone=True,
+        )
+        return row.get('upper') if row else None
+
+    def tariff_expiry_candidates(self, after_user_id, upper_user_id, remind_days):
+        """Paid users in ``(after, upper]`` whose tariff lapsed or lapses within ``remind_days``."""
+        query = """
+        SELECT user_id, tariff, tariff_expires_at, tariff_expires_at <= NOW() AS expired
+        FROM users
+        WHERE user_id > %s AND user_id <= %s
+            AND tariff <> 'Bepul'
+            AND tariff_expires_at <= DATE_ADD(NOW(), INTERVAL %s DAY)
+        """
+        return self._execute(query, (after_user_id, upper_user_id, remind_days), fetchall=True) or []
+
+    def downgrade_expired_users(self, user_ids):
+        """Move the given users whose tariff has lapsed to Bepul; returns their rows.
+
+        The lapse is re-checked under the row lock, so a renewal that landed
+        after the users were picked is left alone.
+        """
+        if not user_ids:
+            return []
+        id_list = ', '.join(['%s'] * len(user_ids))
+        with self.session(transaction=True):
+            rows = self._execute(
+                f"""
+                SELECT user_id, tariff, tariff_expires_at
+                FROM users
+                WHERE user_id IN ({id_list}) AND tariff <> 'Bepul' AND tariff_expires_at <= NOW()
+                FOR UPDATE
+                """,
+                list(user_ids),
+                fetchall=True,
+            ) or []
+            if not rows:
+                return []
+            locked = [row['user_id'] for row in rows]
+            self._execute(
+                f"UPDATE users SET tariff = 'Bepul' WHERE user_id IN ({', '.join(['%s'] * len(locked))})",
+                locked,
+            )
+            for user_id in locked:
+                self._invalidate_tariff(user_id)
+        return rows
 
     def get_user_tariff(self, user_id):
-        self.create_users_table()
+        self.ensure_schema()
         query = "SELECT tariff, tariff_expires_at FROM users WHERE user_id = %s"
-        row = self._execute(query, (user_id,), fetchone=True)
-        if not row:
-            return {'tariff': 'Bepul', 'expires_at': None}
+        return resolve_tariff(self._execute(query, (user_id,), fetchone=True))
 
-        expires_at = row.get('tariff_expires_at')
-        tariff = row.get('tariff') or 'Bepul'
+    def get_user_tariffs(self, user_ids, chunk_size=500):
+        """``get_user_tariff``, ``get_user_package_limits`` and
+        ``get_last_payment`` for many users at once.
 
-        if expires_at and expires_at <= datetime.now():
-            return {'tariff': 'Bepul', 'expires_at': expires_at}
-
-        return {'tariff': tariff, 'expires_at': expires_at}
+        Returns ``{user_id: (tariff_info, package_info, last_payment)}`` for
+        every requested id, with three ``IN (...)`` queries per
+        ``chunk_size`` users instead of three queries per user.
+        """
+        self.ensure_schema()
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+        result = {}
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            id_list = ', '.join(['%s'] * len(chunk))
+            users = {
+                row['user_id']: row
+                for row in self._execute(
+                    f"SELECT user_id, tariff, tariff_expires_at FROM users WHERE user_id IN ({id_list})",
+                    chunk,
+                    fetchall=True,
+                ) or []
+            }
+            packages = {
+                row['user_id']: row
+                for row in self._execute(
+                    f"SELECT * FROM user_package_limits WHERE user_id IN ({id_list})",
+                    chunk,
+                    fetchall=True,
+                ) or []
+            }
+            tariffs = {user_id: resolve_tariff(users.get(user_id)) for user_id in chunk}
+            keys = [value for user_id in chunk for value in (user_id, tariffs[user_id]['tariff'])]
+            # Each (user_id, tariff) pair is one index dive on
+            # idx_user_tariff_status_paid, as in get_last_payment.
+            payments = {
+                row['user_id']: row
+                for row in self._execute(
+                    f"""
+                    SELECT p.user_id, p.amount, p.paid_at
+                    FROM payments p
+                    JOIN (
+                        SELECT user_id, tariff, MAX(paid_at) AS paid_at
+                        FROM payments
+                        WHERE (user_id, tariff) IN ({', '.join(['(%s, %s)'] * len(chunk))})
+                            AND status = 'confirmed'
+                        GROUP BY user_id, tariff
+                    ) latest
+                        ON p.user_id = latest.user_id AND p.tariff = latest.tariff AND p.paid_at = latest.paid_at
+                    WHERE p.status = 'confirmed'
+                    """,
+                    keys,
+                    fetchall=True,
+                ) or []
+            }
+            for user_id in chunk:
+                payment = payments.get(user_id)
+                if payment is not None:
+                    payment = {'amount': payment['amount'], 'paid_at': payment['paid_at']}
+                result[user_id] = (tariffs[user_id], packages.get(user_id), payment)
+        return result
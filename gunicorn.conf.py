@@ -0,0 +1,26 @@
+"""Gunicorn hooks; picked up automatically when gunicorn starts in this directory.
+
+Each worker process records Prometheus metrics into files under
+``PROMETHEUS_MULTIPROC_DIR`` so ``/metrics`` can report totals across
+workers. The directory is emptied when the master starts and a dead
+worker's live gauges are dropped when it exits.
+"""
+import os
+import shutil
+import tempfile
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'pulbot-metrics'))
+
+
+def on_starting(server):
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
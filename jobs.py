@@ -0,0 +1,176 @@
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
+
+
+class JobQueue:
+    """Bounded pool of worker threads fed by the ``payment_jobs`` table.
+
+    Jobs are persisted before any work starts, claimed with a time-limited
+    lease and retried with exponential backoff, so completions survive worker
+    restarts while the number of threads per process stays fixed. Handlers
+    may run more than once (a lease can expire mid-run) and must therefore be
+    idempotent.
+    """
+
+    def __init__(
+        self,
+        db,
+        workers=2,
+        poll_interval=2.0,
+        lease_seconds=120,
+        max_attempts=8,
+        backoff_base=5.0,
+        backoff_max=900.0,
+        drain_timeout=20.0,
+    ) -> None:
+        self.db = db
+        self.workers = max(0, int(workers))
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.drain_timeout = drain_timeout
+        self._handlers = {}
+        self._observers = []
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._atexit_registered = False
+        self._stats = {
+            'enqueued': 0,
+            'duplicates': 0,
+            'processed': 0,
+            'retried': 0,
+            'busy_workers': 0,
+        }
+
+    def register(self, kind, handler) -> None:
+        self._handlers[kind] = handler
+
+    def add_observer(self, observer) -> None:
+        """Call ``observer(kind, seconds, ok)`` after every handler run."""
+        self._observers.append(observer)
+
+    def enqueue(self, kind, payload, dedupe_key) -> bool:
+        """Persist a job; returns False when ``(kind, dedupe_key)`` already exists."""
+        inserted = self.db.enqueue_job(kind, dedupe_key, payload, max_attempts=self.max_attempts)
+        with self._lock:
+            self._stats['enqueued' if inserted else 'duplicates'] += 1
+        self.start()
+        self._wake.set()
+        return inserted
+
+    def wake(self) -> None:
+        """Nudge idle workers, e.g. after a job was inserted without ``enqueue``."""
+        self._wake.set()
+
+    def start(self) -> None:
+        if not self.workers:
+            return
+        pid = os.getpid()
+        if self._pid == pid and not self._stopping.is_set():
+            return
+        with self._lock:
+            if self._pid == pid and not self._stopping.is_set():
+                return
+            # Threads do not survive fork, so a worker process that inherited
+            # a started queue spins up its own pool.
+            self._pid = pid
+            self._stopping.clear()
+            self._threads = []
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{index}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            if not self._atexit_registered:
+                atexit.register(self.shutdown)
+                self._atexit_registered = True
+
+    def shutdown(self, timeout=None) -> None:
+        """Stop claiming new jobs and wait for in-flight ones to finish.
+
+        Jobs still running when the drain timeout expires keep their lease
+        and are picked up again by the next process once it lapses.
+        """
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wake.set()
+        timeout = self.drain_timeout if timeout is None else timeout
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def _backoff(self, attempts) -> float:
+        return min(self.backoff_max, self.backoff_base * (2 ** max(0, attempts - 1)))
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            token = uuid.uuid4().hex
+            try:
+                job = self.db.claim_job(token, self.lease_seconds)
+            except Exception as err:
+                logging.error(f"Job claim error: {err}")
+                job = None
+            if not job:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._execute(job, token)
+
+    def _execute(self, job, token) -> None:
+        handler = self._handlers.get(job['kind'])
+        with self._lock:
+            self._stats['busy_workers'] += 1
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind {job['kind']}")
+            handler(job['payload'])
+        except Exception as err:
+            self._observe(job['kind'], started, False)
+            retry_in = self._backoff(job['attempts'])
+            logging.error(
+                f"Job {job['kind']}:{job['dedupe_key']} attempt {job['attempts']}/{job['max_attempts']} failed: {err}"
+            )
+            try:
+                self.db.fail_job(job['id'], token, err, retry_in)
+            except Exception as fail_err:
+                logging.error(f"Job failure bookkeeping error: {fail_err}")
+            with self._lock:
+                self._stats['retried'] += 1
+        else:
+            self._observe(job['kind'], started, True)
+            try:
+                self.db.complete_job(job['id'], token)
+            except Exception as done_err:
+                logging.error(f"Job completion bookkeeping error: {done_err}")
+            with self._lock:
+                self._stats['processed'] += 1
+        finally:
+            with self._lock:
+                self._stats['busy_workers'] -= 1
+
+    def _observe(self, kind, started, ok) -> None:
+        elapsed = time.perf_counter() - started
+        for observer in self._observers:
+            observer(kind, elapsed, ok)
+
+    def stats(self, include_depth=False) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = len([thread for thread in self._threads if thread.is_alive()])
+        if include_depth:
+            try:
+                stats['depth'] = self.db.job_queue_depth()
+            except Exception as err:
+                logging.error(f"Job queue depth error: {err}")
+                stats['depth'] = None
+        return stats
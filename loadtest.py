@@ -0,0 +1,396 @@
+"""End-to-end load generator for the Plus checkout and Click callbacks.
+
+Each simulated purchase ("flow") runs the three stages a real payment goes
+through against a live server:
+
+1. ``checkout`` - ``POST /payment-plus`` (expects the 302 to Click)
+2. ``prepare``  - ``POST /api/click/prepare``, MD5-signed with CLICK_SECRET_KEY
+3. ``complete`` - ``POST /api/click/complete``, signed with the prepare id
+
+and the report gives per-stage p50/p95/p99 latency, throughput and error
+rate. Flows are derived from ``--seed`` (user ids, packages, which flows
+Click cancels), so two runs with the same arguments send the same traffic.
+
+The stand-ins live in ``docker-compose.loadtest.yml``: a throwaway MySQL on
+tmpfs, the fake Telegram Bot API below and the app under gunicorn::
+
+    docker compose -f docker-compose.loadtest.yml up -d
+    CLICK_SECRET_KEY=loadtest python loadtest.py run --base-url http://127.0.0.1:8000 \\
+        --flows 2000 --concurrency 32 --seed 1 --output baseline.json
+    # later, on the candidate build:
+    CLICK_SECRET_KEY=loadtest python loadtest.py run ... --compare baseline.json
+
+``--compare`` exits non-zero when a stage's p95/p99 grows or its throughput
+drops by more than ``--tolerance``. The fake Telegram API runs standalone
+with ``python loadtest.py fake-telegram --port 8081``.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from click_api import complete_sign, prepare_sign
+from config import CLICK_SERVICE_ID, PLUS_PACKAGE_SEQUENCE
+from ratelimit import TokenBucket
+
+STAGES = ('checkout', 'prepare', 'complete')
+
+
+class StageRecorder:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._latencies = {stage: [] for stage in STAGES}
+        self._errors = {stage: 0 for stage in STAGES}
+
+    def record(self, stage, seconds, ok) -> None:
+        with self._lock:
+            self._latencies[stage].append(seconds)
+            if not ok:
+                self._errors[stage] += 1
+
+    def summary(self, elapsed) -> dict:
+        with self._lock:
+            result = {}
+            for stage in STAGES:
+                samples = sorted(self._latencies[stage])
+                count = len(samples)
+                errors = self._errors[stage]
+                result[stage] = {
+                    'requests': count,
+                    'errors': errors,
+                    'error_rate': errors / count if count else 0.0,
+                    'throughput_rps': (count - errors) / elapsed if elapsed else 0.0,
+                    'mean_ms': 1000 * sum(samples) / count if count else None,
+                    'p50_ms': _percentile(samples, 50),
+                    'p95_ms': _percentile(samples, 95),
+                    'p99_ms': _percentile(samples, 99),
+                    'max_ms': 1000 * samples[-1] if samples else None,
+                }
+        return result
+
+
+def _percentile(samples, percent):
+    """Nearest-rank percentile of sorted ``samples`` in milliseconds."""
+    if not samples:
+        return None
+    rank = max(1, -(-percent * len(samples) // 100))
+    return 1000 * samples[int(rank) - 1]
+
+
+def plan_flows(count, seed, user_base, cancel_rate) -> list:
+    rng = random.Random(seed)
+    return [
+        {
+            # One user per flow: merchant_trans_id is only unique per
+            # (user, package, second).
+            'user_id': user_base + index,
+            'package_code': rng.choice(PLUS_PACKAGE_SEQUENCE),
+            'cancel': rng.random() < cancel_rate,
+        }
+        for index in range(count)
+    ]
+
+
+class FlowRunner:
+    def __init__(self, base_url, service_id, timeout=15.0) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.service_id = service_id
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _http(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _post(self, recorder, stage, path, data, check):
+        started = time.perf_counter()
+        try:
+            response = self._http().post(
+                f"{self.base_url}{path}", data=data, timeout=self.timeout, allow_redirects=False
+            )
+            ok = check(response)
+        except requests.RequestException:
+            response, ok = None, False
+        if recorder is not None:
+            recorder.record(stage, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    def run(self, flow, recorder) -> bool:
+        response = self._post(
+            recorder,
+            'checkout',
+            '/payment-plus',
+            {'user_id': flow['user_id'], 'package_code': flow['package_code'], 'payment_method': 'click'},
+            lambda r: r.status_code == 302,
+        )
+        if response is None:
+            return False
+        query = parse_qs(urlsplit(response.headers['Location']).query)
+        merchant_trans_id = query['transaction_param'][0]
+        amount = query['amount'][0]
+        click_trans_id = str(random.Random(merchant_trans_id).randrange(10 ** 9, 10 ** 10))
+        sign_time = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        params = {
+            'click_trans_id': click_trans_id,
+            'service_id': self.service_id,
+            'merchant_trans_id': merchant_trans_id,
+            'amount': amount,
+            'action': '0',
+            'sign_time': sign_time,
+        }
+        params['sign_string'] = prepare_sign(params, merchant_trans_id)
+        response = self._post(
+            recorder, 'prepare', '/api/click/prepare', params,
+            lambda r: r.status_code == 200 and r.json().get('error') == 0,
+        )
+        if response is None:
+            return False
+
+        params = {
+            'click_trans_id': click_trans_id,
+            'service_id': self.service_id,
+            'merchant_trans_id': merchant_trans_id,
+            'merchant_prepare_id': str(response.json()['merchant_prepare_id']),
+            'amount': amount,
+            'action': '1',
+            'error': '-5017' if flow['cancel'] else '0',
+            'sign_time': sign_time,
+        }
+        params['sign_string'] = complete_sign(params, merchant_trans_id)
+        expected = -5017 if flow['cancel'] else 0
+        response = self._post(
+            recorder, 'complete', '/api/click/complete', params,
+            lambda r: r.status_code == 200 and r.json().get('error') == expected,
+        )
+        return response is not None
+
+
+def _drive(runner, flows, recorder, concurrency, rate):
+    bucket = TokenBucket(rate, capacity=1) if rate else None
+
+    def one(flow):
+        if bucket is not None:
+            bucket.acquire()
+        return runner.run(flow, recorder)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return sum(pool.map(one, flows))
+
+
+def _environment() -> dict:
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'git_revision': revision, 'python': platform.python_version(), 'host': platform.node()}
+
+
+def run(args) -> dict:
+    flows = plan_flows(args.warmup + args.flows, args.seed, args.user_base, args.cancel_rate)
+    runner = FlowRunner(args.base_url, args.service_id, timeout=args.timeout)
+
+    if args.warmup:
+        _drive(runner, flows[:args.warmup], None, args.concurrency, args.rate)
+
+    telegram_before = _telegram_count(args.telegram_url)
+    recorder = StageRecorder()
+    started = time.perf_counter()
+    completed = _drive(runner, flows[args.warmup:], recorder, args.concurrency, args.rate)
+    elapsed = time.perf_counter() - started
+
+    report = {
+        'config': {
+            'base_url': args.base_url,
+            'flows': args.flows,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'seed': args.seed,
+            'cancel_rate': args.cancel_rate,
+        },
+        'environment': _environment(),
+        'elapsed_seconds': elapsed,
+        'flows_completed': completed,
+        'flows_per_second': completed / elapsed if elapsed else 0.0,
+        'stages': recorder.summary(elapsed),
+    }
+    if args.telegram_url:
+        # Notifications are sent by background jobs; give them a moment.
+        time.sleep(args.settle)
+        report['telegram_messages'] = _telegram_count(args.telegram_url) - telegram_before
+    return report
+
+
+def _telegram_count(url):
+    if not url:
+        return 0
+    try:
+        return requests.get(f"{url.rstrip('/')}/stats", timeout=5).json()['messages']
+    except (requests.RequestException, ValueError, KeyError):
+        return 0
+
+
+def compare(report, baseline, tolerance) -> list:
+    regressions = []
+    for stage in STAGES:
+        current, previous = report['stages'][stage], baseline['stages'][stage]
+        for key in ('p95_ms', 'p99_ms'):
+            if current[key] and previous[key] and current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{stage} {key}: {previous[key]:.1f} -> {current[key]:.1f}")
+        if previous['throughput_rps'] and current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(
+                f"{stage} throughput_rps: {previous['throughput_rps']:.1f} -> {current['throughput_rps']:.1f}"
+            )
+        if current['error_rate'] > previous['error_rate'] + 0.001:
+            regressions.append(f"{stage} error_rate: {previous['error_rate']:.4f} -> {current['error_rate']:.4f}")
+    return regressions
+
+
+def print_report(report) -> None:
+    print(
+        f"{report['flows_completed']}/{report['config']['flows']} flows in {report['elapsed_seconds']:.1f}s "
+        f"({report['flows_per_second']:.1f} flows/s)"
+    )
+    print(f"{'stage':<10}{'req':>8}{'err%':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for stage in STAGES:
+        row = report['stages'][stage]
+        cells = [row[key] if row[key] is not None else float('nan') for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms')]
+        print(
+            f"{stage:<10}{row['requests']:>8}{100 * row['error_rate']:>8.2f}{row['throughput_rps']:>9.1f}"
+            + ''.join(f"{value:>9.1f}" for value in cells)
+        )
+    if 'telegram_messages' in report:
+        print(f"telegram messages received: {report['telegram_messages']}")
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Answers ``sendMessage`` like the Bot API, optionally slow or throttled."""
+
+    server_version = 'FakeTelegram/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.server.lock:
+                self._reply(200, {'messages': self.server.messages, 'throttled': self.server.throttled})
+        else:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.endswith('/sendMessage'):
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+            throttle = self.server.throttle_every and self.server.requests % self.server.throttle_every == 0
+            if throttle:
+                self.server.throttled += 1
+            else:
+                self.server.messages += 1
+                message_id = self.server.messages
+        if throttle:
+            self._reply(429, {
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            })
+            return
+        self._reply(200, {
+            'ok': True,
+            'result': {'message_id': message_id, 'chat': {'id': payload.get('chat_id')}, 'text': payload.get('text')},
+        })
+
+
+def fake_telegram(args) -> None:
+    server = ThreadingHTTPServer((args.host, args.port), FakeTelegramHandler)
+    server.lock = threading.Lock()
+    server.latency = args.latency / 1000.0
+    server.throttle_every = args.throttle_every
+    server.requests = server.messages = server.throttled = 0
+    print(f"Fake Telegram Bot API on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='drive checkout -> prepare -> complete flows')
+    run_parser.add_argument('--base-url', default=os.getenv('LOADTEST_BASE_URL', 'http://127.0.0.1:8000'))
+    run_parser.add_argument('--service-id', default=CLICK_SERVICE_ID or '1')
+    run_parser.add_argument('--flows', type=int, default=1000)
+    run_parser.add_argument('--warmup', type=int, default=50, help='flows run first and left out of the report')
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--rate', type=float, default=0, help='cap on flows started per second (0 = closed loop)')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--user-base', type=int, default=900_000_000)
+    run_parser.add_argument('--cancel-rate', type=float, default=0.05, help='share of flows Click cancels')
+    run_parser.add_argument('--timeout', type=float, default=15.0)
+    run_parser.add_argument('--telegram-url', default=None, help='fake Telegram API to count delivered messages')
+    run_parser.add_argument('--settle', type=float, default=5.0)
+    run_parser.add_argument('--output', help='write the JSON report here')
+    run_parser.add_argument('--compare', help='baseline JSON report to check for regressions')
+    run_parser.add_argument('--tolerance', type=float, default=0.15)
+
+    fake_parser = commands.add_parser('fake-telegram', help='serve a local stand-in for the Bot API')
+    fake_parser.add_argument('--host', default='0.0.0.0')
+    fake_parser.add_argument('--port', type=int, default=8081)
+    fake_parser.add_argument('--latency', type=float, default=30.0, help='milliseconds per sendMessage')
+    fake_parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth call with 429')
+
+    args = parser.parse_args(argv)
+    if args.command == 'fake-telegram':
+        fake_telegram(args)
+        return 0
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            json.dump(report, handle, indent=2)
+            handle.write('\n')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as handle:
+            regressions = compare(report, json.load(handle), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
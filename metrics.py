@@ -0,0 +1,204 @@
+import hmac
+import logging
+import os
+import time
+
+from flask import Response, abort, g, request
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+except ImportError:  # Metrics are optional; without the client /metrics is not served.
+    prometheus_client = None
+
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+JOB_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _multiprocess_dir():
+    return os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir')
+
+
+class Metrics:
+    """Prometheus instrumentation served on ``/metrics``.
+
+    Records per-endpoint request latency and status counts, per-method
+    ``Database`` query latency and errors, payment job run times, Telegram
+    send latency, compressed response bytes, and thread/queue gauges. Under gunicorn every worker writes
+    to ``PROMETHEUS_MULTIPROC_DIR`` (set up by ``gunicorn.conf.py``) and a
+    scrape of any worker returns the totals of all of them.
+    """
+
+    def __init__(
+        self,
+        app=None,
+        db=None,
+        job_queue=None,
+        notifier=None,
+        compression=None,
+        token='',
+        gauge_interval=5.0,
+    ) -> None:
+        self.db = db
+        self.job_queue = job_queue
+        self.notifier = notifier
+        self.compression = compression
+        self.token = token
+        self.gauge_interval = gauge_interval
+        self._gauges_updated = 0.0
+        self.enabled = prometheus_client is not None
+        if self.enabled:
+            self._create_metrics()
+        if app is not None:
+            self.init_app(app)
+
+    def _create_metrics(self) -> None:
+        self.registry = CollectorRegistry(auto_describe=True)
+        registry = self.registry
+        self.http_latency = Histogram(
+            'pulbot_http_request_duration_seconds', 'Flask request latency.',
+            ['endpoint', 'method'], registry=registry,
+        )
+        self.http_requests = Counter(
+            'pulbot_http_requests_total', 'Flask responses by status code.',
+            ['endpoint', 'method', 'status'], registry=registry,
+        )
+        self.db_latency = Histogram(
+            'pulbot_db_query_duration_seconds', 'Database._execute latency by calling method.',
+            ['method'], buckets=DB_BUCKETS, registry=registry,
+        )
+        self.db_errors = Counter(
+            'pulbot_db_query_errors_total', 'Database._execute errors by calling method.',
+            ['method', 'error'], registry=registry,
+        )
+        self.job_latency = Histogram(
+            'pulbot_job_duration_seconds', 'Payment job handler run time.',
+            ['kind'], buckets=JOB_BUCKETS, registry=registry,
+        )
+        self.jobs = Counter(
+            'pulbot_jobs_total', 'Payment job handler runs by outcome.',
+            ['kind', 'outcome'], registry=registry,
+        )
+        self.telegram_latency = Histogram(
+            'pulbot_telegram_send_duration_seconds', 'Telegram sendMessage latency.',
+            registry=registry,
+        )
+        self.telegram_sends = Counter(
+            'pulbot_telegram_sends_total', 'Telegram sendMessage calls by HTTP status.',
+            ['status'], registry=registry,
+        )
+        # Ratio per endpoint: rate(out) / rate(in).
+        self.compression_bytes_in = Counter(
+            'pulbot_compression_bytes_in_total', 'Response bytes before compression.',
+            ['endpoint', 'encoding'], registry=registry,
+        )
+        self.compression_bytes_out = Counter(
+            'pulbot_compression_bytes_out_total', 'Response bytes after compression.',
+            ['endpoint', 'encoding'], registry=registry,
+        )
+        self.job_workers = Gauge(
+            'pulbot_job_workers', 'Job worker threads by state.',
+            ['state'], multiprocess_mode='livesum', registry=registry,
+        )
+        self.notifier_leader = Gauge(
+            'pulbot_notifier_leader', 'Processes currently holding the Telegram dispatcher lock.',
+            multiprocess_mode='livesum', registry=registry,
+        )
+        self.db_pool = Gauge(
+            'pulbot_db_pool_connections', 'Pooled database connections by state.',
+            ['state'], multiprocess_mode='livesum', registry=registry,
+        )
+        self.job_queue_depth = Gauge(
+            'pulbot_job_queue_depth', 'payment_jobs rows by status.',
+            ['status'], multiprocess_mode='mostrecent', registry=registry,
+        )
+        self.outbox_depth = Gauge(
+            'pulbot_notification_outbox_depth', 'notification_outbox rows by status.',
+            ['status'], multiprocess_mode='mostrecent', registry=registry,
+        )
+
+    def init_app(self, app) -> None:
+        app.extensions['metrics'] = self
+        if not self.enabled:
+            logging.warning("prometheus_client is not installed; /metrics is disabled")
+            return
+        app.before_request(self._start_timer)
+        app.after_request(self._record_request)
+        app.add_url_rule('/metrics', 'metrics', self._serve)
+        if self.db is not None:
+            self.db.add_query_observer(self._record_query)
+        if self.job_queue is not None:
+            self.job_queue.add_observer(self._record_job)
+        if self.notifier is not None:
+            self.notifier.add_send_observer(self._record_send)
+        if self.compression is not None:
+            self.compression.add_observer(self._record_compression)
+
+    def _start_timer(self) -> None:
+        g._metrics_started = time.perf_counter()
+        now = time.monotonic()
+        if now - self._gauges_updated >= self.gauge_interval:
+            self._gauges_updated = now
+            self._update_process_gauges()
+
+    def _record_request(self, response):
+        started = g.pop('_metrics_started', None)
+        endpoint = request.endpoint or 'unmatched'
+        if started is not None:
+            self.http_latency.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        self.http_requests.labels(endpoint, request.method, str(response.status_code)).inc()
+        return response
+
+    def _record_query(self, method, query, params, seconds, error) -> None:
+        self.db_latency.labels(method).observe(seconds)
+        if error is not None:
+            self.db_errors.labels(method, type(error).__name__).inc()
+
+    def _record_job(self, kind, seconds, ok) -> None:
+        self.job_latency.labels(kind).observe(seconds)
+        self.jobs.labels(kind, 'ok' if ok else 'error').inc()
+
+    def _record_send(self, status, seconds) -> None:
+        self.telegram_latency.observe(seconds)
+        self.telegram_sends.labels(str(status)).inc()
+
+    def _record_compression(self, endpoint, encoding, size_in, size_out) -> None:
+        self.compression_bytes_in.labels(endpoint, encoding).inc(size_in)
+        self.compression_bytes_out.labels(endpoint, encoding).inc(size_out)
+
+    def _update_process_gauges(self) -> None:
+        if self.job_queue is not None:
+            stats = self.job_queue.stats()
+            self.job_workers.labels('alive').set(stats['workers'])
+            self.job_workers.labels('busy').set(stats['busy_workers'])
+        if self.notifier is not None:
+            self.notifier_leader.set(self.notifier.stats()['leader'])
+        if self.db is not None:
+            pool = self.db.pool_stats()
+            self.db_pool.labels('in_use').set(pool['in_use'])
+            self.db_pool.labels('idle').set(pool['idle'])
+
+    def _update_depth_gauges(self) -> None:
+        # Table-wide numbers: one query each, only when scraped.
+        try:
+            for status, total in self.db.job_queue_depth().items():
+                self.job_queue_depth.labels(status).set(total)
+            for status, total in self.db.notification_outbox_depth().items():
+                self.outbox_depth.labels(status).set(total)
+        except Exception as err:
+            logging.error(f"Metrics depth query error: {err}")
+
+    def _serve(self):
+        if self.token:
+            provided = request.args.get('token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not hmac.compare_digest(provided, self.token):
+                return abort(404)
+        self._update_process_gauges()
+        if self.db is not None:
+            self._update_depth_gauges()
+        if _multiprocess_dir():
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = self.registry
+        return Response(prometheus_client.generate_latest(registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
@@ -0,0 +1,393 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:  # Only the asyncio entry point (async_app.py) needs it.
+    aiohttp = None
+
+from ratelimit import TokenBucket
+
+
+def build_payment_message(payload: dict) -> str:
+    display_tariff = 'Max' if payload['tariff'] == 'PRO' else payload['tariff']
+    message = (
+        f"✅ To'lov {int(payload['amount']):,} so'm muvaffaqiyatli amalga oshirildi!\n\n"
+        f"Tarifingiz faollashtirildi: {display_tariff}"
+    )
+    package_info = payload.get('package')
+    if package_info:
+        message += (
+            f"\nPaket: {package_info.get('title', payload.get('package_code'))} "
+            f"({package_info.get('text_limit', 0)} ta matn / {package_info.get('voice_limit', 0)} ta ovoz)"
+        )
+    return message
+
+
+def build_expiry_message(tariff, expires_at, expired) -> str:
+    display_tariff = 'Max' if tariff == 'PRO' else tariff
+    if expired:
+        return (
+            f"⌛️ {display_tariff} tarifingiz muddati tugadi, endi Bepul tarifdasiz.\n\n"
+            f"Imkoniyatlarni qaytarish uchun tarifni qayta faollashtiring."
+        )
+    return (
+        f"⏳ {display_tariff} tarifingiz {expires_at:%d.%m.%Y %H:%M} da tugaydi.\n\n"
+        f"Uzilishsiz foydalanish uchun tarifni oldindan uzaytiring."
+    )
+
+
+class TelegramDispatcher:
+    """Drains ``notification_outbox`` into the Telegram Bot API.
+
+    Messages are written to the outbox in the same transaction as the change
+    they announce; this dispatcher sends them over one keep-alive HTTP
+    session, paced by a token bucket, retrying 429 and 5xx responses with
+    backoff. Only one process per database sends at a time: the dispatcher
+    holds a MySQL advisory lock, so the bot-wide rate limit is respected no
+    matter how many gunicorn workers run.
+    """
+
+    LOCK_NAME = 'pulbot_notification_dispatcher'
+
+    def __init__(
+        self,
+        db,
+        bot_token,
+        api_url='https://api.telegram.org',
+        rate=25.0,
+        batch_size=50,
+        poll_interval=1.0,
+        max_attempts=10,
+        backoff_base=2.0,
+        backoff_max=600.0,
+        enabled=True,
+    ) -> None:
+        self.db = db
+        self.bot_token = bot_token
+        self.api_url = api_url.rstrip('/')
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.enabled = enabled
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self._session = None
+        self._lock_connection = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._atexit_registered = False
+        self._send_observers = []
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+            'rate_limited': 0,
+            'leader': 0,
+        }
+
+    def _count(self, key, amount=1) -> None:
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def add_send_observer(self, observer) -> None:
+        """Call ``observer(status, seconds)`` after every Bot API request.
+
+        ``status`` is the HTTP status code, or ``'error'`` when no response
+        arrived.
+        """
+        self._send_observers.append(observer)
+
+    def _observe_send(self, status, started) -> None:
+        elapsed = time.perf_counter() - started
+        for observer in self._send_observers:
+            observer(status, elapsed)
+
+    def _http(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+
+    def start(self) -> None:
+        if not (self.enabled and self.bot_token):
+            return
+        pid = os.getpid()
+        if self._pid == pid and not self._stopping.is_set():
+            return
+        with self._start_lock:
+            if self._pid == pid and not self._stopping.is_set():
+                return
+            self._pid = pid
+            self._stopping.clear()
+            self._session = None
+            self._lock_connection = None
+            self._thread = threading.Thread(target=self._run, name='telegram-dispatcher', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.shutdown)
+                self._atexit_registered = True
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def shutdown(self, timeout=10.0) -> None:
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._release_leadership()
+        self._pid = None
+
+    def _hold_leadership(self) -> bool:
+        connection = self._lock_connection
+        if connection is not None:
+            try:
+                connection.ping(reconnect=False)
+                return True
+            except Exception:
+                # The server drops advisory locks together with the session.
+                self._release_leadership()
+        try:
+            connection = self.db._connect()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, 0) AS acquired", (self.LOCK_NAME,))
+                row = cursor.fetchone()
+        except Exception as err:
+            logging.debug(f"Notification dispatcher lock error: {err}")
+            return False
+        if row and row.get('acquired') == 1:
+            self._lock_connection = connection
+            with self._stats_lock:
+                self._stats['leader'] = 1
+            return True
+        connection.close()
+        return False
+
+    def _release_leadership(self) -> None:
+        connection, self._lock_connection = self._lock_connection, None
+        with self._stats_lock:
+            self._stats['leader'] = 0
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            if not self._hold_leadership():
+                self._stopping.wait(max(self.poll_interval, 5.0))
+                continue
+            token = uuid.uuid4().hex
+            try:
+                batch = self.db.claim_notifications(token, self.batch_size, self._lease_seconds())
+            except Exception as err:
+                logging.error(f"Notification claim error: {err}")
+                batch = []
+            if not batch:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            for message in batch:
+                if not self.bucket.acquire(stop_event=self._stopping):
+                    # Unsent messages keep their lease and are reclaimed later.
+                    return
+                self._deliver(message, token)
+
+    def _lease_seconds(self) -> int:
+        return max(30, int(self.batch_size / max(self.bucket.rate, 0.1)) * 2 + 30)
+
+    def _backoff(self, attempts) -> float:
+        return min(self.backoff_max, self.backoff_base * (2 ** max(0, attempts - 1)))
+
+    def _send_url(self) -> str:
+        return f"{self.api_url}/bot{self.bot_token}/sendMessage"
+
+    def _deliver(self, message, token) -> None:
+        started = time.perf_counter()
+        try:
+            response = self._http().post(
+                self._send_url(),
+                json={'chat_id': message['chat_id'], 'text': message['text']},
+                timeout=10,
+            )
+        except requests.RequestException as err:
+            self._observe_send('error', started)
+            self._send_failed(message, token, err)
+            return
+        self._observe_send(response.status_code, started)
+        self._handle_response(message, token, response.status_code, response.text)
+
+    def _send_failed(self, message, token, error) -> None:
+        attempts = int(message.get('attempts') or 1)
+        self._reschedule(message, token, error, self._backoff(attempts), attempts >= self.max_attempts)
+
+    def _handle_response(self, message, token, status, body) -> None:
+        attempts = int(message.get('attempts') or 1)
+        give_up = attempts >= self.max_attempts
+
+        if status == 200:
+            try:
+                self.db.mark_notification_sent(message['id'], token)
+            except Exception as err:
+                logging.error(f"Notification ack error: {err}")
+            self._count('sent')
+            return
+
+        if status == 429:
+            retry_after = 1
+            try:
+                retry_after = int(json.loads(body).get('parameters', {}).get('retry_after') or 1)
+            except (ValueError, AttributeError):
+                pass
+            self._count('rate_limited')
+            self.bucket.pause(retry_after)
+            self._reschedule(message, token, 'HTTP 429', retry_after, give_up)
+            return
+
+        if status >= 500:
+            self._reschedule(message, token, f"HTTP {status}", self._backoff(attempts), give_up)
+            return
+
+        # 400/403 (blocked bot, unknown chat) will never succeed on retry.
+        self._reschedule(message, token, f"HTTP {status}: {body[:200]}", 0, True)
+
+    def _reschedule(self, message, token, error, retry_in, give_up) -> None:
+        logging.warning(f"Telegram notification {message['id']} not delivered: {error}")
+        self._count('failed' if give_up else 'retried')
+        try:
+            self.db.reschedule_notification(message['id'], token, error, retry_in, give_up=give_up)
+        except Exception as err:
+            logging.error(f"Notification reschedule error: {err}")
+
+    def stats(self, include_depth=False) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        if include_depth:
+            try:
+                stats['depth'] = self.db.notification_outbox_depth()
+            except Exception as err:
+                logging.error(f"Notification outbox depth error: {err}")
+                stats['depth'] = None
+        return stats
+
+
+class AsyncTelegramDispatcher(TelegramDispatcher):
+    """``TelegramDispatcher`` running as a task on an asyncio event loop.
+
+    Leadership, outbox claims, acks and retry rules are the synchronous
+    dispatcher's (database calls go to the default executor); only the Bot
+    API requests move onto one ``aiohttp`` session, so a slow Telegram never
+    ties up a thread. Start it from the loop with ``start_async``.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._loop = None
+        self._task = None
+        self._client = None
+        self._wake_async = None
+
+    def start(self) -> None:
+        # The thread-based start would race the event-loop task for the lock.
+        pass
+
+    async def start_async(self) -> None:
+        if not (self.enabled and self.bot_token) or self._task is not None:
+            return
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for AsyncTelegramDispatcher")
+        self._loop = asyncio.get_running_loop()
+        self._wake_async = asyncio.Event()
+        self._stopping.clear()
+        self._client = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        self._task = self._loop.create_task(self._run_async())
+
+    def wake(self) -> None:
+        # Called from job worker threads as well as from the loop itself.
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake_async.set)
+
+    async def shutdown_async(self, timeout=10.0) -> None:
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._wake_async.set()
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            pass
+        await self._client.close()
+        await self._loop.run_in_executor(None, self._release_leadership)
+        self._task = None
+        self._loop = None
+
+    async def _idle(self, seconds) -> None:
+        try:
+            await asyncio.wait_for(self._wake_async.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        self._wake_async.clear()
+
+    async def _run_async(self) -> None:
+        loop = self._loop
+        while not self._stopping.is_set():
+            if not await loop.run_in_executor(None, self._hold_leadership):
+                await self._idle(max(self.poll_interval, 5.0))
+                continue
+            token = uuid.uuid4().hex
+            try:
+                batch = await loop.run_in_executor(
+                    None, self.db.claim_notifications, token, self.batch_size, self._lease_seconds()
+                )
+            except Exception as err:
+                logging.error(f"Notification claim error: {err}")
+                batch = []
+            if not batch:
+                await self._idle(self.poll_interval)
+                continue
+            for message in batch:
+                wait = self.bucket.try_acquire()
+                while wait > 0:
+                    if self._stopping.is_set():
+                        # Unsent messages keep their lease and are reclaimed later.
+                        return
+                    await asyncio.sleep(wait)
+                    wait = self.bucket.try_acquire()
+                await self._deliver_async(message, token)
+
+    async def _deliver_async(self, message, token) -> None:
+        started = time.perf_counter()
+        try:
+            async with self._client.post(
+                self._send_url(),
+                json={'chat_id': message['chat_id'], 'text': message['text']},
+            ) as response:
+                status, body = response.status, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            self._observe_send('error', started)
+            await self._loop.run_in_executor(None, self._send_failed, message, token, err)
+            return
+        self._observe_send(status, started)
+        await self._loop.run_in_executor(None, self._handle_response, message, token, status, body)
@@ -0,0 +1,107 @@
+import gzip
+import hashlib
+import threading
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available.
+    brotli = None
+
+
+class RenderedPage:
+    __slots__ = ('version', 'bodies', 'etags')
+
+    def __init__(self, version, html) -> None:
+        identity = html.encode('utf-8')
+        digest = hashlib.sha256(identity).hexdigest()[:32]
+        self.version = version
+        self.bodies = {
+            'identity': identity,
+            'gzip': gzip.compress(identity, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(identity, quality=11, mode=brotli.MODE_TEXT)
+        # A strong ETag identifies one exact byte sequence, so every encoded
+        # variant carries its own tag.
+        self.etags = {
+            encoding: digest if encoding == 'identity' else f'{digest}-{encoding}'
+            for encoding in self.bodies
+        }
+
+
+class PageCache:
+    """Rendered HTML pages kept in memory together with gzip/brotli variants.
+
+    Pages must not depend on the request; they are rendered once per
+    ``version`` (for example a fingerprint of the catalog they display) and
+    then served with strong ETags, answering ``If-None-Match`` with 304.
+    Concurrent requests for a page that is not rendered yet wait for one
+    render instead of each compressing their own copy.
+    """
+
+    def __init__(self, cache_control='no-cache') -> None:
+        self.cache_control = cache_control
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self._stats = {
+            'renders': 0,
+            'hits': 0,
+            'not_modified': 0,
+        }
+
+    def _page(self, name, version, render):
+        with self._lock:
+            page = self._pages.get(name)
+            if page is not None and page.version == version:
+                self._stats['hits'] += 1
+                return page
+        with self._render_lock:
+            with self._lock:
+                page = self._pages.get(name)
+                if page is not None and page.version == version:
+                    self._stats['hits'] += 1
+                    return page
+            page = RenderedPage(version, render())
+            with self._lock:
+                self._pages[name] = page
+                self._stats['renders'] += 1
+        return page
+
+    @staticmethod
+    def _negotiate(page) -> str:
+        accepted = request.accept_encodings
+        best, best_quality = 'identity', 0
+        for encoding in ('br', 'gzip'):
+            quality = accepted[encoding]
+            if encoding in page.bodies and quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def respond(self, name, version, render) -> Response:
+        page = self._page(name, version, render)
+        encoding = self._negotiate(page)
+        etag = page.etags[encoding]
+
+        if request.if_none_match.contains(etag):
+            with self._lock:
+                self._stats['not_modified'] += 1
+            response = Response(status=304)
+        else:
+            response = Response(page.bodies[encoding], mimetype='text/html')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = self.cache_control
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,297 @@
+import atexit
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+class _Grant:
+    """Quota units this process leased for one (user, kind)."""
+
+    __slots__ = ('lease_id', 'version', 'remaining', 'used', 'available', 'expires_at', 'touched_at', 'synced_at')
+
+    def __init__(self, lease_id, version) -> None:
+        self.lease_id = lease_id
+        self.version = version
+        self.remaining = 0
+        self.used = 0
+        self.available = 0
+        self.expires_at = 0.0
+        self.touched_at = 0.0
+        self.synced_at = 0.0
+
+
+class QuotaEngine:
+    """Consumes ``user_package_limits`` quota from memory, writing behind.
+
+    Each process leases blocks of ``grant_size`` units per user and kind
+    (``Database.lease_quota``) and serves ``consume()`` calls from them
+    without touching MySQL. Every grant is its own row in ``quota_leases``,
+    keyed by a lease id naming this process; leases never exceed
+    ``limit - used - reserved`` under the row lock, and other workers reclaim
+    them only after ``lease_seconds`` without renewal, so usage cannot
+    overshoot the limit however many workers consume at once. Consumed units are flushed every
+    ``flush_interval`` seconds with one multi-row UPDATE that also renews
+    the leases; grants idle for ``idle_seconds`` give their unused units
+    back on the same flush. A grant that has not been synced for
+    ``LEASE_MARGIN`` seconds (flushes failing) stops being served from until
+    it is leased again.
+    """
+
+    KINDS = ('text', 'voice')
+    # Grants stop being used this long after their last successful sync, well
+    # before the database may reclaim them, leaving time for their usage to
+    # be flushed.
+    LEASE_MARGIN = 10.0
+
+    def __init__(
+        self,
+        db,
+        grant_size=20,
+        flush_interval=1.0,
+        lease_seconds=120,
+        idle_seconds=30.0,
+        enabled=True,
+    ) -> None:
+        self.db = db
+        self.grant_size = max(1, int(grant_size))
+        self.flush_interval = flush_interval
+        self.lease_seconds = max(int(lease_seconds), int(self.LEASE_MARGIN) * 2)
+        self.idle_seconds = idle_seconds
+        self.enabled = enabled
+        self.owner = None
+        self._serial = itertools.count(1)
+        self._grants = {}
+        self._retired = []
+        self._lock = threading.Lock()
+        # Serialises leasing per key without a lock object per user.
+        self._stripes = [threading.Lock() for _ in range(64)]
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._atexit_registered = False
+        self._stats = {
+            'consumed': 0,
+            'denied': 0,
+            'leases': 0,
+            'flushes': 0,
+            'flushed_rows': 0,
+            'flush_errors': 0,
+            'dropped': 0,
+        }
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+        pid = os.getpid()
+        if self._pid == pid and not self._stopping.is_set():
+            return
+        with self._lock:
+            if self._pid == pid and not self._stopping.is_set():
+                return
+            # Leases held by the parent belong to the parent; a forked worker
+            # starts empty and leases its own under its own owner id.
+            if self._pid != pid:
+                self._grants = {}
+                self._retired = []
+                self.owner = f"{socket.gethostname()[:40]}:{pid}:{uuid.uuid4().hex[:8]}"
+            self._pid = pid
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='quota-flusher', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.shutdown)
+                self._atexit_registered = True
+
+    def shutdown(self, timeout=5.0) -> None:
+        """Stop the flusher, then flush usage and hand back every lease."""
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush(release_all=True)
+        self._pid = None
+
+    def _usable(self, grant, now) -> bool:
+        return grant.expires_at > now and now - grant.synced_at < self.LEASE_MARGIN
+
+    def consume(self, user_id, kind, amount=1) -> dict:
+        """Take ``amount`` units; ``{'allowed': bool, 'remaining': int}``.
+
+        ``remaining`` is this process's view: its own unused lease plus what
+        was unreserved in the database at its last lease.
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown quota kind: {kind}")
+        self.start()
+        key = (int(user_id), kind)
+        with self._stripes[hash(key) % len(self._stripes)]:
+            now = time.monotonic()
+            with self._lock:
+                grant = self._grants.get(key)
+                if grant is not None and grant.expires_at <= now:
+                    # The database may already have reclaimed this lease.
+                    self._retire(key)
+                    grant = None
+                if self._take(key, grant, amount, now):
+                    return {'allowed': True, 'remaining': grant.remaining + grant.available}
+            grant = self._lease(key, grant, amount, now)
+            with self._lock:
+                if self._take(key, grant, amount, now):
+                    return {'allowed': True, 'remaining': grant.remaining + grant.available}
+                self._stats['denied'] += 1
+                remaining = (grant.remaining + grant.available) if grant else 0
+                return {'allowed': False, 'remaining': remaining}
+
+    def _take(self, key, grant, amount, now) -> bool:
+        """Serve ``amount`` from ``grant`` if it is still in service. Caller holds ``_lock``."""
+        # The flusher may have retired the grant since it was looked up.
+        if grant is None or self._grants.get(key) is not grant:
+            return False
+        if grant.remaining < amount or not self._usable(grant, now):
+            return False
+        grant.remaining -= amount
+        grant.used += amount
+        grant.touched_at = now
+        self._stats['consumed'] += amount
+        return True
+
+    def _lease(self, key, grant, amount, now):
+        user_id, kind = key
+        needed = amount - (grant.remaining if grant else 0)
+        lease_id = grant.lease_id if grant else f"{self.owner}:{next(self._serial)}"
+        lease = self.db.lease_quota(lease_id, user_id, kind, max(self.grant_size, needed), self.lease_seconds)
+        with self._lock:
+            self._stats['leases'] += 1
+            if lease is None:
+                return grant
+            retired = grant is not None and self._grants.get(key) is not grant
+            if retired:
+                # Retired by the flusher meanwhile: hand the new units back
+                # through the next flush and lease again under a fresh id.
+                released = _Grant(lease_id, lease['version'])
+                released.remaining = lease['granted']
+                self._retired.append((key, released))
+            else:
+                if grant is not None and grant.version != lease['version']:
+                    # The package was reassigned: usage on the old one is void
+                    # and the lease row now belongs to the new package.
+                    self._grants.pop(key, None)
+                    grant = None
+                if grant is None:
+                    grant = _Grant(lease_id, lease['version'])
+                    self._grants[key] = grant
+                grant.remaining += lease['granted']
+                grant.available = lease['available']
+                grant.expires_at = now + self.lease_seconds - self.LEASE_MARGIN
+                grant.synced_at = now
+                grant.touched_at = now
+                return grant
+        return self._lease(key, None, amount, now)
+
+    def _retire(self, key) -> None:
+        """Move a grant out of service; the next flush settles it. Caller holds ``_lock``."""
+        grant = self._grants.pop(key, None)
+        if grant is not None:
+            self._retired.append((key, grant))
+
+    def _harvest(self, release_all):
+        """Collect flush items, ``{lease_id: [user_id, kind, version, used, released, retire]}``."""
+        now = time.monotonic()
+        items = {}
+        with self._lock:
+            for key, grant in list(self._grants.items()):
+                if release_all or grant.expires_at <= now or now - grant.touched_at >= self.idle_seconds:
+                    self._retire(key)
+            retired, self._retired = self._retired, []
+            settled = [(key, grant, grant.used, 0, False) for key, grant in self._grants.items()]
+            settled += [(key, grant, grant.used, grant.remaining, True) for key, grant in retired]
+            for (user_id, kind), grant, used, released, retire in settled:
+                grant.used -= used
+                grant.remaining -= released
+                item = items.get(grant.lease_id)
+                if item is None:
+                    items[grant.lease_id] = [user_id, kind, grant.version, used, released, retire]
+                else:
+                    # Units leased for a grant the flusher had just retired.
+                    item[3] += used
+                    item[4] += released
+                    item[5] = item[5] or retire
+        return items
+
+    def _requeue(self, items) -> None:
+        """Put the counts of a failed flush back so the next one settles them."""
+        with self._lock:
+            for lease_id, (user_id, kind, version, used, released, retire) in items.items():
+                grant = self._grants.get((user_id, kind))
+                if grant is not None and grant.lease_id == lease_id and not retire:
+                    grant.used += used
+                    continue
+                grant = _Grant(lease_id, version)
+                grant.used, grant.remaining = used, released
+                self._retired.append(((user_id, kind), grant))
+
+    def flush(self, release_all=False) -> int:
+        started = time.monotonic()
+        items = self._harvest(release_all)
+        if not items:
+            return 0
+        lease_ids = list(items)
+        user_ids = {item[0] for item in items.values()}
+        applied, dropped = 0, []
+        try:
+            for start in range(0, len(lease_ids), 500):
+                chunk = lease_ids[start:start + 500]
+                chunk_applied, chunk_dropped = self.db.flush_quota_usage(
+                    [(items[lease_id][0], items[lease_id][1], lease_id, *items[lease_id][2:]) for lease_id in chunk],
+                    self.lease_seconds,
+                )
+                applied += chunk_applied
+                dropped += chunk_dropped
+                self._mark_synced({lease_id: items.pop(lease_id) for lease_id in chunk}, chunk_dropped, started)
+        except Exception as err:
+            logging.error(f"Quota flush error: {err}")
+            with self._lock:
+                self._stats['flush_errors'] += 1
+            self._requeue(items)
+            return applied
+        if dropped:
+            logging.warning(f"Quota flush dropped {len(dropped)} grants whose lease was reclaimed or package reassigned")
+        for user_id in user_ids:
+            self.db.tariff_cache.invalidate(user_id)
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['flushed_rows'] += applied
+            self._stats['dropped'] += len(dropped)
+        return applied
+
+    def _mark_synced(self, items, dropped, started) -> None:
+        # ``started`` precedes the database's NOW(), so local deadlines stay
+        # on the early side of the renewed lease.
+        dropped = set(dropped)
+        with self._lock:
+            for lease_id, (user_id, kind, version, *_) in items.items():
+                grant = self._grants.get((user_id, kind))
+                if grant is None or grant.lease_id != lease_id or grant.version != version:
+                    continue
+                if lease_id in dropped:
+                    # Its lease is gone, so its remaining units are not ours.
+                    del self._grants[(user_id, kind)]
+                else:
+                    grant.synced_at = started
+                    grant.expires_at = started + self.lease_seconds - self.LEASE_MARGIN
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['grants'] = len(self._grants)
+            stats['unsettled'] = len(self._retired)
+        return stats
@@ -0,0 +1,194 @@
+"""Token buckets: a single local one, and keyed ones for request limiting.
+
+``TokenBucket`` paces one caller (the Telegram dispatcher, the load
+tester). ``RateLimiter`` keeps one bucket per rule and client key in a
+store: ``LocalBucketStore`` in this process, or ``RedisBucketStore`` so
+every gunicorn worker draws from the same buckets.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # Only needed when RATE_LIMIT_REDIS_URL is set.
+    redis = None
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at ``rate`` tokens per second."""
+
+    def __init__(self, rate, capacity=None) -> None:
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now) -> None:
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_acquire(self, tokens=1.0) -> float:
+        """Take ``tokens`` if available; otherwise return seconds until they are."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1.0, stop_event=None) -> bool:
+        """Block until ``tokens`` are taken; returns False if ``stop_event`` fires."""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return True
+            if stop_event is not None:
+                if stop_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def pause(self, seconds) -> None:
+        """Drain the bucket and refuse tokens for ``seconds`` (e.g. after HTTP 429)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = 0.0
+            self._updated = now + seconds
+            self._paused_until = max(self._paused_until, now + seconds)
+
+
+class LocalBucketStore:
+    """Per-key token buckets in this process, least recently used dropped first.
+
+    Dropping a bucket only forgets it; it comes back full, which is what an
+    idle client's bucket would be anyway.
+    """
+
+    def __init__(self, maxsize=100_000) -> None:
+        self.maxsize = max(1, int(maxsize))
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, buckets, tokens=1.0) -> float:
+        """Take ``tokens`` from every ``(key, rate, capacity)`` bucket, or from none.
+
+        Returns 0 when all of them had the tokens, otherwise the seconds
+        until the emptiest one will; refused requests take nothing.
+        """
+        with self._lock:
+            now = time.monotonic()
+            levels = []
+            wait = 0.0
+            for key, rate, capacity in buckets:
+                level, updated = self._buckets.pop(key, (capacity, now))
+                level = min(capacity, level + max(0.0, now - updated) * rate)
+                levels.append((key, level))
+                if level < tokens:
+                    wait = max(wait, (tokens - level) / rate)
+            for key, level in levels:
+                self._buckets[key] = (level if wait > 0 else level - tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class RedisBucketStore:
+    """``LocalBucketStore`` kept in Redis, shared by every worker and host.
+
+    Each take is one script call, atomic on the server and timed by the
+    server's clock. Buckets expire once they would be full again. If Redis
+    cannot be reached, takes fall back to a local store until it can.
+    """
+
+    SCRIPT = """
+    redis.replicate_commands()
+    local tokens = tonumber(ARGV[1])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local levels = {}
+    local wait = 0
+    for index, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[index * 2])
+        local capacity = tonumber(ARGV[index * 2 + 1])
+        local state = redis.call('HMGET', key, 'level', 'updated')
+        local level = tonumber(state[1]) or capacity
+        local updated = tonumber(state[2]) or now
+        level = math.min(capacity, level + math.max(0, now - updated) * rate)
+        levels[index] = level
+        if level < tokens then
+            wait = math.max(wait, (tokens - level) / rate)
+        end
+    end
+    for index, key in ipairs(KEYS) do
+        local level = levels[index]
+        if wait == 0 then
+            level = level - tokens
+        end
+        local rate = tonumber(ARGV[index * 2])
+        local capacity = tonumber(ARGV[index * 2 + 1])
+        redis.call('HSET', key, 'level', tostring(level), 'updated', tostring(now))
+        redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000) + 1000)
+    end
+    return tostring(wait)
+    """
+    ERROR_LOG_INTERVAL = 60.0
+
+    def __init__(self, url, prefix='pulbot:ratelimit:', timeout=0.05) -> None:
+        if redis is None:
+            raise RuntimeError('RATE_LIMIT_REDIS_URL is set but the redis package is not installed')
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._script = self.client.register_script(self.SCRIPT)
+        self._fallback = LocalBucketStore()
+        self._error_logged_at = float('-inf')
+
+    def take(self, buckets, tokens=1.0) -> float:
+        args = [tokens]
+        for _, rate, capacity in buckets:
+            args += [rate, capacity]
+        try:
+            return float(self._script(keys=[self.prefix + key for key, _, _ in buckets], args=args))
+        except redis.RedisError as err:
+            now = time.monotonic()
+            if now - self._error_logged_at >= self.ERROR_LOG_INTERVAL:
+                self._error_logged_at = now
+                logging.error(f"Rate limit store error, limiting per process: {err}")
+            return self._fallback.take(buckets, tokens)
+
+
+class RateLimiter:
+    """Named rules of ``(rate per second, burst)``, one bucket per rule and key.
+
+    ``check((rule, key), ...)`` takes a token from each named bucket, or
+    from none of them, and returns 0 or the seconds until all have one.
+    ``None`` keys are never limited.
+    """
+
+    def __init__(self, rules, store=None, enabled=True) -> None:
+        self.rules = rules
+        self.store = store or LocalBucketStore()
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {'allowed': 0, 'limited': 0}
+
+    def check(self, *limits) -> float:
+        buckets = [(f"{rule}:{key}", *self.rules[rule]) for rule, key in limits if key is not None]
+        if not self.enabled or not buckets:
+            return 0.0
+        wait = self.store.take(buckets)
+        with self._lock:
+            self._stats['limited' if wait > 0 else 'allowed'] += 1
+        return wait
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,61 @@
+"""Rebuild and inspect the revenue_daily rollup.
+
+``revenue_daily`` is kept current by the payment completion path. The
+migration creates it empty, so rebuild it once after deploying, and again
+after importing or hand-editing payments or to check it against the source
+rows::
+
+    python revenue.py rebuild [--since 2024-01-01] [--until 2024-12-31] [--chunk-days 31]
+    python revenue.py show --since 2026-10-01 [--until 2026-10-31] [--group-by day,tariff] [--status confirmed]
+"""
+import argparse
+import sys
+from datetime import date, timedelta
+
+from database import Database
+
+
+def rebuild(db, args) -> int:
+    days = db.rebuild_revenue_daily(args.since, args.until, chunk_days=args.chunk_days)
+    print(f"Rebuilt revenue_daily for {days} day(s)")
+    return 0
+
+
+def show(db, args) -> int:
+    until = args.until or date.today()
+    since = args.since or until - timedelta(days=29)
+    group_by = [item for item in args.group_by.split(',') if item]
+    rows = db.revenue_summary(since, until, group_by=group_by, status=args.status)
+    columns = [dimension for dimension in Database.REVENUE_DIMENSIONS if dimension in group_by]
+    columns += ['payments', 'original_amount', 'discount_amount', 'amount']
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if row[column] is None else str(row[column]) for column in columns))
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild_parser = commands.add_parser('rebuild', help='recompute the rollup from payments')
+    rebuild_parser.add_argument('--since', type=date.fromisoformat, help='first day (default: first payment)')
+    rebuild_parser.add_argument('--until', type=date.fromisoformat, help='last day (default: last payment)')
+    rebuild_parser.add_argument('--chunk-days', type=int, default=31, help='days replaced per transaction')
+    rebuild_parser.set_defaults(handler=rebuild)
+
+    show_parser = commands.add_parser('show', help='print rollup sums')
+    show_parser.add_argument('--since', type=date.fromisoformat, help='first day (default: 30 days back)')
+    show_parser.add_argument('--until', type=date.fromisoformat, help='last day (default: today)')
+    show_parser.add_argument('--group-by', default='day', help=f"comma-separated: {','.join(Database.REVENUE_DIMENSIONS)}")
+    show_parser.add_argument('--status', choices=Database.REVENUE_STATUSES)
+    show_parser.set_defaults(handler=show)
+
+    args = parser.parse_args(argv)
+    db = Database()
+    db.ensure_schema()
+    return args.handler(db, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
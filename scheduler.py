@@ -0,0 +1,339 @@
+"""Periodic maintenance that runs in one process per database.
+
+``PaymentSweeper`` expires checkouts that were abandoned while ``pending``
+or ``prepared`` and gives their promo reservations back.
+``TariffExpiryScheduler`` downgrades lapsed tariffs and queues the
+"expires soon" and "expired" reminders. Like the Telegram dispatcher, each
+task holds a MySQL advisory lock while it works, so any number of gunicorn
+workers can start it and only one of them runs it. Run a single pass by
+hand with::
+
+    python scheduler.py sweep
+    python scheduler.py expire-tariffs
+"""
+import argparse
+import atexit
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from notifier import build_expiry_message
+
+
+class PeriodicTask:
+    """Calls ``run_once()`` every ``interval`` seconds while holding ``LOCK_NAME``.
+
+    ``run_once`` returns a dict of counts for the pass; they are added to
+    ``stats()`` and logged when any of them is non-zero. Passes that work
+    in batches call ``_throttle()`` between them, which keeps the task busy
+    at most ``duty_cycle`` of the wall time and ends the pass early while
+    this process's connection pool is nearly exhausted.
+    """
+
+    LOCK_NAME = None
+    THREAD_NAME = 'periodic-task'
+
+    def __init__(self, db, interval=60.0, duty_cycle=1.0, enabled=True) -> None:
+        self.db = db
+        self.interval = interval
+        self.duty_cycle = min(1.0, max(0.01, duty_cycle))
+        self.enabled = enabled
+        self._lock_connection = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+        self._atexit_registered = False
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'runs': 0,
+            'errors': 0,
+            'leader': 0,
+            'last_run_at': None,
+            'last_run': None,
+        }
+
+    def run_once(self) -> dict:
+        raise NotImplementedError
+
+    def start(self) -> None:
+        if not self.enabled:
+            return
+        pid = os.getpid()
+        if self._pid == pid and not self._stopping.is_set():
+            return
+        with self._start_lock:
+            if self._pid == pid and not self._stopping.is_set():
+                return
+            self._pid = pid
+            self._stopping.clear()
+            self._lock_connection = None
+            self._thread = threading.Thread(target=self._run, name=self.THREAD_NAME, daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.shutdown)
+                self._atexit_registered = True
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def shutdown(self, timeout=10.0) -> None:
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._release_leadership()
+        self._pid = None
+
+    def _hold_leadership(self) -> bool:
+        connection = self._lock_connection
+        if connection is not None:
+            try:
+                connection.ping(reconnect=False)
+                return True
+            except Exception:
+                self._release_leadership()
+        try:
+            connection = self.db._connect()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT GET_LOCK(%s, 0) AS acquired", (self.LOCK_NAME,))
+                row = cursor.fetchone()
+        except Exception as err:
+            logging.debug(f"{self.THREAD_NAME} lock error: {err}")
+            return False
+        if row and row.get('acquired') == 1:
+            self._lock_connection = connection
+            with self._stats_lock:
+                self._stats['leader'] = 1
+            return True
+        connection.close()
+        return False
+
+    def _release_leadership(self) -> None:
+        connection, self._lock_connection = self._lock_connection, None
+        with self._stats_lock:
+            self._stats['leader'] = 0
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _pool_busy(self) -> bool:
+        pool = self.db.pool_stats()
+        return pool['in_use'] >= max(1, pool['size'] - 1)
+
+    def _throttle(self, started) -> bool:
+        """Sleep after a batch that began at ``started``; False to end the pass."""
+        elapsed = time.perf_counter() - started
+        if self._stopping.wait(elapsed * (1 - self.duty_cycle) / self.duty_cycle):
+            return False
+        return not self._pool_busy()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            if not self._hold_leadership():
+                self._stopping.wait(max(self.interval, 5.0))
+                continue
+            self.run_and_record()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def run_and_record(self):
+        started = time.perf_counter()
+        try:
+            counts = self.run_once()
+        except Exception as err:
+            logging.error(f"{self.THREAD_NAME} error: {err}")
+            with self._stats_lock:
+                self._stats['runs'] += 1
+                self._stats['errors'] += 1
+            return None
+        counts['seconds'] = round(time.perf_counter() - started, 3)
+        with self._stats_lock:
+            self._stats['runs'] += 1
+            self._stats['last_run_at'] = datetime.now().isoformat(timespec='seconds')
+            self._stats['last_run'] = counts
+            for key, value in counts.items():
+                if key != 'seconds':
+                    self._stats[key] = self._stats.get(key, 0) + value
+        if any(value for key, value in counts.items() if key != 'seconds'):
+            summary = ', '.join(f"{key}={value}" for key, value in counts.items())
+            logging.info(f"{self.THREAD_NAME}: {summary}")
+        return counts
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+class PaymentSweeper(PeriodicTask):
+    """Cancels payments left ``pending``/``prepared`` for ``stale_minutes``.
+
+    Works in batches of ``batch_size``, one short transaction each (see
+    ``Database.expire_stale_payments``), throttled between batches.
+    """
+
+    LOCK_NAME = 'pulbot_payment_sweeper'
+    THREAD_NAME = 'payment-sweeper'
+
+    def __init__(
+        self,
+        db,
+        interval=60.0,
+        stale_minutes=60,
+        batch_size=200,
+        max_batches=50,
+        duty_cycle=0.1,
+        enabled=True,
+    ) -> None:
+        super().__init__(db, interval=interval, duty_cycle=duty_cycle, enabled=enabled)
+        self.stale_minutes = stale_minutes
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+
+    def run_once(self) -> dict:
+        counts = {'expired': 0, 'promo_released': 0, 'batches': 0}
+        if self._pool_busy():
+            return counts
+        for _ in range(self.max_batches):
+            started = time.perf_counter()
+            result = self.db.expire_stale_payments(self.stale_minutes, self.batch_size)
+            counts['expired'] += result['payments']
+            counts['promo_released'] += result['promo_released']
+            counts['batches'] += 1
+            if result['payments'] < self.batch_size or not self._throttle(started):
+                break
+        return counts
+
+
+class TariffExpiryScheduler(PeriodicTask):
+    """Downgrades lapsed tariffs and queues expiry reminders.
+
+    Walks ``users`` in primary-key order, ``chunk_size`` users at a time.
+    Per chunk it reads only the paid users whose tariff has lapsed or lapses
+    within ``remind_days``, downgrades the lapsed ones with one UPDATE in a
+    short transaction that also queues their "expired" reminders, and
+    queues the "expires soon" reminders with one multi-row INSERT. Reminder
+    dedupe keys include the expiry time, so each user hears about each
+    expiry once however often the table is scanned. A pass cut short by the
+    duty cycle or a busy pool leaves its cursor in ``scheduler_cursors`` and
+    the next pass, in whichever process leads then, resumes there; it wraps
+    to the start only after the end of the table.
+    """
+
+    LOCK_NAME = 'pulbot_tariff_expiry'
+    THREAD_NAME = 'tariff-expiry'
+
+    def __init__(
+        self,
+        db,
+        notifier=None,
+        interval=300.0,
+        chunk_size=1000,
+        remind_days=3,
+        duty_cycle=0.5,
+        send_reminders=True,
+        enabled=True,
+    ) -> None:
+        super().__init__(db, interval=interval, duty_cycle=duty_cycle, enabled=enabled)
+        self.notifier = notifier
+        self.chunk_size = chunk_size
+        self.remind_days = remind_days
+        self.send_reminders = send_reminders
+        self.cursor = None
+
+    def _reminder(self, row, expired):
+        expires_at = row['tariff_expires_at']
+        kind = 'expired' if expired else 'expiring'
+        return (
+            row['user_id'],
+            build_expiry_message(row['tariff'], expires_at, expired),
+            f"tariff_{kind}:{row['user_id']}:{expires_at:%Y%m%d%H%M%S}",
+        )
+
+    def run_once(self) -> dict:
+        counts = {'chunks': 0, 'downgraded': 0, 'expired_reminders': 0, 'expiring_reminders': 0}
+        # Another process may have led since this one last ran.
+        self.cursor = self.db.get_scheduler_cursor(self.LOCK_NAME)
+        while not self._pool_busy():
+            started = time.perf_counter()
+            upper = self.db.users_chunk_bound(self.cursor, self.chunk_size)
+            if upper is None:
+                self.cursor = 0
+                self.db.set_scheduler_cursor(self.LOCK_NAME, self.cursor)
+                break
+            candidates = self.db.tariff_expiry_candidates(self.cursor, upper, self.remind_days)
+            lapsed = [row['user_id'] for row in candidates if row['expired']]
+            expiring = [row for row in candidates if not row['expired']]
+            if lapsed:
+                with self.db.session(transaction=True):
+                    downgraded = self.db.downgrade_expired_users(lapsed)
+                    if self.send_reminders:
+                        # Lapses from before the scheduler first ran are
+                        # downgraded silently rather than announced late.
+                        cutoff = datetime.now() - timedelta(days=self.remind_days)
+                        counts['expired_reminders'] += self.db.enqueue_notifications(
+                            [self._reminder(row, True) for row in downgraded if row['tariff_expires_at'] >= cutoff]
+                        )
+                counts['downgraded'] += len(downgraded)
+            if expiring and self.send_reminders:
+                counts['expiring_reminders'] += self.db.enqueue_notifications(
+                    [self._reminder(row, False) for row in expiring]
+                )
+            counts['chunks'] += 1
+            self.cursor = upper
+            self.db.set_scheduler_cursor(self.LOCK_NAME, self.cursor)
+            if not self._throttle(started):
+                break
+        if self.notifier is not None and (counts['expired_reminders'] or counts['expiring_reminders']):
+            self.notifier.wake()
+        return counts
+
+
+def main(argv=None) -> int:
+    from config import BOT_TOKEN, PAYMENT_SWEEPER_CONFIG, TARIFF_EXPIRY_CONFIG
+    from database import Database
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    sweep_parser = commands.add_parser('sweep', help='expire stale payments once')
+    sweep_parser.add_argument('--stale-minutes', type=int, default=PAYMENT_SWEEPER_CONFIG['stale_minutes'])
+    sweep_parser.add_argument('--batch-size', type=int, default=PAYMENT_SWEEPER_CONFIG['batch_size'])
+    sweep_parser.add_argument('--max-batches', type=int, default=PAYMENT_SWEEPER_CONFIG['max_batches'])
+    expiry_parser = commands.add_parser('expire-tariffs', help='downgrade lapsed tariffs and queue reminders once')
+    expiry_parser.add_argument('--chunk-size', type=int, default=TARIFF_EXPIRY_CONFIG['chunk_size'])
+    expiry_parser.add_argument('--remind-days', type=int, default=TARIFF_EXPIRY_CONFIG['remind_days'])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    db = Database()
+    db.ensure_schema()
+    if args.command == 'sweep':
+        config = dict(PAYMENT_SWEEPER_CONFIG)
+        config.update(stale_minutes=args.stale_minutes, batch_size=args.batch_size, max_batches=args.max_batches)
+        task = PaymentSweeper(db, **config)
+    else:
+        config = dict(TARIFF_EXPIRY_CONFIG)
+        config.update(chunk_size=args.chunk_size, remind_days=args.remind_days)
+        task = TariffExpiryScheduler(db, send_reminders=bool(BOT_TOKEN), **config)
+    if not task._hold_leadership():
+        print(f'Another process is running {task.THREAD_NAME}; try again later.')
+        return 1
+    try:
+        counts = task.run_and_record()
+    finally:
+        task._release_leadership()
+    print(counts)
+    return 0 if counts is not None else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
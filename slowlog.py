@@ -0,0 +1,305 @@
+"""Slow-query log for ``Database._execute`` and a report over it.
+
+``SlowQueryLog`` observes every statement the ``Database`` runs. Statements
+slower than the threshold are written as JSON lines to a rotating file
+together with the query template (placeholders, never the values), the
+``Database`` method that issued it, the application frame that called that
+method and, for SELECTs, the ``EXPLAIN`` plan. Plans are captured on a
+background thread over a dedicated connection, so a slow request is not
+made slower by logging it. Summarise the log with::
+
+    python slowlog.py report [--path slow_queries.log] [--top 20] [--sort total]
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+_SKIPPED_FILES = {
+    os.path.abspath(__file__),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database.py'),
+}
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+def fingerprint(template: str) -> str:
+    return hashlib.sha1(template.encode('utf-8')).hexdigest()[:12]
+
+
+def _origin():
+    """First frame outside database.py and this module, as ``file:function:line``."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if os.path.abspath(filename) not in _SKIPPED_FILES:
+            return f"{os.path.basename(filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return None
+
+
+class SlowQueryLog:
+    """Writes statements slower than ``threshold_ms`` to a rotating JSON-lines file.
+
+    ``EXPLAIN`` runs at most once per query template every
+    ``explain_interval`` seconds; records that arrive while the writer is
+    behind are dropped and counted rather than queued without bound.
+    """
+
+    def __init__(
+        self,
+        db,
+        threshold_ms=200.0,
+        path='slow_queries.log',
+        max_bytes=10 * 1024 * 1024,
+        backup_count=5,
+        explain=True,
+        explain_interval=300.0,
+        enabled=True,
+    ) -> None:
+        self.db = db
+        self.threshold = threshold_ms / 1000.0
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.enabled = enabled
+        self._queue = queue.Queue(maxsize=1000)
+        self._explained = {}
+        self._connection = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._logger = None
+        self._stats = {
+            'recorded': 0,
+            'explained': 0,
+            'dropped': 0,
+        }
+        if enabled:
+            db.add_query_observer(self.observe)
+
+    def observe(self, method, query, params, seconds, error) -> None:
+        if seconds < self.threshold:
+            return
+        record = {
+            'ts': datetime.now().isoformat(timespec='milliseconds'),
+            'ms': round(seconds * 1000, 2),
+            'method': method,
+            'origin': _origin(),
+            'template': normalize_query(query),
+            'error': f"{type(error).__name__}: {error}" if error is not None else None,
+        }
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((record, params))
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+
+    def _ensure_writer(self) -> None:
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # A forked worker gets its own writer thread and connection.
+            self._pid = pid
+            self._connection = None
+            self._logger = None
+            self._thread = threading.Thread(target=self._run, name='slow-query-log', daemon=True)
+            self._thread.start()
+
+    def _file_logger(self):
+        if self._logger is None:
+            # '{pid}' in the path gives every gunicorn worker its own file, so
+            # workers never rotate a file another one is writing to.
+            path = os.path.abspath(self.path.format(pid=os.getpid()))
+            logger = logging.getLogger('slow_query')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            for handler in list(logger.handlers):
+                if getattr(handler, 'baseFilename', None) != path:
+                    logger.removeHandler(handler)
+                    handler.close()
+            if not logger.handlers:
+                handler = RotatingFileHandler(
+                    path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding='utf-8'
+                )
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def _run(self) -> None:
+        while True:
+            record, params = self._queue.get()
+            record['fingerprint'] = fingerprint(record['template'])
+            if self.explain and record['error'] is None and self._should_explain(record):
+                record['explain'] = self._explain(record['template'], params)
+            try:
+                self._file_logger().info(json.dumps(record, default=str))
+            except Exception as err:
+                logging.error(f"Slow query log write error: {err}")
+                continue
+            with self._lock:
+                self._stats['recorded'] += 1
+
+    def _should_explain(self, record) -> bool:
+        if not record['template'].upper().startswith(('SELECT', 'WITH')):
+            return False
+        now = time.monotonic()
+        last = self._explained.get(record['fingerprint'])
+        if last is not None and now - last < self.explain_interval:
+            return False
+        self._explained[record['fingerprint']] = now
+        return True
+
+    def _explain(self, template, params):
+        try:
+            if self._connection is None or not self._connection.open:
+                self._connection = self.db._connect()
+            with self._connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN {template}", params or ())
+                plan = cursor.fetchall()
+        except Exception as err:
+            self._connection = None
+            return {'error': str(err)}
+        with self._lock:
+            self._stats['explained'] += 1
+        return plan
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+
+def read_records(path, since=None):
+    files = []
+    for current in sorted(glob.glob(path.replace('{pid}', '*'))):
+        files.extend(f"{current}.{index}" for index in range(20, 0, -1))
+        files.append(current)
+    for name in files:
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding='utf-8') as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since and record.get('ts', '') < since:
+                    continue
+                yield record
+
+
+def _plan_summary(plan) -> str:
+    if not isinstance(plan, list):
+        return f"EXPLAIN failed: {plan.get('error')}" if isinstance(plan, dict) else ''
+    parts = []
+    for row in plan:
+        access = row.get('type') or '-'
+        flag = ' FULL SCAN' if access == 'ALL' else ''
+        extra = f" ({row['Extra']})" if row.get('Extra') else ''
+        parts.append(f"{row.get('table')}: {access} key={row.get('key')} rows={row.get('rows')}{flag}{extra}")
+    return '; '.join(parts)
+
+
+def summarize(records) -> list:
+    groups = {}
+    for record in records:
+        key = record.get('fingerprint') or fingerprint(record['template'])
+        group = groups.setdefault(key, {
+            'fingerprint': key,
+            'template': record['template'],
+            'timings': [],
+            'methods': {},
+            'origins': {},
+            'errors': 0,
+            'plan': None,
+            'last_seen': '',
+        })
+        group['timings'].append(record['ms'])
+        group['methods'][record.get('method')] = group['methods'].get(record.get('method'), 0) + 1
+        if record.get('origin'):
+            group['origins'][record['origin']] = group['origins'].get(record['origin'], 0) + 1
+        if record.get('error'):
+            group['errors'] += 1
+        if record.get('explain') is not None:
+            group['plan'] = record['explain']
+        group['last_seen'] = max(group['last_seen'], record.get('ts', ''))
+
+    summary = []
+    for group in groups.values():
+        timings = sorted(group.pop('timings'))
+        count = len(timings)
+        group.update({
+            'count': count,
+            'total_ms': sum(timings),
+            'mean_ms': sum(timings) / count,
+            'p95_ms': timings[max(0, -(-95 * count // 100) - 1)],
+            'max_ms': timings[-1],
+            'full_scan': isinstance(group['plan'], list) and any(row.get('type') == 'ALL' for row in group['plan']),
+        })
+        summary.append(group)
+    return summary
+
+
+def report(args) -> int:
+    summary = summarize(read_records(args.path, since=args.since))
+    if not summary:
+        print(f"No slow queries recorded in {args.path}")
+        return 0
+    summary.sort(key=lambda group: group[f'{args.sort}_ms' if args.sort != 'count' else 'count'], reverse=True)
+    for group in summary[:args.top]:
+        methods = ', '.join(f"{name} x{count}" for name, count in sorted(group['methods'].items(), key=lambda item: -item[1]))
+        print(
+            f"[{group['fingerprint']}] {group['count']}x  total {group['total_ms'] / 1000:.2f}s  "
+            f"mean {group['mean_ms']:.1f}ms  p95 {group['p95_ms']:.1f}ms  max {group['max_ms']:.1f}ms"
+            + ('  FULL SCAN' if group['full_scan'] else '')
+        )
+        print(f"  method: {methods}")
+        if group['origins']:
+            top_origin = max(group['origins'].items(), key=lambda item: item[1])[0]
+            print(f"  called from: {top_origin}")
+        if group['errors']:
+            print(f"  errors: {group['errors']}")
+        print(f"  query: {group['template'][:300]}")
+        if group['plan'] is not None:
+            print(f"  plan: {_plan_summary(group['plan'])}")
+        print(f"  last seen: {group['last_seen']}")
+        print()
+    return 0
+
+
+def main(argv=None) -> int:
+    from config import SLOW_QUERY_CONFIG
+
+    parser = argparse.ArgumentParser(description='Summarise the slow-query log.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    report_parser = commands.add_parser('report', help='group slow queries by template')
+    report_parser.add_argument('--path', default=SLOW_QUERY_CONFIG['path'])
+    report_parser.add_argument('--since', help='ISO timestamp, e.g. 2026-10-01T00:00')
+    report_parser.add_argument('--top', type=int, default=20)
+    report_parser.add_argument('--sort', choices=('total', 'p95', 'max', 'mean', 'count'), default='total')
+    args = parser.parse_args(argv)
+    return report(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
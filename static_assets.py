@@ -0,0 +1,70 @@
+import json
+import logging
+import mimetypes
+import os
+
+from flask import abort, request, send_from_directory
+
+from build_assets import MANIFEST_PATH, OUTPUT_DIR, SOURCE_DIR
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class AssetManifest:
+    """Maps logical asset names (``payment-plus.css``) to fingerprinted files."""
+
+    def __init__(self, path=MANIFEST_PATH) -> None:
+        self.path = path
+        self._entries = None
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path, encoding='utf-8') as handle:
+                    self._entries = json.load(handle)
+            except (OSError, ValueError) as err:
+                logging.warning(f"Asset manifest unavailable, serving unbuilt sources: {err}")
+                self._entries = {}
+        return self._entries
+
+    def url(self, name) -> str:
+        return f"/assets/{self._load().get(name, name)}"
+
+    def is_fingerprinted(self, filename) -> bool:
+        return filename in self._load().values()
+
+
+def _preferred_variant(filename):
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[encoding] and os.path.exists(os.path.join(OUTPUT_DIR, filename + suffix)):
+            return encoding, filename + suffix
+    return None, filename
+
+
+def init_static_assets(app, manifest=None) -> AssetManifest:
+    manifest = manifest or AssetManifest()
+
+    @app.context_processor
+    def _asset_helpers():
+        return {'asset_url': manifest.url}
+
+    @app.route('/assets/<path:filename>')
+    def static_asset(filename):
+        if manifest.is_fingerprinted(filename):
+            # The name changes whenever the content does, so the WebView may
+            # keep these forever.
+            encoding, variant = _preferred_variant(filename)
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(OUTPUT_DIR, variant, mimetype=mimetype, max_age=31536000)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+            response.vary.add('Accept-Encoding')
+            return response
+        if os.path.exists(os.path.join(SOURCE_DIR, filename)):
+            # Development fallback when build_assets.py has not been run.
+            return send_from_directory(SOURCE_DIR, filename, max_age=0)
+        abort(404)
+
+    return manifest
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Importing app.py must not need MySQL or start the periodic workers.
+os.environ.setdefault('DB_HOST', '127.0.0.1')
+os.environ.setdefault('DB_PORT', '1')
+os.environ.setdefault('DB_POOL_TIMEOUT', '1')
+for flag in ('NOTIFY_DISPATCHER', 'PAYMENT_SWEEPER', 'TARIFF_EXPIRY', 'QUOTA_ENGINE', 'SLOW_QUERY_LOG'):
+    os.environ.setdefault(flag, 'false')
+
+
+@pytest.fixture
+def mysql_db():
+    """A ``Database`` on a throwaway MySQL schema, migrated from scratch.
+
+    Set TEST_DB_HOST (and TEST_DB_PORT, TEST_DB_USER, TEST_DB_PASSWORD,
+    TEST_DB_NAME) to run these tests; every table in TEST_DB_NAME is dropped
+    first. Without them the tests are skipped.
+    """
+    if not os.getenv('TEST_DB_HOST'):
+        pytest.skip('TEST_DB_HOST is not set')
+    from database import Database
+
+    db = Database()
+    db.connection_config.update(
+        host=os.environ['TEST_DB_HOST'],
+        port=int(os.getenv('TEST_DB_PORT', 3306)),
+        user=os.getenv('TEST_DB_USER', 'root'),
+        password=os.getenv('TEST_DB_PASSWORD', ''),
+        database=os.getenv('TEST_DB_NAME', 'pulbot_test'),
+    )
+    connection = db._connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+            cursor.execute("SHOW TABLES")
+            for row in cursor.fetchall():
+                cursor.execute(f"DROP TABLE `{next(iter(row.values()))}`")
+    finally:
+        connection.close()
+    db.ensure_schema()
+    yield db
+    db.pool.close()
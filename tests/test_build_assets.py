@@ -0,0 +1,27 @@
+import pytest
+
+import build_assets
+
+
+def test_minify_css_keeps_quoted_strings():
+    source = """
+    /* heading */
+    .badge::before {  content: "a  b ; }" ;  }
+    .title { font-family: 'Open  Sans', sans-serif; }
+    """
+
+    assert build_assets.minify_css(source) == (
+        '.badge::before{content:"a  b ; }"}.title{font-family:\'Open  Sans\',sans-serif}\n'
+    )
+
+
+def test_minify_css_drops_comments_but_not_descendant_space():
+    assert build_assets.minify_css('.card  :hover { color: red; } /* x */') == '.card :hover{color:red}\n'
+
+
+@pytest.mark.parametrize('argv', [['--help'], ['--output', 'x']])
+def test_arguments_other_than_none_do_not_build(argv, monkeypatch):
+    monkeypatch.setattr(build_assets, 'build', lambda: pytest.fail('build() ran'))
+
+    with pytest.raises(SystemExit):
+        build_assets.main(argv)
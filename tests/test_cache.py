@@ -0,0 +1,97 @@
+import asyncio
+import threading
+
+import pytest
+
+from cache import TTLCache
+
+
+def test_concurrent_misses_call_loader_once():
+    cache = TTLCache()
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('k', loader))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while cache.stats()['coalesced'] < 7:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+    assert results == ['value'] * 8
+    assert cache.get('k') == 'value'
+
+
+def test_loader_error_reaches_every_waiter_and_is_not_cached():
+    cache = TTLCache()
+
+    def loader():
+        raise RuntimeError('database unavailable')
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_load('k', loader)
+    assert cache.get_or_load('k', lambda: 'fresh') == 'fresh'
+
+
+def test_invalidation_during_load_discards_result():
+    cache = TTLCache()
+
+    def loader():
+        # A write lands while the old value is being read.
+        cache.invalidate('k')
+        return 'stale'
+
+    assert cache.get_or_load('k', loader) == 'stale'
+    assert cache.get('k') is None
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('cache.time.monotonic', lambda: now[0])
+    cache = TTLCache(ttl=30)
+    cache.set('k', 1)
+
+    now[0] += 29
+    assert cache.get('k') == 1
+    now[0] += 2
+    assert cache.get('k') is None
+
+
+def test_get_or_load_many_loads_only_missing_keys():
+    cache = TTLCache()
+    cache.set('a', 1)
+    requested = []
+
+    def loader(keys):
+        requested.append(sorted(keys))
+        return {key: key.upper() for key in keys}
+
+    assert cache.get_or_load_many(['a', 'b', 'c', 'b'], loader) == {'a': 1, 'b': 'B', 'c': 'C'}
+    assert requested == [['b', 'c']]
+    assert cache.get_or_load_many(['b', 'c'], loader) == {'b': 'B', 'c': 'C'}
+    assert requested == [['b', 'c']]
+
+
+def test_async_misses_await_one_load():
+    cache = TTLCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_load_async('k', loader) for _ in range(5)))
+
+    assert asyncio.run(main()) == ['value'] * 5
+    assert calls == [1]
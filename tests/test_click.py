@@ -0,0 +1,134 @@
+import pytest
+
+import click_api
+from cache import TTLCache
+
+
+class CallbackStore:
+    """In-memory ``click_callbacks``: first response per key wins."""
+
+    def __init__(self) -> None:
+        self.rows = {}
+
+    def get(self, action, click_trans_id, merchant_trans_id):
+        return self.rows.get((action, click_trans_id, merchant_trans_id))
+
+    def store(self, action, click_trans_id, merchant_trans_id, response):
+        key = (action, click_trans_id, merchant_trans_id)
+        if key in self.rows:
+            return False
+        self.rows[key] = response
+        return True
+
+
+@pytest.fixture
+def click(monkeypatch):
+    import app as app_module
+
+    store = CallbackStore()
+    db = app_module.db
+    monkeypatch.setitem(app_module.app.before_request_funcs, None, [])
+    monkeypatch.setattr(app_module, 'click_responses', TTLCache())
+    monkeypatch.setattr(db, 'get_click_callback_response', store.get)
+    monkeypatch.setattr(db, 'store_click_callback_response', store.store)
+    return app_module.app.test_client(), app_module, store, monkeypatch
+
+
+def prepare_params(click_trans_id='9001', merchant_trans_id='42_PLUS_1'):
+    params = {
+        'click_trans_id': click_trans_id,
+        'service_id': '1',
+        'merchant_trans_id': merchant_trans_id,
+        'amount': '45000',
+        'action': '0',
+        'sign_time': '2026-01-01 10:00:00',
+    }
+    params['sign_string'] = click_api.prepare_sign(params, merchant_trans_id)
+    return params
+
+
+def complete_params(click_trans_id='9001', merchant_trans_id='42_PLUS_1', error='0'):
+    params = {
+        'click_trans_id': click_trans_id,
+        'service_id': '1',
+        'merchant_trans_id': merchant_trans_id,
+        'merchant_prepare_id': '77',
+        'amount': '45000',
+        'action': '1',
+        'sign_time': '2026-01-01 10:00:05',
+        'error': error,
+    }
+    params['sign_string'] = click_api.complete_sign(params, merchant_trans_id)
+    return params
+
+
+def test_prepare_retry_replays_first_response(click):
+    client, app_module, store, monkeypatch = click
+    writes = []
+    monkeypatch.setattr(app_module.db, 'update_payment_prepare', lambda *args: writes.append(args))
+
+    first = client.post('/api/click/prepare', data=prepare_params()).get_json()
+    # A second worker has no LRU entry and must answer from click_callbacks.
+    monkeypatch.setattr(app_module, 'click_responses', TTLCache())
+    retry = client.post('/api/click/prepare', data=prepare_params()).get_json()
+
+    assert first['error'] == 0
+    assert retry == first
+    assert writes == [('42_PLUS_1', '9001')]
+
+
+def test_failed_prepare_write_is_not_remembered(click):
+    client, app_module, store, monkeypatch = click
+
+    def unavailable(*args):
+        raise RuntimeError('database unavailable')
+
+    monkeypatch.setattr(app_module.db, 'update_payment_prepare', unavailable)
+    response = client.post('/api/click/prepare', data=prepare_params())
+
+    assert response.status_code == 500
+    assert response.get_json()['error'] == -7
+    assert store.rows == {}
+
+    monkeypatch.setattr(app_module.db, 'update_payment_prepare', lambda *args: None)
+    assert client.post('/api/click/prepare', data=prepare_params()).get_json()['error'] == 0
+
+
+def test_bad_signature_is_rejected_before_any_work(click):
+    client, _, store, _ = click
+    params = prepare_params()
+    params['sign_string'] = 'forged'
+
+    response = client.post('/api/click/prepare', data=params)
+
+    assert response.get_json()['error'] == -1
+    assert store.rows == {}
+
+
+def test_complete_enqueues_once_and_replays(click):
+    client, app_module, store, monkeypatch = click
+    enqueued = []
+    monkeypatch.setattr(app_module.job_queue, 'enqueue', lambda kind, payload, dedupe_key: enqueued.append(dedupe_key) or True)
+
+    first = client.post('/api/click/complete', data=complete_params()).get_json()
+    retry = client.post('/api/click/complete', data=complete_params()).get_json()
+
+    assert first['error'] == 0
+    assert retry == first
+    assert enqueued == ['42_PLUS_1']
+
+
+def test_lost_completion_is_not_remembered(click):
+    client, app_module, store, monkeypatch = click
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('database unavailable')
+
+    monkeypatch.setattr(app_module.job_queue, 'enqueue', fail)
+    monkeypatch.setattr(app_module, '_run_payment_success_job', fail)
+
+    response = client.post('/api/click/complete', data=complete_params())
+
+    assert response.status_code == 500
+    assert response.get_json()['error'] == -7
+    assert store.rows == {}
@@ -0,0 +1,147 @@
+import pytest
+
+from jobs import JobQueue
+
+
+class FakeJobsDB:
+    """Records JobQueue's bookkeeping calls; enqueue dedupes on (kind, key)."""
+
+    def __init__(self) -> None:
+        self.jobs = {}
+        self.completed = []
+        self.failed = []
+
+    def enqueue_job(self, kind, dedupe_key, payload, max_attempts=8):
+        if (kind, dedupe_key) in self.jobs:
+            return False
+        self.jobs[(kind, dedupe_key)] = payload
+        return True
+
+    def complete_job(self, job_id, token):
+        self.completed.append((job_id, token))
+
+    def fail_job(self, job_id, token, error, retry_in):
+        self.failed.append((job_id, token, str(error), retry_in))
+
+
+def job(kind='payment_success', attempts=1, max_attempts=3):
+    return {'id': 5, 'kind': kind, 'dedupe_key': 'm1', 'payload': {'n': 1}, 'attempts': attempts, 'max_attempts': max_attempts}
+
+
+@pytest.fixture
+def queue():
+    db = FakeJobsDB()
+    # No worker threads: tests drive _execute directly.
+    return JobQueue(db, workers=0, backoff_base=5.0, backoff_max=60.0), db
+
+
+def test_enqueue_dedupes_on_key(queue):
+    queue, db = queue
+
+    assert queue.enqueue('payment_success', {'n': 1}, dedupe_key='m1') is True
+    assert queue.enqueue('payment_success', {'n': 2}, dedupe_key='m1') is False
+
+    assert db.jobs == {('payment_success', 'm1'): {'n': 1}}
+    assert queue.stats()['enqueued'] == 1
+    assert queue.stats()['duplicates'] == 1
+
+
+def test_successful_handler_completes_under_its_claim_token(queue):
+    queue, db = queue
+    seen = []
+    queue.register('payment_success', seen.append)
+
+    queue._execute(job(), 'token-a')
+
+    assert seen == [{'n': 1}]
+    assert db.completed == [(5, 'token-a')]
+    assert db.failed == []
+
+
+def test_failed_handler_is_retried_with_exponential_backoff(queue):
+    queue, db = queue
+
+    def boom(payload):
+        raise RuntimeError('deadlock')
+
+    queue.register('payment_success', boom)
+    for attempts in (1, 2, 3, 5):
+        queue._execute(job(attempts=attempts), 'token-a')
+
+    assert [retry_in for *_, retry_in in db.failed] == [5.0, 10.0, 20.0, 60.0]
+    assert db.failed[0][:3] == (5, 'token-a', 'deadlock')
+    assert db.completed == []
+
+
+def test_unknown_kind_fails_instead_of_completing(queue):
+    queue, db = queue
+
+    queue._execute(job(kind='mystery'), 'token-a')
+
+    assert db.completed == []
+    assert 'No handler registered' in db.failed[0][2]
+
+
+def test_observers_see_every_run(queue):
+    queue, db = queue
+    runs = []
+    queue.add_observer(lambda kind, seconds, ok: runs.append((kind, ok)))
+    queue.register('payment_success', lambda payload: None)
+
+    queue._execute(job(), 'a')
+    queue._execute(job(kind='mystery'), 'b')
+
+    assert runs == [('payment_success', True), ('mystery', False)]
+
+
+def _job_row(db, dedupe_key):
+    return db._execute(
+        "SELECT status, attempts, locked_by, last_error FROM payment_jobs WHERE dedupe_key = %s",
+        (dedupe_key,),
+        fetchone=True,
+    )
+
+
+def test_database_claim_complete_and_stale_token(mysql_db):
+    assert mysql_db.enqueue_job('payment_success', 'm1', {'n': 1}) is True
+    assert mysql_db.enqueue_job('payment_success', 'm1', {'n': 2}) is False
+
+    claimed = mysql_db.claim_job('token-a', 60)
+    assert claimed['payload'] == {'n': 1} and claimed['attempts'] == 1
+    assert mysql_db.claim_job('token-b', 60) is None
+
+    mysql_db.complete_job(claimed['id'], 'token-b')
+    assert _job_row(mysql_db, 'm1')['status'] == 'running'
+    mysql_db.complete_job(claimed['id'], 'token-a')
+    assert _job_row(mysql_db, 'm1')['status'] == 'done'
+
+
+def test_database_failed_job_is_retried_then_failed(mysql_db):
+    mysql_db.enqueue_job('payment_success', 'm2', {}, max_attempts=2)
+
+    first = mysql_db.claim_job('token-a', 60)
+    mysql_db.fail_job(first['id'], 'token-a', 'boom', 0)
+    assert _job_row(mysql_db, 'm2')['status'] == 'queued'
+
+    second = mysql_db.claim_job('token-b', 60)
+    assert second['attempts'] == 2
+    mysql_db.fail_job(second['id'], 'token-b', 'boom', 0)
+    row = _job_row(mysql_db, 'm2')
+    assert (row['status'], row['last_error']) == ('failed', 'boom')
+    assert mysql_db.claim_job('token-c', 60) is None
+
+
+def test_database_expired_lease_is_reclaimed_until_final_attempt(mysql_db):
+    mysql_db.enqueue_job('payment_success', 'm3', {}, max_attempts=2)
+    expire = "UPDATE payment_jobs SET locked_until = DATE_SUB(NOW(), INTERVAL 1 SECOND) WHERE dedupe_key = 'm3'"
+
+    mysql_db.claim_job('token-a', 60)
+    mysql_db._execute(expire)
+    reclaimed = mysql_db.claim_job('token-b', 60)
+    assert reclaimed['attempts'] == 2
+
+    mysql_db._execute(expire)
+    assert mysql_db.claim_job('token-c', 60) is None
+    row = _job_row(mysql_db, 'm3')
+    assert (row['status'], row['locked_by']) == ('failed', None)
+    assert row['last_error'] == 'Lease expired on the final attempt'
@@ -0,0 +1,41 @@
+from database import Database
+
+
+def test_migration_versions_are_unique_increasing_and_resolvable():
+    versions = [version for version, _, _ in Database.MIGRATIONS]
+    assert versions == sorted(set(versions))
+    for _, _, method in Database.MIGRATIONS:
+        assert callable(getattr(Database, method))
+
+
+def test_pending_migrations_skip_applied_versions(monkeypatch):
+    db = Database()
+    monkeypatch.setattr(db, '_promo_codes_checksum', lambda: 'abc')
+    applied = {
+        name: {'name': name, 'version': version, 'checksum': None}
+        for version, name, _ in Database.MIGRATIONS[:-1]
+    }
+    applied['seed_promo_codes'] = {'name': 'seed_promo_codes', 'version': None, 'checksum': 'abc'}
+
+    pending = db._pending_migrations(applied)
+
+    version, name, method = Database.MIGRATIONS[-1]
+    assert pending == [(name, version, None, method)]
+
+
+def test_repeatable_migration_reruns_when_checksum_changes(monkeypatch):
+    db = Database()
+    monkeypatch.setattr(db, '_promo_codes_checksum', lambda: 'new')
+    applied = {name: {'name': name, 'version': version, 'checksum': None} for version, name, _ in Database.MIGRATIONS}
+    applied['seed_promo_codes'] = {'name': 'seed_promo_codes', 'version': None, 'checksum': 'old'}
+
+    assert db._pending_migrations(applied) == [('seed_promo_codes', None, 'new', 'seed_promo_codes')]
+
+
+def test_fresh_schema_is_migrated_once(mysql_db):
+    rows = mysql_db._execute("SELECT version FROM schema_migrations WHERE version IS NOT NULL", fetchall=True)
+    assert sorted(row['version'] for row in rows) == [version for version, _, _ in Database.MIGRATIONS]
+    assert mysql_db.run_migrations() == 0
+    columns = mysql_db._table_columns('user_package_limits')
+    assert 'limits_version' in columns
+    assert 'text_reserved' not in columns
@@ -0,0 +1,122 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from loadtest import FakeTelegramHandler
+from notifier import TelegramDispatcher
+
+
+class ScriptedTelegramHandler(FakeTelegramHandler):
+    """``FakeTelegramHandler`` that first plays back ``server.script`` replies."""
+
+    def do_POST(self):
+        with self.server.lock:
+            reply = self.server.script.pop(0) if self.server.script else None
+        if reply is None:
+            super().do_POST()
+            return
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._reply(*reply)
+
+
+class FakeOutbox:
+    def __init__(self) -> None:
+        self.sent = []
+        self.rescheduled = []
+
+    def mark_notification_sent(self, notification_id, token) -> None:
+        self.sent.append((notification_id, token))
+
+    def reschedule_notification(self, notification_id, token, error, retry_in, give_up=False) -> None:
+        self.rescheduled.append({'id': notification_id, 'error': error, 'retry_in': retry_in, 'give_up': give_up})
+
+
+@pytest.fixture
+def telegram():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ScriptedTelegramHandler)
+    server.lock = threading.Lock()
+    server.latency = 0
+    server.throttle_every = 0
+    server.requests = server.messages = server.throttled = 0
+    server.script = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def outbox():
+    return FakeOutbox()
+
+
+@pytest.fixture
+def dispatcher(telegram, outbox):
+    return TelegramDispatcher(
+        outbox,
+        'test-token',
+        api_url=f'http://127.0.0.1:{telegram.server_address[1]}',
+        max_attempts=3,
+        backoff_base=2.0,
+        enabled=False,
+    )
+
+
+def message(attempts=1):
+    return {'id': 7, 'chat_id': 42, 'text': 'salom', 'attempts': attempts}
+
+
+def test_ok_response_marks_sent(dispatcher, outbox, telegram):
+    dispatcher._deliver(message(), 'lease')
+
+    assert outbox.sent == [(7, 'lease')]
+    assert outbox.rescheduled == []
+    assert telegram.messages == 1
+    assert dispatcher.stats()['sent'] == 1
+
+
+def test_rate_limited_response_pauses_bucket_and_reschedules(dispatcher, outbox, telegram):
+    telegram.throttle_every = 1
+
+    dispatcher._deliver(message(), 'lease')
+
+    assert outbox.sent == []
+    assert outbox.rescheduled == [{'id': 7, 'error': 'HTTP 429', 'retry_in': 1, 'give_up': False}]
+    assert dispatcher.bucket.try_acquire() > 0.5
+    assert dispatcher.stats()['rate_limited'] == 1
+
+
+def test_server_error_backs_off_and_retries(dispatcher, outbox, telegram):
+    telegram.script = [(502, {'ok': False}), (503, {'ok': False})]
+
+    dispatcher._deliver(message(attempts=1), 'lease')
+    dispatcher._deliver(message(attempts=2), 'lease')
+    dispatcher._deliver(message(attempts=3), 'lease')
+
+    assert outbox.rescheduled == [
+        {'id': 7, 'error': 'HTTP 502', 'retry_in': 2.0, 'give_up': False},
+        {'id': 7, 'error': 'HTTP 503', 'retry_in': 4.0, 'give_up': False},
+    ]
+    assert outbox.sent == [(7, 'lease')]
+    assert dispatcher.stats()['retried'] == 2
+
+
+def test_last_attempt_marks_failed(dispatcher, outbox, telegram):
+    telegram.script = [(500, {'ok': False})]
+
+    dispatcher._deliver(message(attempts=3), 'lease')
+
+    assert outbox.rescheduled == [{'id': 7, 'error': 'HTTP 500', 'retry_in': 8.0, 'give_up': True}]
+    assert dispatcher.stats()['failed'] == 1
+
+
+def test_unreachable_api_is_retried(dispatcher, outbox):
+    dispatcher.api_url = 'http://127.0.0.1:1'
+
+    dispatcher._deliver(message(), 'lease')
+
+    assert len(outbox.rescheduled) == 1
+    assert outbox.rescheduled[0]['give_up'] is False
+    assert outbox.sent == []
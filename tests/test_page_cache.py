@@ -0,0 +1,69 @@
+import gzip
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from page_cache import PageCache
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+def respond(app, cache, version='v1', headers=None, render=lambda: '<p>salom</p>' * 50):
+    with app.test_request_context('/', headers=headers or {}):
+        return cache.respond('page', version, render)
+
+
+def test_gzip_variant_with_its_own_etag(app):
+    cache = PageCache()
+
+    plain = respond(app, cache)
+    packed = respond(app, cache, headers={'Accept-Encoding': 'gzip'})
+
+    assert packed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(packed.get_data()) == plain.get_data()
+    assert packed.get_etag()[0] != plain.get_etag()[0]
+    assert 'Accept-Encoding' in packed.headers['Vary']
+    assert cache.stats()['renders'] == 1
+
+
+def test_matching_etag_gets_304(app):
+    cache = PageCache()
+    etag = respond(app, cache).get_etag()[0]
+
+    response = respond(app, cache, headers={'If-None-Match': f'"{etag}"'})
+
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert cache.stats()['not_modified'] == 1
+
+
+def test_new_version_renders_again(app):
+    cache = PageCache()
+    respond(app, cache, render=lambda: 'old')
+
+    assert respond(app, cache, version='v2', render=lambda: 'new').get_data() == b'new'
+    assert cache.stats()['renders'] == 2
+
+
+def test_concurrent_misses_render_once(app):
+    cache = PageCache()
+    renders = []
+
+    def render():
+        renders.append(1)
+        time.sleep(0.05)
+        return 'page'
+
+    threads = [threading.Thread(target=respond, args=(app, cache), kwargs={'render': render}) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert renders == [1]
+    assert cache.stats()['hits'] == 5
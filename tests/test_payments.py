@@ -0,0 +1,54 @@
+from contextlib import nullcontext
+
+import pymysql
+import pytest
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.calls.append(name)
+        return record
+
+
+@pytest.fixture
+def manual(monkeypatch):
+    import app as app_module
+
+    writes = Recorder()
+    payment = {'status': 'pending', 'promo_code': 'BAHOR', 'discount_percent': 10, 'discount_amount': 5000, 'amount': 45000}
+    db = app_module.db
+    monkeypatch.setitem(app_module.app.before_request_funcs, None, [])
+    monkeypatch.setattr(db, 'session', lambda transaction=False: nullcontext())
+    monkeypatch.setattr(db, 'get_payment_by_merchant_trans_id', lambda merchant_trans_id, for_update=False: payment)
+    for name in ('update_payment_complete', 'activate_tariff', 'assign_user_package', 'log_package_purchase', 'complete_promo_reservation'):
+        monkeypatch.setattr(db, name, getattr(writes, name))
+    return app_module.app.test_client(), payment, writes, monkeypatch, db
+
+
+def test_manual_complete_skips_confirmed_payment(manual):
+    client, payment, writes, _, _ = manual
+    payment['status'] = 'confirmed'
+
+    response = client.post('/manual-complete', json={'merchant_trans_id': '42_PLUS_1'})
+
+    assert response.status_code == 200
+    assert response.get_json()['success'] is True
+    assert writes.calls == []
+
+
+def test_manual_complete_fails_when_promo_write_fails(manual):
+    client, _, writes, monkeypatch, db = manual
+
+    def deadlock(*args):
+        raise pymysql.err.OperationalError(1213, 'Deadlock found when trying to get lock')
+
+    monkeypatch.setattr(db, 'complete_promo_reservation', deadlock)
+
+    response = client.post('/manual-complete', json={'merchant_trans_id': '42_PLUS_1'})
+
+    assert response.status_code == 500
+    assert response.get_json()['success'] is False
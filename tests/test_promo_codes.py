@@ -0,0 +1,112 @@
+from contextlib import nullcontext
+
+import pytest
+
+from database import Database
+
+
+class ScriptedExecute:
+    """Stands in for ``Database._execute``: records statements, answers from ``replies``."""
+
+    def __init__(self, replies=()) -> None:
+        self.replies = list(replies)
+        self.calls = []
+
+    def __call__(self, query, params=None, fetchone=False, fetchall=False):
+        self.calls.append((' '.join(query.split()), params))
+        for fragment, reply in self.replies:
+            if fragment in query:
+                return reply(params) if callable(reply) else reply
+        return None if fetchone or fetchall else 0
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = Database()
+    monkeypatch.setattr(db, 'session', lambda transaction=False: nullcontext())
+    return db
+
+
+def test_configure_shards_caps_shard_count_at_usage_limit(db):
+    db._execute = ScriptedExecute([
+        ('SELECT usage_limit', {'usage_limit': 3, 'usage_count': 0, 'counter_shards': 0}),
+    ])
+
+    db.configure_promo_shards('promo3', 4)
+
+    counters = [params for query, params in db._execute.calls if query.startswith('INSERT INTO promo_code_counters')]
+    assert [(shard, capacity) for _, shard, _, capacity in counters] == [(0, 1), (1, 1), (2, 1)]
+    assert ('UPDATE promo_codes SET counter_shards = %s WHERE code = %s', (3, 'PROMO3')) in db._execute.calls
+
+
+def test_configure_shards_leaves_single_use_code_unsharded(db):
+    db._execute = ScriptedExecute([
+        ('SELECT usage_limit', {'usage_limit': 1, 'usage_count': 0, 'counter_shards': 0}),
+    ])
+
+    db.configure_promo_shards('ONCE', 4)
+
+    assert len(db._execute.calls) == 1
+
+
+def test_sharded_claim_treats_empty_shard_of_limited_code_as_full(db):
+    db._execute = ScriptedExecute()
+
+    db._try_claim_promo_slot('PROMO3', 4, enforce_limit=True)
+
+    query = db._execute.calls[0][0]
+    assert 'p.usage_limit <= 0 OR c.used < c.capacity' in query
+    assert 'c.capacity = 0' not in query
+
+
+def test_claim_with_stale_shard_count_retries_on_current_counter(db, monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(db.promo_codes_snapshot, 'invalidate', lambda: invalidated.append(True))
+    db._execute = ScriptedExecute([
+        # The code was sharded after this worker's snapshot was taken.
+        ('UPDATE promo_codes SET usage_count', 0),
+        ('SELECT counter_shards', {'counter_shards': 4}),
+        ('UPDATE promo_code_counters', lambda params: 1 if params[2] == 4 else 0),
+    ])
+
+    claimed, shard = db._claim_promo_slot('PROMO', 0)
+
+    assert claimed and shard in range(4)
+    assert invalidated
+
+
+def test_full_code_is_not_retried(db):
+    db._execute = ScriptedExecute([('SELECT counter_shards', {'counter_shards': 0})])
+
+    assert db._claim_promo_slot('PROMO', 0) == (False, None)
+    assert sum(query.startswith('UPDATE') for query, _ in db._execute.calls) == 1
+
+
+def _create_code(db, code, limit):
+    db._execute(
+        "INSERT INTO promo_codes (code, discount_percent, usage_limit, plan_type, is_active) VALUES (%s, 10, %s, 'PLUS', 1)",
+        (code, limit),
+    )
+
+
+def test_sharded_code_never_exceeds_limit_below_shard_count(mysql_db):
+    _create_code(mysql_db, 'SHARD3', 3)
+    mysql_db.configure_promo_shards('SHARD3', 4)
+    # A shard left at capacity 0 by an older split must count as full.
+    mysql_db._execute("INSERT INTO promo_code_counters (code, shard, used, capacity) VALUES ('SHARD3', 3, 0, 0)")
+
+    results = [mysql_db.reserve_promo_code('SHARD3', 1, f'order-{n}', 10, 100) for n in range(6)]
+
+    assert results.count(True) == 3
+
+
+def test_stale_snapshot_claims_on_shard_counters(mysql_db):
+    _create_code(mysql_db, 'STALE', 2)
+    mysql_db.promo_codes_snapshot.refresh()
+    mysql_db.configure_promo_shards('STALE', 2)
+
+    results = [mysql_db.reserve_promo_code('STALE', 1, f'order-{n}', 10, 100) for n in range(4)]
+
+    assert results.count(True) == 2
+    usage = mysql_db._execute("SELECT usage_count FROM promo_codes WHERE code = 'STALE'", fetchone=True)
+    assert usage['usage_count'] == 0
@@ -0,0 +1,169 @@
+import threading
+
+import pytest
+
+from quota import QuotaEngine
+
+
+class FakeTariffCache:
+    def __init__(self) -> None:
+        self.invalidated = []
+
+    def invalidate(self, user_id) -> None:
+        self.invalidated.append(user_id)
+
+
+class FakeQuotaDB:
+    """``lease_quota``/``flush_quota_usage`` over one user's limits, in memory."""
+
+    def __init__(self, limit, version=1) -> None:
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.used = 0
+        self.version = version
+        self.leases = {}
+        self.tariff_cache = FakeTariffCache()
+        self.fail_flush = False
+
+    def lease_quota(self, lease_id, user_id, kind, units, lease_seconds):
+        with self.lock:
+            self.leases = {key: lease for key, lease in self.leases.items() if lease['version'] == self.version}
+            available = max(0, self.limit - self.used - sum(lease['units'] for lease in self.leases.values()))
+            granted = min(units, available)
+            if granted or lease_id in self.leases:
+                lease = self.leases.setdefault(lease_id, {'units': 0, 'version': self.version})
+                lease['units'] += granted
+            return {'granted': granted, 'available': available - granted, 'version': self.version}
+
+    def flush_quota_usage(self, items, lease_seconds):
+        if self.fail_flush:
+            raise RuntimeError('database unavailable')
+        with self.lock:
+            applied, dropped = 0, []
+            for user_id, kind, lease_id, version, used, released, retire in items:
+                lease = self.leases.get(lease_id)
+                if lease is None or lease['version'] != version or version != self.version:
+                    dropped.append(lease_id)
+                    continue
+                applied += 1
+                self.used += min(used, lease['units'])
+                if retire:
+                    del self.leases[lease_id]
+                else:
+                    lease['units'] = max(0, lease['units'] - used - released)
+            return applied, dropped
+
+
+def engine(db, **kwargs):
+    quota = QuotaEngine(db, grant_size=5, flush_interval=3600, **kwargs)
+    quota.start()
+    return quota
+
+
+def test_consume_leases_a_block_and_flush_writes_usage():
+    db = FakeQuotaDB(limit=12)
+    quota = engine(db)
+
+    results = [quota.consume(1, 'text')['allowed'] for _ in range(3)]
+    assert results == [True] * 3
+    assert quota.stats()['leases'] == 1
+    assert db.used == 0
+
+    assert quota.flush() == 1
+    assert db.used == 3
+    assert sum(lease['units'] for lease in db.leases.values()) == 2
+    assert db.tariff_cache.invalidated == [1]
+    quota.shutdown()
+
+
+def test_leases_never_exceed_limit_across_engines():
+    db = FakeQuotaDB(limit=40)
+    engines = [engine(db) for _ in range(3)]
+    allowed = []
+
+    def work(quota):
+        allowed.extend(quota.consume(1, 'voice')['allowed'] for _ in range(30))
+
+    threads = [threading.Thread(target=work, args=(quota,)) for quota in engines]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for quota in engines:
+        quota.shutdown()
+
+    assert allowed.count(True) == 40
+    assert db.used == 40
+    assert db.leases == {}
+
+
+def test_shutdown_returns_unused_units():
+    db = FakeQuotaDB(limit=10)
+    quota = engine(db)
+    quota.consume(1, 'text')
+
+    quota.shutdown()
+
+    assert db.used == 1
+    assert db.leases == {}
+
+
+def test_usage_on_reassigned_package_is_dropped():
+    db = FakeQuotaDB(limit=10)
+    quota = engine(db)
+    quota.consume(1, 'text', 2)
+
+    db.version = 2
+    db.leases.clear()
+    quota.flush()
+
+    assert db.used == 0
+    assert quota.stats()['dropped'] == 1
+    # The dropped grant is not served from any more; the next consume leases anew.
+    assert quota.consume(1, 'text')['allowed'] is True
+    assert all(lease['version'] == 2 for lease in db.leases.values())
+    quota.shutdown()
+
+
+def test_grant_stops_serving_when_flushes_keep_failing(monkeypatch):
+    db = FakeQuotaDB(limit=10)
+    quota = engine(db)
+    quota.consume(1, 'text')
+
+    def unavailable(*args):
+        raise RuntimeError('database unavailable')
+
+    db.fail_flush = True
+    monkeypatch.setattr(db, 'lease_quota', unavailable)
+    quota.flush()
+    assert quota.stats()['flush_errors'] == 1
+    # Within the margin the grant is still served from memory.
+    assert quota.consume(1, 'text')['allowed'] is True
+
+    quota._grants[(1, 'text')].synced_at -= QuotaEngine.LEASE_MARGIN
+    with pytest.raises(RuntimeError):
+        quota.consume(1, 'text')
+
+    db.fail_flush = False
+    quota.shutdown()
+    assert db.used == 2
+
+
+def test_unknown_kind_is_rejected():
+    with pytest.raises(ValueError):
+        QuotaEngine(FakeQuotaDB(limit=1), enabled=False).consume(1, 'video')
+
+
+def test_database_leases_and_flushes(mysql_db):
+    mysql_db.assign_user_package(7, 'P', 10, 0)
+    first = mysql_db.lease_quota('a:1', 7, 'text', 6, 60)
+    second = mysql_db.lease_quota('b:1', 7, 'text', 6, 60)
+    assert (first['granted'], second['granted'], second['available']) == (6, 4, 0)
+
+    applied, dropped = mysql_db.flush_quota_usage([(7, 'text', 'a:1', first['version'], 2, 4, True)], 60)
+    assert (applied, dropped) == (1, [])
+    assert mysql_db.lease_quota('c:1', 7, 'text', 10, 60)['granted'] == 4
+
+    mysql_db.assign_user_package(7, 'P', 10, 0)
+    applied, dropped = mysql_db.flush_quota_usage([(7, 'text', 'b:1', second['version'], 3, 0, False)], 60)
+    assert (applied, dropped) == (0, ['b:1'])
@@ -0,0 +1,97 @@
+import pytest
+
+import ratelimit
+from ratelimit import LocalBucketStore, RateLimiter
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def test_local_store_allows_burst_then_returns_wait(clock):
+    store = LocalBucketStore()
+    bucket = [('k', 2.0, 3)]
+    assert [store.take(bucket) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert store.take(bucket) == pytest.approx(0.5)
+
+
+def test_local_store_refills_at_rate_up_to_capacity(clock):
+    store = LocalBucketStore()
+    bucket = [('k', 2.0, 3)]
+    for _ in range(3):
+        store.take(bucket)
+    clock.now += 0.5
+    assert store.take(bucket) == 0.0
+    assert store.take(bucket) > 0
+    clock.now += 60
+    assert [store.take(bucket) for _ in range(4)][:3] == [0.0, 0.0, 0.0]
+    assert store.take(bucket) > 0
+
+
+def test_local_store_refused_take_charges_no_bucket(clock):
+    store = LocalBucketStore()
+    user, ip = ('user', 1.0, 5), ('ip', 1.0, 1)
+    assert store.take([user, ip]) == 0.0
+    assert store.take([user, ip]) == pytest.approx(1.0)
+    # The refusal above left the user bucket at 4 tokens.
+    assert [store.take([user]) for _ in range(4)] == [0.0] * 4
+    assert store.take([user]) > 0
+
+
+def test_local_store_evicts_least_recently_used(clock):
+    store = LocalBucketStore(maxsize=2)
+    for key in ('a', 'b', 'c'):
+        store.take([(key, 1.0, 1)])
+    assert store.take([('a', 1.0, 1)]) == 0.0
+    assert store.take([('c', 1.0, 1)]) > 0
+
+
+def test_rate_limiter_skips_missing_keys_and_counts(clock):
+    limiter = RateLimiter({'r': (1.0, 1)})
+    assert limiter.check(('r', None)) == 0.0
+    assert limiter.check(('r', 7)) == 0.0
+    assert limiter.check(('r', 7)) > 0
+    assert limiter.stats() == {'allowed': 1, 'limited': 1}
+
+
+def test_redis_store_falls_back_to_local_buckets(clock):
+    pytest.importorskip('redis')
+    store = ratelimit.RedisBucketStore('redis://127.0.0.1:1/0', timeout=0.05)
+    bucket = [('k', 1.0, 2)]
+    assert [store.take(bucket) for _ in range(2)] == [0.0, 0.0]
+    assert store.take(bucket) == pytest.approx(1.0)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'rate_limiter', RateLimiter(app_module._rate_limit_rules()))
+    monkeypatch.setattr(app_module, '_validate_promocode', lambda *args: (_ for _ in ()).throw(ValueError('x')))
+    monkeypatch.setitem(app_module.app.before_request_funcs, None, [])
+    return app_module.app.test_client(), app_module
+
+
+def test_promocode_validate_returns_429_with_retry_after(client):
+    client, app_module = client
+    burst = app_module.RATE_LIMIT_CONFIG['promo_burst']
+    body = {'code': 'ABC', 'amount': 1000, 'user_id': 5}
+    statuses = [client.post('/api/promocode/validate', json=body).status_code for _ in range(burst)]
+    assert statuses == [400] * burst
+    response = client.post('/api/promocode/validate', json=body)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert response.get_json()['success'] is False
+    # Another user behind the same address still gets through.
+    assert client.post('/api/promocode/validate', json={**body, 'user_id': 6}).status_code == 400
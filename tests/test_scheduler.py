@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import click_api
+from scheduler import TariffExpiryScheduler
+
+
+class FakeUsersDB:
+    """Users 1..``users``; records the chunks a pass read."""
+
+    def __init__(self, users) -> None:
+        self.users = users
+        self.cursors = {}
+        self.chunks = []
+
+    def get_scheduler_cursor(self, name):
+        return self.cursors.get(name, 0)
+
+    def set_scheduler_cursor(self, name, position):
+        self.cursors[name] = position
+
+    def users_chunk_bound(self, after_user_id, size):
+        upper = min(after_user_id + size, self.users)
+        return upper if upper > after_user_id else None
+
+    def tariff_expiry_candidates(self, after_user_id, upper_user_id, remind_days):
+        self.chunks.append((after_user_id, upper_user_id))
+        return []
+
+
+def scheduler(db, chunks_per_pass):
+    task = TariffExpiryScheduler(db, chunk_size=10, enabled=False)
+    budget = iter([True] * (chunks_per_pass - 1) + [False])
+    task._pool_busy = lambda: False
+    task._throttle = lambda started: next(budget, False)
+    return task
+
+
+def test_pass_resumes_where_the_last_one_stopped():
+    db = FakeUsersDB(users=35)
+
+    scheduler(db, chunks_per_pass=2).run_once()
+    # A newly elected leader picks up the stored cursor.
+    scheduler(db, chunks_per_pass=2).run_once()
+
+    assert db.chunks == [(0, 10), (10, 20), (20, 30), (30, 35)]
+
+
+def test_cursor_wraps_only_at_end_of_table():
+    db = FakeUsersDB(users=20)
+    task = scheduler(db, chunks_per_pass=5)
+
+    task.run_once()
+
+    assert db.cursors[TariffExpiryScheduler.LOCK_NAME] == 0
+    assert db.chunks == [(0, 10), (10, 20)]
+
+
+def test_lapsed_tariff_reads_as_free_before_the_scheduler_runs():
+    lapsed = {'tariff': 'PRO', 'tariff_expires_at': datetime.now() - timedelta(minutes=1)}
+    active = {'tariff': 'PRO', 'tariff_expires_at': datetime.now() + timedelta(days=1)}
+
+    assert click_api.resolve_tariff(lapsed)['tariff'] == 'Bepul'
+    assert click_api.resolve_tariff(active)['tariff'] == 'PRO'
+    assert click_api.resolve_tariff(None) == {'tariff': 'Bepul', 'expires_at': None}